@@ -12,17 +12,21 @@ from party import (
 )
 from shipment import (
     ShipmentOut, GenerateShippingLabelMessage, GenerateShippingLabel,
-    ShippingCarrierSelector, SelectShippingRate
+    ShippingCarrierSelector, SelectShippingRate,
+    GenerateShippingLabelsBatchEnd, GenerateShippingLabelsBatch
 )
 from stock import StockMove
-from sale import Sale, SaleLine, ReturnSale, ApplyShippingStart, \
-    ApplyShippingSelectRate, ApplyShipping
+from sale import Sale, SaleLine, SaleShippingRate, ReturnSale, \
+    ApplyShippingStart, ApplyShippingSelectRate, ApplyShipping
 from configuration import PartyConfiguration
 from log import CarrierLog
 from manifest import ShippingManifest
 from location import Location
 from package import Package
+from product import Template, Product, Uom
 from tracking import ShipmentTracking
+from rate_table import CarrierZone, CarrierZoneLine, CarrierWeightBreak
+from single_flight import RateRequest
 
 
 def register():
@@ -33,18 +37,27 @@ def register():
         CarrierService,
         BoxType,
         CarrierBoxType,
+        CarrierZone,
+        CarrierZoneLine,
+        CarrierWeightBreak,
         CarrierLog,
+        RateRequest,
         Address,
         ShipmentTracking,
         ShippingManifest,
         ShipmentOut,
         StockMove,
         Package,
+        Template,
+        Product,
+        Uom,
         Sale,
         SaleLine,
+        SaleShippingRate,
         ApplyShippingStart,
         ApplyShippingSelectRate,
         GenerateShippingLabelMessage,
+        GenerateShippingLabelsBatchEnd,
         SelectShippingRate,
         ShippingCarrierSelector,
         AddressValidationMsg,
@@ -54,6 +67,7 @@ def register():
     )
     Pool.register(
         GenerateShippingLabel,
+        GenerateShippingLabelsBatch,
         AddressValidationWizard,
         ReturnSale,
         ApplyShipping,
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+    adapter.py
+
+    Carrier adapters, whose network calls run on a pool of threads shared
+    by the process.
+"""
+import threading
+import time
+from Queue import Queue, Empty
+
+from trytond.config import config
+
+__all__ = [
+    'CarrierAdapter', 'AdapterTimeout', 'register_adapter',
+    'unregister_adapter', 'get_adapter', 'run_sync', 'iter_run',
+]
+
+_adapters = {}
+
+#: Calls waiting for a thread of the adapters, shared by the process.
+_calls = Queue()
+_threads = []
+_threads_lock = threading.Lock()
+
+
+class AdapterTimeout(Exception):
+    "A call to a carrier adapter did not complete in time"
+
+
+class CarrierAdapter(object):
+    """
+    Base of the adapters of carriers.
+
+    An operation (`rate`, `label`, `track` and `validate`) is split in
+    three methods so only the network call leaves the Tryton transaction:
+
+    * `prepare_<operation>(record, *args)` runs in the transaction and
+      returns the request, plain data built from the records.
+    * `<operation>(request)` sends the request and returns the response,
+      it runs on a thread of the adapters and must not touch records.
+    * `parse_<operation>(record, request, response)` runs back in the
+      transaction and returns the result of the operation.
+
+    The records are a sale or a shipment for `rate` (with the carrier and
+    the carrier service as arguments), a shipment for `label`, a
+    `shipment.tracking` for `track` and a `party.address` for `validate`.
+    The results are those of `get_shipping_rate`,
+    `generate_shipping_labels`, `refresh_status` and `validate_address`.
+    """
+
+    def prepare_rate(self, record, carrier, carrier_service=None):
+        raise NotImplementedError
+
+    def rate(self, request):
+        raise NotImplementedError
+
+    def parse_rate(self, record, request, response):
+        raise NotImplementedError
+
+    def prepare_label(self, shipment):
+        raise NotImplementedError
+
+    def label(self, request):
+        raise NotImplementedError
+
+    def parse_label(self, shipment, request, response):
+        raise NotImplementedError
+
+    def prepare_track(self, tracking):
+        raise NotImplementedError
+
+    def track(self, request):
+        raise NotImplementedError
+
+    def parse_track(self, tracking, request, response):
+        raise NotImplementedError
+
+    def prepare_validate(self, address):
+        raise NotImplementedError
+
+    def validate(self, request):
+        raise NotImplementedError
+
+    def parse_validate(self, address, request, response):
+        raise NotImplementedError
+
+    def supports(self, operation):
+        "Tells if the adapter implements the three methods of the operation"
+        return all(
+            getattr(type(self), name) != getattr(CarrierAdapter, name)
+            for name in (
+                'prepare_%s' % operation, operation, 'parse_%s' % operation,
+            )
+        )
+
+    def run(self, operation, record, *args, **kwargs):
+        """
+        Runs the operation for the record and waits for its result, it is
+        the bridge used by the RPC entry points.
+        """
+        request = getattr(self, 'prepare_%s' % operation)(record, *args)
+        response = run_sync(
+            getattr(self, operation), request, kwargs.get('timeout')
+        )
+        return getattr(self, 'parse_%s' % operation)(
+            record, request, response
+        )
+
+
+def register_adapter(carrier_cost_method, adapter):
+    """
+    Drives the carriers of the cost method through the adapter.
+    """
+    _adapters[carrier_cost_method] = adapter
+
+
+def unregister_adapter(carrier_cost_method):
+    _adapters.pop(carrier_cost_method, None)
+
+
+def get_adapter(carrier_cost_method, operation=None):
+    """
+    Returns the adapter of the cost method, None if it has none or if it
+    does not support the operation.
+    """
+    adapter = _adapters.get(carrier_cost_method)
+    if adapter is not None and operation and not adapter.supports(operation):
+        return None
+    return adapter
+
+
+def get_adapter_workers():
+    """
+    Threads sending the calls of the adapters of the process, read from
+    the `adapter_workers` option of the `shipping` configuration section.
+    """
+    return config.getint('shipping', 'adapter_workers', default=10)
+
+
+def _work():
+    "Thread body of the adapters"
+    while True:
+        send, request, results, key = _calls.get()
+        try:
+            results.put((key, send(request), None))
+        except Exception as exc:
+            results.put((key, None, exc))
+
+
+def _submit(send, request, results, key):
+    """
+    Queues the call of `send` with the request, `(key, response, error)` is
+    put in `results` once it completes
+    """
+    with _threads_lock:
+        while len(_threads) < get_adapter_workers():
+            thread = threading.Thread(target=_work, name='shipping-adapters')
+            thread.daemon = True
+            thread.start()
+            _threads.append(thread)
+    _calls.put((send, request, results, key))
+
+
+def _get_deadline(timeout):
+    return time.time() + (timeout or float('inf'))
+
+
+def _iter_results(results, count, deadline):
+    """
+    Yields `(key, response, error)` for `count` calls as they complete and
+    stops at the deadline
+    """
+    # Queue.get without a timeout cannot be interrupted, so wait in slices
+    while count and time.time() < deadline:
+        try:
+            result = results.get(
+                timeout=max(min(deadline - time.time(), 3600), 0)
+            )
+        except Empty:
+            continue
+        count -= 1
+        yield result
+
+
+def run_sync(send, request, timeout=None):
+    """
+    Calls `send` with the request from a thread of the adapters and returns
+    its response, raising `AdapterTimeout` after `timeout` seconds.
+    """
+    results = Queue()
+    _submit(send, request, results, None)
+    for _, response, error in _iter_results(
+            results, 1, _get_deadline(timeout)):
+        if error is not None:
+            raise error
+        return response
+    raise AdapterTimeout()
+
+
+def iter_run(adapter, operation, calls, timeout=None, throttle=None):
+    """
+    Sends the operation of the adapter for each tuple of arguments of
+    `calls` at once and returns an iterator of `(arguments, result, error)`
+    tuples in completion order.
+
+    Requests are prepared and sent before returning, so the calls are in
+    flight together on the threads of the adapters while the caller does
+    something else, and responses are parsed while iterating. Both run in
+    the transaction of the caller. The error of a call, from preparing,
+    sending or parsing it, is given with its arguments and does not stop
+    the others. Calls which did not complete within `timeout` seconds of
+    being sent come last with an `AdapterTimeout` error, they are not
+    waited for. The `ready()` method of the iterator gives only the results
+    of the calls which completed already, without waiting.
+
+    `throttle`, called with the arguments of each call while preparing it,
+    may return a function the thread of the call runs right before sending
+    it, such as :meth:`carrier.Carrier.get_throttle`, its error is the
+    error of the call.
+    """
+    prepare = getattr(adapter, 'prepare_%s' % operation)
+    send = getattr(adapter, operation)
+
+    results, sent, failed = Queue(), {}, []
+    for index, args in enumerate(calls):
+        try:
+            request = prepare(*args)
+        except Exception as exc:
+            failed.append((args, None, exc))
+            continue
+        sent[index] = (args, request)
+        _submit(
+            _throttled(send, throttle and throttle(*args)), request, results,
+            index
+        )
+    return _Run(
+        getattr(adapter, 'parse_%s' % operation), failed, sent, results,
+        _get_deadline(timeout)
+    )
+
+
+def _throttled(send, throttle):
+    "Returns `send` calling `throttle` first"
+    if throttle is None:
+        return send
+
+    def call(request):
+        throttle()
+        return send(request)
+    return call
+
+
+class _Run(object):
+    """
+    Calls sent together by `iter_run`, iterating gives their results as
+    they complete.
+    """
+
+    def __init__(self, parse, failed, sent, results, deadline):
+        self.parse = parse
+        self.failed = failed
+        self.sent = sent
+        self.results = results
+        self.deadline = deadline
+
+    def _pop(self, index, response, error):
+        args, request = self.sent.pop(index)
+        if error is None:
+            try:
+                return args, self.parse(args[0], request, response), None
+            except Exception as exc:
+                error = exc
+        return args, None, error
+
+    def ready(self):
+        "Yields the results of the calls which completed already"
+        while self.failed:
+            yield self.failed.pop(0)
+        while self.sent:
+            try:
+                index, response, error = self.results.get_nowait()
+            except Empty:
+                return
+            yield self._pop(index, response, error)
+
+    def __iter__(self):
+        for result in self.ready():
+            yield result
+        for index, response, error in _iter_results(
+                self.results, len(self.sent), self.deadline):
+            yield self._pop(index, response, error)
+        for index in sorted(self.sent):
+            yield self.sent.pop(index)[0], None, AdapterTimeout()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+    breaker.py
+
+    Circuit breakers isolating the carriers whose API is failing.
+"""
+import logging
+import threading
+import time
+
+from trytond import backend
+from trytond.config import config
+from trytond.exceptions import UserError, UserWarning
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = [
+    'CLOSED', 'OPEN', 'HALF_OPEN', 'allow_call', 'cancel_call',
+    'record_success', 'record_failure', 'get_circuit_state',
+    'is_carrier_failure',
+]
+
+logger = logging.getLogger(__name__)
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+class _Circuit(object):
+    __slots__ = ('state', 'failures', 'opened')
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = None
+
+
+#: Circuits of the carriers which failed since they last answered, keyed on
+#: the database and the carrier, shared by the threads of the process.
+_circuits = {}
+_circuits_lock = threading.Lock()
+
+
+def get_breaker_failures():
+    """
+    Consecutive failures opening the circuit of a carrier, read from the
+    `breaker_failures` option of the `shipping` configuration section.
+    """
+    return config.getint('shipping', 'breaker_failures', default=5)
+
+
+def get_breaker_reset():
+    """
+    Seconds an open circuit waits before letting a trial call through, read
+    from the `breaker_reset` option of the `shipping` configuration section.
+    """
+    return config.getfloat('shipping', 'breaker_reset', default=60)
+
+
+def is_carrier_failure(error):
+    """
+    Tells if the error means the carrier failed to answer, user errors are
+    answers of the carrier.
+    """
+    return not isinstance(error, (UserError, UserWarning))
+
+
+def _log(carrier, message):
+    "Records the transition in `carrier.log`"
+    logger.warning('Carrier %s: %s', carrier.rec_name, message)
+
+    CarrierLog = Pool().get('carrier.log')
+    values = [{'carrier': carrier.id, 'log': message}]
+    transaction = Transaction()
+    if backend.name() != 'sqlite':
+        # The transition must be kept even if the caller rolls back
+        with transaction.new_transaction():
+            CarrierLog.create(values)
+    elif not transaction.readonly:
+        CarrierLog.create(values)
+
+
+def _get_key(carrier):
+    return (Transaction().database.name, carrier.id)
+
+
+def get_circuit_state(carrier):
+    "Returns the state of the circuit of the carrier"
+    circuit = _circuits.get(_get_key(carrier))
+    return circuit.state if circuit is not None else CLOSED
+
+
+def allow_call(carrier):
+    """
+    Tells if a call to the carrier may be made. Calls are refused while the
+    circuit is open, once the reset delay is over a single trial call goes
+    through and the circuit is half-open until it completes.
+    """
+    with _circuits_lock:
+        circuit = _circuits.get(_get_key(carrier))
+        if circuit is None or circuit.state == CLOSED:
+            return True
+        if circuit.state == HALF_OPEN or \
+                time.time() < circuit.opened + get_breaker_reset():
+            return False
+        circuit.state = HALF_OPEN
+    _log(carrier, 'Circuit half-open, trying a call')
+    return True
+
+
+def cancel_call(carrier):
+    """
+    Gives back the call allowed by `allow_call` when it was not made, the
+    next call is the trial of a half-open circuit again.
+    """
+    with _circuits_lock:
+        circuit = _circuits.get(_get_key(carrier))
+        if circuit is not None and circuit.state == HALF_OPEN:
+            circuit.state = OPEN
+
+
+def record_success(carrier):
+    "Closes the circuit of the carrier, it answered"
+    with _circuits_lock:
+        circuit = _circuits.pop(_get_key(carrier), None)
+    if circuit is not None and circuit.state != CLOSED:
+        _log(carrier, 'Circuit closed, the carrier answers again')
+
+
+def record_failure(carrier, error):
+    """
+    Counts a failure of the carrier, the circuit opens after too many
+    consecutive failures or when the trial call of a half-open circuit
+    fails.
+    """
+    with _circuits_lock:
+        circuit = _circuits.setdefault(_get_key(carrier), _Circuit())
+        circuit.failures += 1
+        opens = circuit.state == HALF_OPEN or (
+            circuit.state == CLOSED and
+            circuit.failures >= get_breaker_failures()
+        )
+        if opens:
+            circuit.state = OPEN
+            circuit.opened = time.time()
+        failures = circuit.failures
+    if opens:
+        _log(carrier, 'Circuit opened after %d failures, last one: %s' % (
+            failures, error
+        ))
@@ -7,9 +7,14 @@ from decimal import Decimal
 
 from trytond.pool import PoolMeta, Pool
 from trytond.model import ModelSQL, ModelView, fields
+from trytond.cache import Cache
 from trytond.transaction import Transaction
 from trytond.pyson import Eval, Or, Bool, Id
 
+from .rating import clear_rate_cache, get_rate_timeout
+from .limiter import CallBudgetExhausted, get_bucket, get_call_priority
+from .rate_table import RateTable
+
 __all__ = [
     'Carrier', 'Service', 'CarrierService', 'BoxType', 'CarrierBoxType'
 ]
@@ -45,10 +50,216 @@ class Carrier:
         ]], depends=['carrier_cost_method']
     )
 
+    #: Rate from the zones and weight breaks of the carrier instead of its
+    #: cost method.
+    use_rate_table = fields.Boolean('Use Rate Table')
+    rate_surcharge = fields.Numeric(
+        'Surcharge (%)', digits=(16, 2), states={
+            'invisible': ~Eval('use_rate_table'),
+        }, depends=['use_rate_table'],
+        help='Percentage added to the prices of the rate table'
+    )
+    rate_zones = fields.One2Many(
+        'carrier.zone', 'carrier', 'Rate Zones', states={
+            'invisible': ~Eval('use_rate_table'),
+        }, depends=['use_rate_table']
+    )
+    weight_breaks = fields.One2Many(
+        'carrier.weight_break', 'carrier', 'Weight Breaks', states={
+            'invisible': ~Eval('use_rate_table'),
+        }, depends=['use_rate_table']
+    )
+
+    #: Pack the shipments into the box types of the carrier instead of a
+    #: single default package.
+    auto_pack = fields.Boolean(
+        'Auto Pack', help='Pack the moves of the shipments without packages '
+        'into the box types of the carrier, based on the dimensions and '
+        'weights of the products.'
+    )
+
+    #: Volume per unit of weight the carrier bills packages on, as in
+    #: 5000 cubic centimeters per kilogram. Actual weights are billed when
+    #: empty.
+    dimensional_weight_divisor = fields.Float(
+        'Dimensional Weight Divisor',
+        help='Volume of a package, in the cube of the distance unit, per '
+        'unit of weight billed. Packages are billed the larger of their '
+        'weight and dimensional weight. Leave empty to bill the actual '
+        'weight.'
+    )
+    dimensional_distance_uom = fields.Many2One(
+        'product.uom', 'Dimensional Distance Unit', states={
+            'required': Bool(Eval('dimensional_weight_divisor')),
+            'invisible': ~Eval('dimensional_weight_divisor'),
+        }, domain=[
+            ('category', '=', Id('product', 'uom_cat_length'))
+        ], depends=['dimensional_weight_divisor']
+    )
+    dimensional_weight_uom = fields.Many2One(
+        'product.uom', 'Dimensional Weight Unit', states={
+            'required': Bool(Eval('dimensional_weight_divisor')),
+            'invisible': ~Eval('dimensional_weight_divisor'),
+        }, domain=[
+            ('category', '=', Id('product', 'uom_cat_weight'))
+        ], depends=['dimensional_weight_divisor']
+    )
+
+    #: Calls per second the API of the carrier allows, unlimited when empty.
+    api_calls_per_second = fields.Float(
+        'API Calls per Second',
+        help='Calls to the carrier API allowed per second by each server '
+        'process, the calls above it wait. Leave empty for no limit.'
+    )
+    api_call_burst = fields.Integer(
+        'API Call Burst', help='Calls which can be made at once after a pause'
+    )
+
+    _active_carriers_cache = Cache(
+        'carrier.get_active_carriers', context=False
+    )
+    _rate_table_cache = Cache('carrier.get_rate_table', context=False)
+
     @staticmethod
     def default_active():
         return True
 
+    @classmethod
+    def get_active_carriers(cls):
+        """
+        Returns the active carriers, as used by rating when no carrier is
+        given.
+
+        The ids are cached per database, user and company until a carrier,
+        a carrier service or a carrier box type changes. The carriers are
+        browsed together so their services, box types and carrier products
+        are read in one pass for all of them.
+        """
+        transaction = Transaction()
+        key = (transaction.user, transaction.context.get('company'))
+        ids = cls._active_carriers_cache.get(key)
+        if ids is None:
+            ids = map(int, cls.search([('active', '=', True)]))
+            cls._active_carriers_cache.set(key, ids)
+
+        carriers = cls.browse(ids)
+        for carrier in carriers[:1]:
+            carrier.carrier_cost_method
+            carrier.carrier_product.list_price
+            carrier.services
+            carrier.box_types
+        return carriers
+
+    def get_rate_table(self):
+        """
+        Returns the :class:`rate_table.RateTable` of the carrier, it is built
+        once and cached until the carrier or its rate table changes.
+        """
+        table = self._rate_table_cache.get(self.id)
+        if table is None:
+            table = RateTable.from_carrier(self)
+            self._rate_table_cache.set(self.id, table)
+        return table
+
+    @staticmethod
+    def default_use_rate_table():
+        return False
+
+    @staticmethod
+    def default_auto_pack():
+        return False
+
+    def get_dimensional_weight(self, dimensions, distance_uom, weight_uom):
+        """
+        Returns the weight in `weight_uom` the carrier bills for the volume
+        of a package of `(length, width, height)` dimensions in
+        `distance_uom`. None when the carrier bills the actual weight or a
+        dimension is missing.
+        """
+        Uom = Pool().get('product.uom')
+
+        if not self.dimensional_weight_divisor or not distance_uom or \
+                not all(dimensions):
+            return None
+        volume = 1
+        for dimension in dimensions:
+            volume *= Uom.convert_qty(
+                distance_uom, dimension, self.dimensional_distance_uom,
+                round=False
+            )
+        return Uom.convert_qty(
+            self.dimensional_weight_uom,
+            volume / self.dimensional_weight_divisor, weight_uom
+        )
+
+    @classmethod
+    def __setup__(cls):
+        super(Carrier, cls).__setup__()
+        cls._error_messages.update({
+            'api_call_budget_exhausted':
+                'Carrier "%s" is busy, please retry in a moment.',
+        })
+
+    def _get_api_call_key(self):
+        """
+        Returns the key the API calls are budgeted on. Downstream modules
+        whose carriers share an account should return the account, so the
+        carriers of the account share its budget.
+        """
+        return ('carrier', self.id)
+
+    def throttle(self):
+        """
+        Waits until the API call budget of the carrier allows one more call
+        and takes it. Calls made in a `shipping_call_priority` background
+        context only go through when no interactive call is waiting.
+
+        Raises a user error if no call could be made within the rate timeout.
+
+        The budget is per server process, it is not shared with the other
+        processes: with several processes, set a share of the quota of the
+        carrier API.
+        """
+        throttle = self.get_throttle()
+        if throttle:
+            throttle()
+
+    def get_throttle(self):
+        """
+        Returns a function doing what `throttle` does without the
+        transaction, to be called from the thread making the call right
+        before it. None if the calls of the carrier are not budgeted.
+        """
+        if not self.api_calls_per_second:
+            return None
+        bucket = get_bucket(
+            self._get_api_call_key(), self.api_calls_per_second,
+            self.api_call_burst or 1
+        )
+        priority, timeout = get_call_priority(), get_rate_timeout()
+        message = self.raise_user_error(
+            'api_call_budget_exhausted', error_args=(self.rec_name,),
+            raise_exception=False
+        )
+
+        def throttle():
+            if not bucket.acquire(priority, timeout):
+                raise CallBudgetExhausted(message)
+        return throttle
+
+    @classmethod
+    def clear_caches(cls):
+        "Clear what is cached about carriers"
+        cls._active_carriers_cache.clear()
+        cls._rate_table_cache.clear()
+        clear_rate_cache()
+
+    @classmethod
+    def create(cls, vlist):
+        carriers = super(Carrier, cls).create(vlist)
+        cls.clear_caches()
+        return carriers
+
     @staticmethod
     def default_currency():
         Company = Pool().get('company.company')
@@ -57,6 +268,16 @@ class Carrier:
         if company:
             return Company(company).currency.id
 
+    @classmethod
+    def write(cls, *args):
+        super(Carrier, cls).write(*args)
+        cls.clear_caches()
+
+    @classmethod
+    def delete(cls, carriers):
+        super(Carrier, cls).delete(carriers)
+        cls.clear_caches()
+
     def get_sale_price(self):
         """
         Returns sale price for a carrier in following format:
@@ -109,6 +330,22 @@ class CarrierService(ModelSQL):
         select=True
     )
 
+    @classmethod
+    def create(cls, vlist):
+        records = super(CarrierService, cls).create(vlist)
+        Pool().get('carrier').clear_caches()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(CarrierService, cls).write(*args)
+        Pool().get('carrier').clear_caches()
+
+    @classmethod
+    def delete(cls, records):
+        super(CarrierService, cls).delete(records)
+        Pool().get('carrier').clear_caches()
+
 
 class BoxType(ModelSQL, ModelView):
     "Carrier Box Type"
@@ -143,6 +380,19 @@ class BoxType(ModelSQL, ModelView):
         ], depends=['length', 'width', 'height']
     )
 
+    #: Heaviest content the box takes, unlimited when empty.
+    maximum_weight = fields.Float('Maximum Weight')
+
+    #: Measuring unit of the maximum weight.
+    maximum_weight_uom = fields.Many2One(
+        'product.uom', 'Maximum Weight Uom', states={
+            'required': Bool(Eval('maximum_weight')),
+        },
+        domain=[
+            ('category', '=', Id('product', 'uom_cat_weight'))
+        ], depends=['maximum_weight']
+    )
+
     @staticmethod
     def check_xml_record(records, values):
         return True
@@ -159,3 +409,19 @@ class CarrierBoxType(ModelSQL):
         "carrier.box_type", "Box Type", ondelete="CASCADE", required=True,
         select=True
     )
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(CarrierBoxType, cls).create(vlist)
+        Pool().get('carrier').clear_caches()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(CarrierBoxType, cls).write(*args)
+        Pool().get('carrier').clear_caches()
+
+    @classmethod
+    def delete(cls, records):
+        super(CarrierBoxType, cls).delete(records)
+        Pool().get('carrier').clear_caches()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+    limiter.py
+
+    Token buckets budgeting the calls made to carrier APIs. The buckets
+    live in the server process, each process has its own budget.
+"""
+import threading
+import time
+
+from trytond.exceptions import UserError
+from trytond.transaction import Transaction
+
+__all__ = [
+    'INTERACTIVE', 'BACKGROUND', 'TokenBucket', 'CallBudgetExhausted',
+    'get_bucket', 'get_call_priority',
+]
+
+#: Priority of the calls made for a user waiting on them.
+INTERACTIVE = 0
+
+#: Priority of the calls made by crons and other background jobs, they
+#: only get a token when no interactive call is waiting for one.
+BACKGROUND = 1
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class CallBudgetExhausted(UserError):
+    "No token of the bucket of a carrier could be taken in time"
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket refilled with `rate` tokens per second and
+    holding at most `burst` tokens.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.waiting = [0, 0]
+        self.condition = threading.Condition()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def acquire(self, priority=INTERACTIVE, timeout=None):
+        """
+        Takes a token, waiting up to `timeout` seconds for one. Returns
+        False if no token could be taken in time.
+
+        Callers of a lower priority do not take tokens while callers of a
+        higher priority are waiting.
+        """
+        if timeout is None:
+            timeout = float('inf')
+        deadline = time.time() + timeout
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    self._refill()
+                    if self.tokens >= 1 and not any(self.waiting[:priority]):
+                        self.tokens -= 1
+                        return True
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(
+                        min(max((1 - self.tokens) / self.rate, 0.01),
+                            remaining)
+                    )
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+
+def get_bucket(key, rate, burst):
+    """
+    Returns the bucket of the process for the key in the database of the
+    transaction, it is replaced when the limits change.
+    """
+    key = (Transaction().database.name, key)
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None or (bucket.rate, bucket.burst) != (
+                rate, max(burst, 1)):
+            bucket = _buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+
+def get_call_priority():
+    """
+    Priority of the calls of the transaction, background when the
+    `shipping_call_priority` context key says so.
+    """
+    if Transaction().context.get('shipping_call_priority') == 'background':
+        return BACKGROUND
+    return INTERACTIVE
@@ -3,13 +3,53 @@
     mixin.py
 
 """
-from trytond.model import fields, ModelView
+import datetime
+import logging
+from decimal import Decimal
+
+from trytond.config import config
+from trytond.exceptions import UserError, UserWarning
+from trytond.model import fields, Model, ModelView
 from trytond.pool import Pool
 from trytond.pyson import Eval, Or, Bool
 from trytond.transaction import Transaction
 from trytond.modules.stock_package.stock import PackageMixin
 
-__all__ = ['ShipmentCarrierMixin']
+from .rating import (
+    fan_out_shipping_rates, iter_shipping_rates, quote_shipping_rate,
+    address_fingerprint, get_rate_adapter, get_rate_timeout, imap_unordered
+)
+from .adapter import get_adapter, iter_run
+from .rate_table import get_rate_table_rates, get_rate_table_rates_bulk
+from .packing import Item, Box, pack
+
+__all__ = ['ShipmentCarrierMixin', 'get_label_workers']
+
+logger = logging.getLogger(__name__)
+
+
+def get_label_workers():
+    """
+    Size of the worker pool generating the labels of a batch of shipments,
+    read from the `label_workers` option of the `shipping` configuration
+    section.
+    """
+    return config.getint('shipping', 'label_workers', default=4)
+
+
+def _can_generate_apart():
+    """
+    Labels are generated from transactions of their own, the database must
+    be reachable from another connection.
+    """
+    return Transaction().database.name != ':memory:'
+
+
+def _get_error_message(error):
+    "Returns the message of the error for the summary of a batch"
+    if isinstance(error, (UserError, UserWarning)):
+        return error.message
+    return '%s: %s' % (error.__class__.__name__, error)
 
 
 class ShipmentCarrierMixin(PackageMixin):
@@ -30,6 +70,15 @@ class ShipmentCarrierMixin(PackageMixin):
         ),
         'get_weight'
     )
+    #: Weight the carrier bills for the shipment, see
+    #: `get_billable_weights`.
+    billable_weight = fields.Function(
+        fields.Float(
+            "Billable Weight", digits=(16, Eval('weight_digits', 2)),
+            depends=['weight_digits'],
+        ),
+        'get_billable_weight'
+    )
     weight_uom = fields.Function(
         fields.Many2One('product.uom', 'Weight UOM'),
         'get_weight_uom'
@@ -102,24 +151,88 @@ class ShipmentCarrierMixin(PackageMixin):
         """
         Returns sum of weight associated with each package or
         move line otherwise
+
+        The weights of all the packages, and of all the moves, of the
+        records are computed together.
         """
-        Uom = Pool().get('product.uom')
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Package = pool.get('stock.package')
 
-        res = {}
+        package_weights = Package.get_weights(
+            [p for record in records for p in record.packages]
+        )
+        res, moves = {}, []
         for record in records:
             weight_uom = record.weight_uom
             if record.packages:
                 res[record.id] = sum([
-                    Uom.compute_qty(p.weight_uom, p.weight, weight_uom)
+                    Uom.convert_qty(
+                        p.weight_uom, package_weights[p.id], weight_uom
+                    )
                     for p in record.packages
                 ])
             else:
+                moves.append((record, record.carrier_cost_moves))
+        res.update(cls._sum_move_weights(moves))
+        return res
+
+    @classmethod
+    def get_billable_weights(cls, records, carrier=None):
+        """
+        Returns a dictionary with the weight billed for each record by
+        `carrier`, or by the carrier of the record: the sum of the billable
+        weights of its packages, or its weight when it has no package.
+
+        The weights of all the packages of the records are computed
+        together.
+        """
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Package = pool.get('stock.package')
+
+        package_weights = Package.get_billable_weights(
+            [p for record in records for p in record.packages], carrier
+        )
+        res = cls.get_weight([r for r in records if not r.packages])
+        for record in records:
+            if record.packages:
                 res[record.id] = sum([
-                    move.get_weight(weight_uom, silent=True)
-                    for move in record.carrier_cost_moves
+                    Uom.convert_qty(
+                        p.weight_uom, package_weights[p.id], record.weight_uom
+                    )
+                    for p in record.packages
                 ])
         return res
 
+    @classmethod
+    def get_billable_weight(cls, records, name):
+        return cls.get_billable_weights(records)
+
+    @staticmethod
+    def _sum_move_weights(moves):
+        """
+        Returns the weight of each record from the list of its
+        `(record, moves)` pairs
+        """
+        Move = Pool().get('stock.move')
+
+        by_uom = {}
+        for record, record_moves in moves:
+            by_uom.setdefault(record.weight_uom, []).append(
+                (record, record_moves)
+            )
+
+        res = {}
+        for weight_uom, uom_moves in by_uom.iteritems():
+            weights = Move.sum_weights(
+                [record_moves for _, record_moves in uom_moves], weight_uom,
+                silent=True
+            )
+            for (record, _), weight in zip(uom_moves, weights):
+                res[record.id] = weight
+        return res
+
     @fields.depends('weight_uom')
     def on_change_with_weight_digits(self, name=None):
         if self.weight_uom:
@@ -153,6 +266,9 @@ class ShipmentCarrierMixin(PackageMixin):
                 'Carrier for selected shipment is not of %s',
             'no_packages': 'Shipment %s has no packages',
             'warehouse_address_missing': 'Warehouse address is missing',
+            'carrier_rate_timeout':
+                'Carriers %s did not answer the rate request in time',
+            'unknown_rate_policy': 'Unknown rate policy "%s"',
         })
 
         # Following fields are already there in customer shipment, have
@@ -251,6 +367,15 @@ class ShipmentCarrierMixin(PackageMixin):
         if not silent:
             return self.raise_user_error('warehouse_address_missing')
 
+    def _get_ship_to_address(self):
+        """
+        The address the shipment is delivered to
+        """
+        if hasattr(self, 'delivery_address'):
+            return self.delivery_address
+        elif hasattr(self, 'contact_address'):
+            return self.contact_address
+
     def allow_label_generation(self):
         """
         Shipment must be in the right states and tracking number must not
@@ -268,20 +393,150 @@ class ShipmentCarrierMixin(PackageMixin):
         """
         Create a single stock package for the whole shipment
         """
-        Package = Pool().get('stock.package')
+        package, = self.create_packages([
+            self._get_default_package_values(box_type)
+        ])
+        return package
 
-        package, = Package.create([{
+    def _get_default_package_values(self, box_type=None):
+        """
+        Returns the `(values, moves)` pair of the single package holding the
+        whole shipment, for `create_packages`
+        """
+        return ({
             'shipment': '%s,%d' % (self.__name__, self.id),
             'box_type': box_type and box_type.id,
-            'moves': [('add', self.carrier_cost_moves)],
-        }])
-        return package
+        }, self.carrier_cost_moves)
+
+    @classmethod
+    def _overrides_default_package(cls):
+        "Tells if the class creates its default packages by itself"
+        return (
+            cls._create_default_package.__func__ is not
+            ShipmentCarrierMixin._create_default_package.__func__
+        )
+
+    @staticmethod
+    def create_packages(packages):
+        """
+        Creates the packages from the list of their `(values, moves)` pairs
+        in one call, the moves of all the packages are then written at once.
+        """
+        pool = Pool()
+        Package = pool.get('stock.package')
+        Move = pool.get('stock.move')
+
+        records = Package.create([values for values, _ in packages])
+        args = []
+        for package, (_, moves) in zip(records, packages):
+            if moves:
+                args.extend((list(moves), {'package': package.id}))
+        if args:
+            Move.write(*args)
+        return records
+
+    def _get_packing_items(self):
+        """
+        Returns the :class:`packing.Item` of the carrier cost moves, with
+        the dimensions of their products in centimeters and their weights
+        in grams
+        """
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Uom = pool.get('product.uom')
+        Move = pool.get('stock.move')
+
+        centimeter = ModelData.get_id('product', 'uom_centimeter')
+        moves = self.carrier_cost_moves
+        weights = Move.get_canonical_weights(moves, silent=True)
+        items = []
+        for move in moves:
+            template = move.product.template
+            dimensions = tuple(
+                Uom.convert_qty(
+                    getattr(template, name + '_uom'), getattr(template, name),
+                    centimeter, round=False
+                ) or 0
+                for name in ('length', 'width', 'height')
+            )
+            items.append(Item(
+                move, dimensions, move.internal_quantity,
+                weights.get(move.id) or 0
+            ))
+        return items
+
+    def _get_packing_boxes(self):
+        """
+        Returns the :class:`packing.Box` of the box types of the carrier, in
+        centimeters and grams. Box types without all their dimensions are
+        left out.
+        """
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Uom = pool.get('product.uom')
+
+        centimeter = ModelData.get_id('product', 'uom_centimeter')
+        gram = ModelData.get_id('product', 'uom_gram')
+        boxes = []
+        for box_type in self.carrier.box_types:
+            dimensions = (box_type.length, box_type.width, box_type.height)
+            if not all(dimensions):
+                continue
+            max_weight = None
+            if box_type.maximum_weight:
+                max_weight = Uom.convert_qty(
+                    box_type.maximum_weight_uom, box_type.maximum_weight,
+                    gram, round=False
+                )
+            boxes.append(Box(box_type, tuple(
+                Uom.convert_qty(
+                    box_type.distance_unit, d, centimeter, round=False
+                )
+                for d in dimensions
+            ), max_weight))
+        return boxes
+
+    def _is_auto_packed(self):
+        "Tells if the carrier packs the moves into its box types"
+        carrier = self.carrier
+        return bool(
+            carrier and carrier.auto_pack and carrier.box_types and
+            self.carrier_cost_moves
+        )
+
+    def _get_packages(self):
+        """
+        Returns the packages packing the carrier cost moves as a list of
+        `(values, moves)` pairs for `create_packages`.
+
+        When the carrier packs automatically the moves are packed into its
+        box types, see :func:`packing.pack`, moves fitting no box type get a
+        package of their own without box type. Otherwise all the moves go
+        into a single package.
+        """
+        if not self._is_auto_packed():
+            return [self._get_default_package_values()]
+
+        shipment = '%s,%d' % (self.__name__, self.id)
+        bins = pack(self._get_packing_items(), self._get_packing_boxes())
+        return [({
+            'shipment': shipment,
+            'box_type': bin_.box and bin_.box.key.id,
+        }, [item.key for item in bin_.items]) for bin_ in bins]
+
+    def _create_packages(self):
+        "Creates the packages of the shipment, see `_get_packages`"
+        return self.create_packages(self._get_packages())
 
     def get_shipping_rates(self, carriers=None, silent=False):
         """
         Gives a list of rates from carriers provided. If no carriers provided,
         return rates from all the carriers.
 
+        Carriers are rated concurrently when the `rate_workers` option of
+        the `shipping` configuration section is greater than one, see
+        :func:`rating.fan_out_shipping_rates`.
+
         List contains dictionary with following minimum keys:
             [
                 {
@@ -296,13 +551,122 @@ class ShipmentCarrierMixin(PackageMixin):
         Carrier = Pool().get('carrier')
 
         if carriers is None:
-            carriers = Carrier.search([])
+            carriers = Carrier.get_active_carriers()
 
-        rates = []
-        for carrier in carriers:
-            rates.extend(self.get_shipping_rate(carrier=carrier, silent=silent))
+        rates, timed_out = fan_out_shipping_rates(self, carriers, silent)
+        if timed_out and not silent:
+            self.raise_user_error('carrier_rate_timeout', error_args=(
+                ', '.join(c.rec_name for c in timed_out),
+            ))
         return rates
 
+    def iter_shipping_rates(self, carriers=None, silent=False, timeout=None):
+        """
+        Same as `get_shipping_rates` but yields `(carrier, rates)` tuples
+        as each carrier answers, so callers can show the rates of the
+        fastest carriers first. Carriers which did not answer within
+        `timeout` seconds are yielded last with `rating.TIMEOUT` as rates,
+        see :func:`rating.iter_shipping_rates`.
+        """
+        Carrier = Pool().get('carrier')
+
+        if carriers is None:
+            carriers = Carrier.get_active_carriers()
+
+        return iter_shipping_rates(self, carriers, silent, timeout)
+
+    @classmethod
+    def get_shipping_rates_batch(cls, shipments, carriers=None, silent=False):
+        """
+        Rate many shipments in one call and return a dictionary mapping the
+        id of each shipment to its list of rates (same format as
+        `get_shipping_rates`).
+
+        The shipments are browsed together, so the first access to their
+        addresses, packages or weights reads them for the whole batch.
+        Requests are grouped by carrier through
+        `_get_shipping_rates_for_carrier`.
+        """
+        Carrier = Pool().get('carrier')
+
+        if carriers is None:
+            carriers = Carrier.get_active_carriers()
+        shipments = cls.browse(map(int, shipments))
+        carriers = Carrier.browse(map(int, carriers))
+
+        res = dict((shipment.id, []) for shipment in shipments)
+        for carrier in carriers:
+            rates = cls._get_shipping_rates_for_carrier(
+                shipments, carrier, silent=silent
+            )
+            for shipment_id, shipment_rates in rates.iteritems():
+                res[shipment_id].extend(shipment_rates)
+        return res
+
+    @classmethod
+    def _get_shipping_rates_for_carrier(cls, shipments, carrier, silent=False):
+        """
+        Returns a dictionary mapping the id of each shipment to its rates
+        from the carrier.
+
+        Rates the shipments one by one, downstream modules whose carrier
+        offers a multi-shipment endpoint can extend it to rate the whole
+        group in a single request. Carriers using a rate table price the
+        whole group in bulk.
+        """
+        if carrier.use_rate_table:
+            return get_rate_table_rates_bulk(shipments, carrier)
+        return dict(
+            (shipment.id, shipment.quote_shipping_rate(carrier, silent=silent))
+            for shipment in shipments
+        )
+
+    def quote_shipping_rate(self, carrier, carrier_service=None, silent=False):
+        """
+        Same as `get_shipping_rate` but reuses the rates recently quoted for
+        an identical shipment, see :func:`rating.quote_shipping_rate`.
+        """
+        return quote_shipping_rate(self, carrier, carrier_service, silent)
+
+    def _get_rate_fingerprint(self, carrier, carrier_service=None):
+        """
+        Returns a hashable fingerprint of everything the rates of carrier
+        depend on, it is used as key of the rate cache. None disables the
+        cache for the shipment.
+
+        Downstream modules rating on more information should extend it.
+        """
+        if self.id is None or self.id < 0:
+            return None
+
+        # The billable weight follows from the dimensions and weights of the
+        # packages and from the carrier, whose changes clear the cache
+        packages = []
+        for package in self.packages:
+            dimensions = package.box_type or package
+            packages.append((
+                package.box_type and package.box_type.id,
+                dimensions.length, dimensions.width, dimensions.height,
+                dimensions.distance_unit and dimensions.distance_unit.id,
+                package.weight,
+            ))
+
+        return (
+            self.__name__,
+            Transaction().context.get('company'),
+            carrier.id,
+            carrier_service and carrier_service.id,
+            address_fingerprint(self._get_ship_from_address(silent=True)),
+            address_fingerprint(self._get_ship_to_address()),
+            self.weight_uom.id,
+            self.weight,
+            tuple(sorted(packages)),
+            tuple(sorted(
+                (move.product.id, move.quantity, move.uom.id)
+                for move in self.carrier_cost_moves
+            )),
+        )
+
     def get_shipping_rate(self, carrier, carrier_service=None, silent=False):
         """
         Gives a list of rates from provided carrier and carrier service.
@@ -320,6 +684,16 @@ class ShipmentCarrierMixin(PackageMixin):
         """
         Company = Pool().get('company.company')
 
+        if carrier.use_rate_table:
+            return get_rate_table_rates(self, carrier, carrier_service)
+
+        adapter = get_rate_adapter(carrier)
+        if adapter:
+            return adapter.run(
+                'rate', self, carrier, carrier_service,
+                timeout=get_rate_timeout()
+            )
+
         if carrier.carrier_cost_method == 'product':
             currency = Company(Transaction().context['company']).currency
             rate_dict = {
@@ -346,6 +720,14 @@ class ShipmentCarrierMixin(PackageMixin):
                 'carrier': carrier active record,
             }
         """
+        for name, value in self._get_shipping_rate_values(rate).iteritems():
+            setattr(self, name, value)
+        self.save()
+
+    def _get_shipping_rate_values(self, rate):
+        """
+        Returns the values applying the rate sets on the shipment
+        """
         Currency = Pool().get('currency.currency')
 
         shipment_cost = rate['cost_currency'].round(rate['cost'])
@@ -354,21 +736,259 @@ class ShipmentCarrierMixin(PackageMixin):
                 rate['cost_currency'], shipment_cost, self.cost_currency
             )
 
-        self.cost = shipment_cost
-        self.cost_currency = rate['cost_currency']
-        self.carrier = rate['carrier']
-        self.carrier_service = rate['carrier_service']
-        self.save()
+        return {
+            'cost': shipment_cost,
+            'cost_currency': rate['cost_currency'],
+            'carrier': rate['carrier'],
+            'carrier_service': rate['carrier_service'],
+        }
+
+    @classmethod
+    def apply_shipping_rates(cls, shipment_rates):
+        """
+        Applies many rates at once, `shipment_rates` is a list of
+        `(shipment, rate)` tuples. Shipments sharing the same values are
+        written together in a single call.
+        """
+        groups = {}
+        for shipment, rate in shipment_rates:
+            values = dict(
+                (name, int(value) if isinstance(value, Model) else value)
+                for name, value in
+                shipment._get_shipping_rate_values(rate).iteritems()
+            )
+            groups.setdefault(
+                tuple(sorted(values.items())), []
+            ).append(shipment)
+
+        args = []
+        for values, shipments in groups.iteritems():
+            args.extend([shipments, dict(values)])
+        if args:
+            cls.write(*args)
+
+    @classmethod
+    def apply_shipping_rates_by_policy(
+            cls, shipments, policy='cheapest', carriers=None, **options):
+        """
+        Rates the shipments in bulk, picks a rate for each of them following
+        the policy and applies the picked rates in bulk. Returns a
+        dictionary mapping the id of each shipment to its picked rate, None
+        when no rate matched the policy.
+
+        A policy is a `_pick_rate_<policy>` class method, available ones
+        are:
+
+        * `cheapest`
+        * `fastest`: earliest delivery date, costing at most the optional
+          `max_cost` option
+        * `preferred`: rates of the `preferred_carrier` option, unless they
+          cost more than `tolerance` percent above the cheapest rate
+        """
+        Company = Pool().get('company.company')
+
+        pick_rate = getattr(cls, '_pick_rate_%s' % policy, None)
+        if pick_rate is None:
+            cls.raise_user_error('unknown_rate_policy', error_args=(policy,))
+
+        currency = Company(Transaction().context['company']).currency
+        shipments = cls.browse(map(int, shipments))
+        rates = cls.get_shipping_rates_batch(shipments, carriers, silent=True)
+
+        res, shipment_rates = {}, []
+        for shipment in shipments:
+            rate = res[shipment.id] = pick_rate(
+                rates[shipment.id], currency, **options
+            )
+            if rate is not None:
+                shipment_rates.append((shipment, rate))
+        cls.apply_shipping_rates(shipment_rates)
+        return res
+
+    @staticmethod
+    def _get_rate_cost(rate, currency):
+        "Returns the cost of the rate in the currency"
+        Currency = Pool().get('currency.currency')
+
+        if rate['cost_currency'] == currency:
+            return rate['cost']
+        return Currency.compute(rate['cost_currency'], rate['cost'], currency)
+
+    @classmethod
+    def _pick_rate_cheapest(cls, rates, currency, **options):
+        if not rates:
+            return None
+        return min(rates, key=lambda rate: cls._get_rate_cost(rate, currency))
+
+    @classmethod
+    def _pick_rate_fastest(cls, rates, currency, max_cost=None, **options):
+        if max_cost is not None:
+            rates = [
+                rate for rate in rates
+                if cls._get_rate_cost(rate, currency) <= max_cost
+            ]
+        if not rates:
+            return None
+        # Rates without a delivery date are the slowest
+        return min(rates, key=lambda rate: (
+            rate.get('delivery_date') or datetime.date.max,
+            rate.get('delivery_time') or datetime.time.max,
+            cls._get_rate_cost(rate, currency),
+        ))
+
+    @classmethod
+    def _pick_rate_preferred(
+            cls, rates, currency, preferred_carrier=None, tolerance=0,
+            **options):
+        cheapest = cls._pick_rate_cheapest(rates, currency)
+        preferred = cls._pick_rate_cheapest([
+            rate for rate in rates
+            if preferred_carrier and
+            rate['carrier'].id == int(preferred_carrier)
+        ], currency)
+        if preferred is None:
+            return cheapest
+        limit = cls._get_rate_cost(cheapest, currency) * (
+            1 + Decimal(str(tolerance)) / 100
+        )
+        if cls._get_rate_cost(preferred, currency) <= limit:
+            return preferred
+        return cheapest
 
     def generate_shipping_labels(self, **kwargs):
         """
         Generates shipment label for shipment and saves labels,
         tracking numbers.
+
+        Carriers driven by an adapter generate them through the
+        `label` operation of the adapter.
         """
+        adapter = self.carrier and get_adapter(
+            self.carrier.carrier_cost_method, 'label'
+        )
+        if adapter:
+            return adapter.run('label', self)
         self.raise_user_error(
             "Shipping label generation feature is not available"
         )
 
+    @classmethod
+    def generate_shipping_labels_batch(cls, shipments):
+        """
+        Generates the labels of many shipments and returns a dictionary
+        mapping the id of each shipment to the message of the error which
+        prevented it, None when its labels were generated. A shipment
+        failing does not stop the others.
+
+        Carriers driven by an adapter get all their label requests
+        at once, see :func:`adapter.iter_run`. The labels of the other
+        carriers are generated by a pool of `label_workers` threads, each
+        shipment from its own transaction committed once its labels exist,
+        so the writes of a failed shipment are rolled back alone.
+
+        The tracking numbers and costs set on the shipments generated in
+        the transaction of the caller are then saved together.
+        """
+        errors, shipments = {}, list(shipments)
+        adapted, threaded = {}, []
+        for shipment in shipments:
+            try:
+                shipment.allow_label_generation()
+            except UserError as exc:
+                errors[shipment.id] = exc.message
+                continue
+            method = shipment.carrier and \
+                shipment.carrier.carrier_cost_method
+            if get_adapter(method, 'label'):
+                adapted.setdefault(method, []).append(shipment)
+            else:
+                threaded.append(shipment)
+
+        # The adapted labels are in flight while the others are generated
+        results = [
+            cls._send_adapted_labels(get_adapter(m, 'label'), s)
+            for m, s in adapted.iteritems()
+        ]
+        results.insert(0, cls._iter_threaded_labels(threaded))
+
+        generated = []
+        for result in results:
+            for shipment, error in result:
+                if error is None:
+                    generated.append(shipment)
+                else:
+                    errors[shipment.id] = _get_error_message(error)
+                    logger.warning(
+                        'Failed to generate the labels of shipment %s: %s',
+                        shipment.rec_name, error
+                    )
+                logger.info(
+                    'Generated the labels of %d shipments of %d, %d failed',
+                    len(generated), len(shipments), len(errors)
+                )
+        cls.save(generated)
+        return dict((s.id, errors.get(s.id)) for s in shipments)
+
+    @staticmethod
+    def _send_adapted_labels(adapter, shipments):
+        """
+        Sends the label requests of the shipments through the adapter and
+        returns an iterator of `(shipment, error)` as they are answered
+        """
+        run = iter_run(
+            adapter, 'label', [(shipment,) for shipment in shipments],
+            throttle=lambda shipment: shipment.carrier.get_throttle()
+        )
+        return ((shipment, error) for (shipment,), _, error in run)
+
+    @classmethod
+    def _generate_labels(cls, database_name, user, context, shipment_id):
+        """
+        Generates the labels of the shipment within the carrier budget from
+        a transaction of its own, committed unless it fails
+        """
+        with Transaction().start(database_name, user, context=context):
+            shipment = cls(shipment_id)
+            if shipment.carrier:
+                shipment.carrier.throttle()
+            shipment.generate_shipping_labels()
+            shipment.save()
+
+    @classmethod
+    def _iter_threaded_labels(cls, shipments):
+        """
+        Generates the labels of the shipments from the pool of label
+        workers and yields `(shipment, error)` as they are generated
+        """
+        transaction = Transaction()
+        if not _can_generate_apart():
+            for shipment in shipments:
+                try:
+                    if shipment.carrier:
+                        shipment.carrier.throttle()
+                    shipment.generate_shipping_labels()
+                except Exception as exc:
+                    yield shipment, exc
+                else:
+                    yield shipment, None
+            return
+
+        database_name = transaction.database.name
+        user = transaction.user
+        context = transaction.context.copy()
+
+        def generate(shipment):
+            try:
+                cls._generate_labels(
+                    database_name, user, context, shipment.id
+                )
+            except Exception as exc:
+                return exc
+
+        for shipment, error in imap_unordered(
+                generate, shipments, max(get_label_workers(), 1)):
+            yield shipment, error
+
     @staticmethod
     def default_cost_currency():
         Company = Pool().get('company.company')
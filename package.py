@@ -3,9 +3,15 @@
     package.py
 
 """
+from sql import For, Literal, Cast, Null
+from sql.aggregate import Min
+from sql.functions import Position, Substring
+
+from trytond import backend
 from trytond.model import fields
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval, Or, Bool, Id
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 
 __metaclass__ = PoolMeta
@@ -25,7 +31,7 @@ class Package:
             "Weight", digits=(16, Eval('weight_digits', 2)),
             depends=['weight_digits'],
         ),
-        'get_weight'
+        'get_weights'
     )
     weight_uom = fields.Function(
         fields.Many2One('product.uom', 'Weight UOM'),
@@ -35,12 +41,12 @@ class Package:
         fields.Integer('Weight Digits'), 'on_change_with_weight_digits'
     )
 
-    computed_weight = fields.Function(
-        fields.Float(
-            "Computed Weight", digits=(16, Eval('weight_digits', 2)),
-            depends=['weight_digits'],
-        ),
-        'get_computed_weight'
+    #: Sum of the weights of the moves in the weight uom, kept up to date
+    #: by `update_computed_weight` as the moves and products change. Empty
+    #: for the packages created before it was stored.
+    computed_weight = fields.Float(
+        "Computed Weight", digits=(16, Eval('weight_digits', 2)),
+        depends=['weight_digits'], readonly=True,
     )
 
     override_weight = fields.Float(
@@ -56,6 +62,25 @@ class Package:
         }, depends=['override_weight']
     )
 
+    #: Weight the carrier of the shipment bills for the volume of the
+    #: package, see `carrier.get_dimensional_weight`.
+    dimensional_weight = fields.Function(
+        fields.Float(
+            "Dimensional Weight", digits=(16, Eval('weight_digits', 2)),
+            depends=['weight_digits'],
+        ),
+        'get_billable_weight'
+    )
+
+    #: Larger of the weight and the dimensional weight.
+    billable_weight = fields.Function(
+        fields.Float(
+            "Billable Weight", digits=(16, Eval('weight_digits', 2)),
+            depends=['weight_digits'],
+        ),
+        'get_billable_weight'
+    )
+
     available_box_types = fields.Function(
         fields.One2Many("carrier.box_type", None, "Available Box Types"),
         getter="on_change_with_available_box_types"
@@ -88,6 +113,28 @@ class Package:
         ], depends=['length', 'width', 'height']
     )
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        table = TableHandler(cls, module_name)
+        created = not table.column_exist('computed_weight')
+
+        super(Package, cls).__register__(module_name)
+
+        # Migration: computed weight is stored, existing packages are
+        # computed when read
+        if created:
+            table = cls.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*table.update(
+                [table.computed_weight], [Null]
+            ))
+
+    @staticmethod
+    def default_computed_weight():
+        return 0
+
     @fields.depends('shipment')
     def on_change_with_available_box_types(self, name=None):
         Carrier = Pool().get('carrier')
@@ -106,30 +153,48 @@ class Package:
         "Downstream modules can use this method to process label image"
         return data
 
-    def get_tracking_number(self, name):
+    @classmethod
+    def get_tracking_number(cls, packages, name):
         """
-        Return first tracking number for this package
+        Return first tracking number for each package, read with one query
+        per slice of packages
         """
         Tracking = Pool().get('shipment.tracking')
 
-        tracking_numbers = Tracking.search([
-            ('origin', '=', '%s,%s' % (self.__name__, self.id)),
-            ('state', '!=', 'cancelled'),
-        ], limit=1)
+        tracking = Tracking.__table__()
+        cursor = Transaction().connection.cursor()
 
-        return tracking_numbers and tracking_numbers[0].id or None
+        res = dict.fromkeys(map(int, packages))
+        for sub_packages in grouped_slice(packages):
+            cursor.execute(*tracking.select(
+                tracking.origin, Min(tracking.id),
+                where=tracking.origin.in_([
+                    '%s,%d' % (cls.__name__, p.id) for p in sub_packages
+                ]) & (tracking.state != 'cancelled'),
+                group_by=tracking.origin
+            ))
+            for origin, tracking_id in cursor.fetchall():
+                res[int(origin.split(',')[1])] = tracking_id
+        return res
 
     @classmethod
     def search_tracking_number(cls, name, clause):
         Tracking = Pool().get('shipment.tracking')
 
-        tracking_numbers = Tracking.search([
-            ('origin', 'like', 'stock.package,%'),
+        tracking = Tracking.__table__()
+        query = Tracking.search([
+            ('origin', 'like', cls.__name__ + ',%'),
             ('tracking_number', ) + tuple(clause[1:])
-        ])
-        return [
-            ('id', 'in', map(lambda x: x.origin.id, tracking_numbers))
-        ]
+        ], order=[], query=True)
+        return [('id', 'in', tracking.select(
+            Cast(
+                Substring(
+                    tracking.origin, Position(',', tracking.origin) + Literal(1)
+                ),
+                cls.id.sql_type().base
+            ),
+            where=tracking.id.in_(query)
+        ))]
 
     @fields.depends('weight_uom')
     def on_change_with_weight_digits(self, name=None):
@@ -143,28 +208,158 @@ class Package:
         """
         return self.shipment.weight_uom.id
 
-    def get_weight(self, name):
+    def get_weight(self, name=None):
         """
         Returns package weight if weight is not overriden
-        otherwise returns overriden weight
+        otherwise returns overriden weight, see `get_weights`
+        """
+        return self.get_weights([self], name)[self.id]
+
+    def get_computed_weight(self, name=None):
+        """
+        Returns sum of weight associated with each move line, see
+        `compute_weight`
+        """
+        return self.compute_weight([self])[self.id]
+
+    @classmethod
+    def get_weights(cls, packages, name=None):
+        """
+        Returns a dictionary with the weight of each package, its override
+        weight if any. The weights of the packages stored before their
+        computed weight are computed together.
         """
         UOM = Pool().get('product.uom')
-        if self.override_weight:
-            return UOM.compute_qty(
-                self.override_weight_uom,
-                self.override_weight,
-                self.weight_uom
+
+        computed = cls.compute_weight([
+            p for p in packages if p.computed_weight is None and p.shipment
+        ])
+        res = {}
+        for package in packages:
+            if package.override_weight:
+                res[package.id] = UOM.convert_qty(
+                    package.override_weight_uom,
+                    package.override_weight,
+                    package.weight_uom
+                )
+            else:
+                res[package.id] = computed.get(
+                    package.id, package.computed_weight
+                ) or 0
+        return res
+
+    @classmethod
+    def get_dimensional_weights(cls, packages, carrier=None):
+        """
+        Returns a dictionary with the dimensional weight of each package in
+        its weight uom, as billed by `carrier` or by the carrier of its
+        shipment. The dimensions are those of the box type of the package
+        if any.
+        """
+        res = {}
+        for package in packages:
+            res[package.id] = None
+            package_carrier = carrier or (
+                package.shipment and package.shipment.carrier
             )
-        return self.get_computed_weight()
+            if not package.shipment or not package_carrier:
+                continue
+            dimensions = package.box_type or package
+            res[package.id] = package_carrier.get_dimensional_weight(
+                (dimensions.length, dimensions.width, dimensions.height),
+                dimensions.distance_unit, package.weight_uom
+            )
+        return res
 
-    def get_computed_weight(self, name=None):
+    @classmethod
+    def get_billable_weights(cls, packages, carrier=None):
         """
-        Returns sum of weight associated with each move line
+        Returns a dictionary with the weight billed for each package by
+        `carrier` or by the carrier of its shipment: the larger of its
+        weight and dimensional weight
         """
-        return sum(map(
-            lambda move: move.get_weight(self.weight_uom, silent=True),
-            self.moves
-        ))
+        weights = cls.get_weights(packages)
+        dimensional_weights = cls.get_dimensional_weights(packages, carrier)
+        return dict(
+            (package.id, max(
+                weights[package.id], dimensional_weights[package.id] or 0
+            ))
+            for package in packages
+        )
+
+    @classmethod
+    def get_billable_weight(cls, packages, names):
+        res = {}
+        if 'dimensional_weight' in names:
+            res['dimensional_weight'] = cls.get_dimensional_weights(packages)
+        if 'billable_weight' in names:
+            res['billable_weight'] = cls.get_billable_weights(packages)
+        return res
+
+    @classmethod
+    def compute_weight(cls, packages):
+        """
+        Returns sum of weight associated with each move line, the weights
+        of the moves of all the packages are computed together
+        """
+        Move = Pool().get('stock.move')
+
+        by_uom = {}
+        for package in packages:
+            by_uom.setdefault(package.weight_uom, []).append(package)
+
+        res = {}
+        for weight_uom, uom_packages in by_uom.iteritems():
+            weights = Move.sum_weights(
+                [p.moves for p in uom_packages], weight_uom, silent=True
+            )
+            res.update(zip(map(int, uom_packages), weights))
+        return res
+
+    @classmethod
+    def update_computed_weight(cls, packages):
+        """
+        Stores the computed weight of the packages again. Their rows are
+        locked first, so concurrent transactions changing the moves of the
+        same packages update them one after the other.
+
+        Packages of done or cancelled shipments keep the weight they were
+        shipped with.
+        """
+        ids = [p.id for p in packages if p.id is not None and p.id >= 0]
+        if not ids:
+            return
+        # The moves of done or cancelled shipments are done or cancelled
+        packages = cls.search([
+            ('id', 'in', ids),
+            ('shipment', '!=', None),
+            ['OR', [
+                ('moves', '=', None),
+            ], [
+                ('moves.state', 'not in', ['done', 'cancel']),
+            ]],
+        ])
+        if not packages:
+            return
+
+        if backend.name() == 'postgresql':
+            table = cls.__table__()
+            cursor = Transaction().connection.cursor()
+            for sub_ids in grouped_slice(map(int, packages)):
+                cursor.execute(*table.select(
+                    table.id, where=reduce_ids(table.id, sub_ids),
+                    for_=For('UPDATE')
+                ))
+
+        weights = cls.compute_weight(packages)
+        to_write = []
+        for package in packages:
+            if package.computed_weight != weights[package.id]:
+                to_write.extend(
+                    ([package], {'computed_weight': weights[package.id]})
+                )
+        if to_write:
+            cls.write(*to_write)
 
     @staticmethod
     def default_type():
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+    packing.py
+
+    Packing of items into boxes with a first-fit decreasing heuristic.
+"""
+from collections import namedtuple
+
+__all__ = ['Item', 'Box', 'Bin', 'pack']
+
+#: An item to pack: `quantity` units of `dimensions`, a tuple of three
+#: lengths (all zero when unknown), weighing `weight` all together. Units
+#: are rotated as needed but the units of an item are never split.
+Item = namedtuple('Item', ['key', 'dimensions', 'quantity', 'weight'])
+
+#: A type of box: `max_weight` is None when the box takes any weight.
+Box = namedtuple('Box', ['key', 'dimensions', 'max_weight'])
+
+
+def _volume(dimensions):
+    length, width, height = dimensions
+    return length * width * height
+
+
+def _item_volume(item):
+    return _volume(item.dimensions) * item.quantity
+
+
+def _fits(item, box):
+    "Tells if a unit of the item fits in the empty box, rotating it as needed"
+    return all(
+        i <= b for i, b in zip(
+            sorted(item.dimensions, reverse=True),
+            sorted(box.dimensions, reverse=True)
+        )
+    )
+
+
+class Bin(object):
+    "A box being filled"
+    __slots__ = ('box', 'items', 'volume', 'weight')
+
+    def __init__(self, box):
+        self.box = box
+        self.items = []
+        self.volume = 0
+        self.weight = 0
+
+    def holds(self, volume, weight):
+        "Tells if the box takes the volume and weight on top of its items"
+        return (
+            self.volume + volume <= _volume(self.box.dimensions) and (
+                self.box.max_weight is None or
+                self.weight + weight <= self.box.max_weight
+            )
+        )
+
+    def add(self, item, volume):
+        self.items.append(item)
+        self.volume += volume
+        self.weight += item.weight
+
+
+def pack(items, boxes):
+    """
+    Packs the items into boxes and returns the list of the filled `Bin`.
+
+    Items are taken by decreasing volume, then weight, and go into the first
+    open bin they fit in: the item fits the box and the volumes and weights
+    of the items of the bin stay within those of the box. Otherwise a bin
+    is opened with the largest box fitting the item. Once all the items are
+    packed each bin is moved to the smallest box holding its items.
+
+    Items which fit no box are packed alone in a bin without box (`box` is
+    None). Placing items by volume ignores the gaps left between them, the
+    boxes are assumed to be filled by items which are small compared to
+    them or of similar shapes.
+    """
+    boxes = sorted(boxes, key=lambda b: _volume(b.dimensions), reverse=True)
+    items = sorted(
+        items, key=lambda i: (_item_volume(i), i.weight), reverse=True
+    )
+
+    bins, loose = [], []
+    for item in items:
+        volume = _item_volume(item)
+        for bin_ in bins:
+            if _fits(item, bin_.box) and bin_.holds(volume, item.weight):
+                bin_.add(item, volume)
+                break
+        else:
+            for box in boxes:
+                if _fits(item, box) and Bin(box).holds(volume, item.weight):
+                    bin_ = Bin(box)
+                    break
+            else:
+                bin_ = Bin(None)
+            bin_.add(item, volume)
+            (bins if bin_.box is not None else loose).append(bin_)
+
+    for bin_ in bins:
+        for box in reversed(boxes):
+            if all(_fits(i, box) for i in bin_.items) and \
+                    Bin(box).holds(bin_.volume, bin_.weight):
+                bin_.box = box
+                break
+    return bins + loose
@@ -9,6 +9,8 @@ from trytond.pyson import Eval, Bool
 from trytond.model import ModelView, fields
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 
+from .adapter import get_adapter
+
 __all__ = [
     'Address', 'AddressValidationMsg', 'AddressValidationWizard',
     'AddressValidationSuggestionView'
@@ -100,6 +102,9 @@ class Address:
         A good example can be found in the UPS module's implementation of this
         in
         :ref:`address class <trytond-ups:party.Address._ups_address_validate>`.
+
+        Carriers driven by an adapter validate through the `validate`
+        operation of the adapter instead, see :class:`adapter.CarrierAdapter`.
         """
         CarrierConfig = Pool().get('party.configuration')
 
@@ -112,6 +117,11 @@ class Address:
                 "Validation Carrier is not selected in carrier configuration."
             )
 
+        carrier.throttle()
+        adapter = get_adapter(carrier.carrier_cost_method, 'validate')
+        if adapter:
+            return adapter.run('validate', self)
+
         return getattr(
             self, '_{0}_address_validate'.format(carrier.carrier_cost_method)
         )()  # pragma: no cover
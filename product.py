@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+    product.py
+
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.model import fields
+from trytond.pool import PoolMeta, Pool
+from trytond.transaction import Transaction
+
+__metaclass__ = PoolMeta
+__all__ = ['Template', 'Product', 'Uom']
+
+
+class Template:
+    __name__ = 'product.template'
+
+    @classmethod
+    def _get_package_weight_fields(cls):
+        """
+        Fields of the template whose change changes the weight of products
+        and packages
+        """
+        return {'weight', 'weight_uom', 'default_uom'}
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Product = pool.get('product.product')
+        Package = pool.get('stock.package')
+
+        weight_fields = cls._get_package_weight_fields()
+        actions = iter(args)
+        changed = []
+        for templates, values in zip(actions, actions):
+            if weight_fields & set(values):
+                changed.extend(templates)
+        super(Template, cls).write(*args)
+        if not changed:
+            return
+        # Inactive products keep their weight and are in packages too
+        with Transaction().set_context(active_test=False):
+            Product.update_canonical_weight(Product.search([
+                ('template', 'in', map(int, changed)),
+            ]))
+            Package.update_computed_weight(Package.search([
+                ('moves.product.template', 'in', map(int, changed)),
+                ('moves.state', 'not in', ['done', 'cancel']),
+            ]))
+
+
+class Product:
+    __name__ = 'product.product'
+
+    #: Weight of one default uom of the product in grams, kept up to date
+    #: by `update_canonical_weight`. Empty when the product has no weight.
+    canonical_weight = fields.Float(
+        'Canonical Weight', readonly=True, select=True
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        table = TableHandler(cls, module_name)
+        created = not table.column_exist('canonical_weight')
+
+        super(Product, cls).__register__(module_name)
+
+        # Migration: canonical weight is stored, the factor of a weight uom
+        # is its weight in kilograms
+        Template = Pool().get('product.template')
+        if created and TableHandler(Template).column_exist('weight'):
+            Uom = Pool().get('product.uom')
+            product = cls.__table__()
+            template = Template.__table__()
+            uom = Uom.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*product.update(
+                [product.canonical_weight],
+                [template.join(
+                    uom, condition=template.weight_uom == uom.id
+                ).select(
+                    template.weight * uom.factor * 1000,
+                    where=(template.id == product.template) &
+                    (template.weight != 0)
+                )]
+            ))
+
+    def compute_canonical_weight(self):
+        "Returns the weight of one default uom of the product in grams"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Uom = pool.get('product.uom')
+
+        if not self.weight or not self.weight_uom:
+            return None
+        return Uom.convert_qty(
+            self.weight_uom, self.weight,
+            ModelData.get_id('product', 'uom_gram'), round=False
+        )
+
+    @classmethod
+    def update_canonical_weight(cls, products):
+        "Stores the canonical weight of the products again"
+        to_write = []
+        for product in products:
+            weight = product.compute_canonical_weight()
+            if weight != product.canonical_weight:
+                to_write.extend(([product], {'canonical_weight': weight}))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def create(cls, vlist):
+        products = super(Product, cls).create(vlist)
+        cls.update_canonical_weight(products)
+        return products
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        changed = []
+        for products, values in zip(actions, actions):
+            if 'template' in values:
+                changed.extend(products)
+        super(Product, cls).write(*args)
+        cls.update_canonical_weight(cls.browse(changed))
+
+
+def _round_array(numbers, precision):
+    "Same as `product.uom.round` for each number of a NumPy array"
+    i, d = divmod(precision, 1)
+    numbers = numbers / precision
+    # Python 2 rounds half away from zero where NumPy rounds half to even
+    absolute = numpy.abs(numbers)
+    base = numpy.floor(absolute)
+    base = numpy.copysign(base + (absolute - base >= 0.5), numbers)
+    return (base * i) + ((base / (1 / d)) if d != 0 else 0)
+
+
+class Uom:
+    __name__ = 'product.uom'
+
+    #: Conversion steps by pair of uom ids, see `_get_conversion`.
+    _conversions = Cache('product.uom.conversion', context=False)
+
+    @classmethod
+    def create(cls, vlist):
+        uoms = super(Uom, cls).create(vlist)
+        cls._conversions.clear()
+        return uoms
+
+    @classmethod
+    def write(cls, *args):
+        super(Uom, cls).write(*args)
+        cls._conversions.clear()
+
+    @classmethod
+    def delete(cls, uoms):
+        super(Uom, cls).delete(uoms)
+        cls._conversions.clear()
+
+    @classmethod
+    def _get_conversion(cls, from_uom, to_uom):
+        """
+        Returns the steps `compute_qty` takes to convert from `from_uom` to
+        `to_uom`: a tuple `(multiply, from_value, divide, to_value,
+        rounding)`, None when the uoms are of different categories.
+        """
+        key = (int(from_uom), int(to_uom))
+        conversion = cls._conversions.get(key, -1)
+        if conversion != -1:
+            return conversion
+
+        from_uom, to_uom = cls.browse(key)
+        if from_uom.category != to_uom.category:
+            conversion = None
+        else:
+            from_field = from_uom.accurate_field
+            to_field = to_uom.accurate_field
+            conversion = (
+                from_field == 'factor', getattr(from_uom, from_field),
+                to_field == 'factor', getattr(to_uom, to_field),
+                to_uom.rounding,
+            )
+        cls._conversions.set(key, conversion)
+        return conversion
+
+    @classmethod
+    def convert_qty(cls, from_uom, qty, to_uom, round=True):
+        """
+        Same as `compute_qty` but the steps of the conversion of each pair
+        of uoms are cached, so converting many quantities between the same
+        uoms does not read and compare the uoms each time. The uoms may be
+        given as records or ids.
+        """
+        if not qty or (from_uom is None and to_uom is None):
+            return qty
+        if from_uom is None or to_uom is None:
+            return cls.compute_qty(from_uom, qty, to_uom, round=round)
+
+        conversion = cls._get_conversion(from_uom, to_uom)
+        if conversion is None:
+            return cls.compute_qty(
+                cls(int(from_uom)), qty, cls(int(to_uom)), round=round
+            )
+        multiply, from_value, divide, to_value, rounding = conversion
+
+        amount = qty * from_value if multiply else qty / from_value
+        amount = amount / to_value if divide else amount * to_value
+        if round:
+            amount = cls(rounding=rounding).round(amount)
+        return amount
+
+    @classmethod
+    def convert_qty_array(cls, from_uom, quantities, to_uom, round=True):
+        """
+        Same as `convert_qty` for each quantity of a NumPy array, it
+        requires NumPy.
+        """
+        conversion = cls._get_conversion(from_uom, to_uom)
+        if conversion is None:
+            from_uom, to_uom = cls.browse([int(from_uom), int(to_uom)])
+            raise ValueError('cannot convert between %s and %s' % (
+                from_uom.category.name, to_uom.category.name
+            ))
+        multiply, from_value, divide, to_value, rounding = conversion
+
+        amounts = quantities * from_value if multiply \
+            else quantities / from_value
+        amounts = amounts / to_value if divide else amounts * to_value
+        if round:
+            amounts = _round_array(amounts, rounding)
+        return amounts
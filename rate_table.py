@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+    rate_table.py
+
+"""
+from bisect import bisect_left
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.pyson import Eval, Id
+
+__all__ = [
+    'CarrierZone', 'CarrierZoneLine', 'CarrierWeightBreak', 'RateTable',
+    'get_rate_table_rates', 'get_rate_table_rates_bulk',
+]
+
+
+class CarrierZone(ModelSQL, ModelView):
+    "Carrier Zone"
+    __name__ = 'carrier.zone'
+
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, select=True, ondelete='CASCADE'
+    )
+    name = fields.Char('Name', required=True)
+
+    #: Countries, subdivisions and zip code prefixes forming the zone.
+    lines = fields.One2Many('carrier.zone.line', 'zone', 'Lines')
+
+    @classmethod
+    def create(cls, vlist):
+        zones = super(CarrierZone, cls).create(vlist)
+        Pool().get('carrier').clear_caches()
+        return zones
+
+    @classmethod
+    def write(cls, *args):
+        super(CarrierZone, cls).write(*args)
+        Pool().get('carrier').clear_caches()
+
+    @classmethod
+    def delete(cls, zones):
+        super(CarrierZone, cls).delete(zones)
+        Pool().get('carrier').clear_caches()
+
+
+class CarrierZoneLine(ModelSQL, ModelView):
+    "Carrier Zone Line"
+    __name__ = 'carrier.zone.line'
+
+    zone = fields.Many2One(
+        'carrier.zone', 'Zone', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    country = fields.Many2One('country.country', 'Country', required=True)
+    subdivision = fields.Many2One(
+        'country.subdivision', 'Subdivision', domain=[
+            ('country', '=', Eval('country')),
+        ], depends=['country']
+    )
+    zip_prefix = fields.Char(
+        'Zip Prefix', help='Matches the zip codes starting with this prefix'
+    )
+
+    @classmethod
+    def create(cls, vlist):
+        lines = super(CarrierZoneLine, cls).create(vlist)
+        Pool().get('carrier').clear_caches()
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        super(CarrierZoneLine, cls).write(*args)
+        Pool().get('carrier').clear_caches()
+
+    @classmethod
+    def delete(cls, lines):
+        super(CarrierZoneLine, cls).delete(lines)
+        Pool().get('carrier').clear_caches()
+
+
+class CarrierWeightBreak(ModelSQL, ModelView):
+    "Carrier Weight Break"
+    __name__ = 'carrier.weight_break'
+
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, select=True, ondelete='CASCADE'
+    )
+    zone = fields.Many2One(
+        'carrier.zone', 'Zone', required=True, select=True,
+        ondelete='CASCADE', domain=[
+            ('carrier', '=', Eval('carrier')),
+        ], depends=['carrier']
+    )
+
+    #: Service the price applies to, a break without service applies to
+    #: all the services of the carrier.
+    service = fields.Many2One('carrier.service', 'Service')
+
+    #: Heaviest weight priced by the break.
+    weight = fields.Float(
+        'Weight', required=True,
+        help='Shipments up to this weight are charged the price of the break'
+    )
+    weight_uom = fields.Many2One(
+        'product.uom', 'Weight UOM', required=True, domain=[
+            ('category', '=', Id('product', 'uom_cat_weight'))
+        ]
+    )
+    price = fields.Numeric(
+        'Price', required=True, digits=(16, Eval('currency_digits', 2)),
+        depends=['currency_digits']
+    )
+    currency = fields.Many2One('currency.currency', 'Currency', required=True)
+    currency_digits = fields.Function(
+        fields.Integer('Currency Digits'), 'on_change_with_currency_digits'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(CarrierWeightBreak, cls).__setup__()
+        cls._order.insert(0, ('weight', 'ASC'))
+
+    @staticmethod
+    def default_weight_uom():
+        ModelData = Pool().get('ir.model.data')
+        return ModelData.get_id('product', 'uom_pound')
+
+    @fields.depends('currency')
+    def on_change_with_currency_digits(self, name=None):
+        if self.currency:
+            return self.currency.digits
+        return 2
+
+    @classmethod
+    def create(cls, vlist):
+        breaks = super(CarrierWeightBreak, cls).create(vlist)
+        Pool().get('carrier').clear_caches()
+        return breaks
+
+    @classmethod
+    def write(cls, *args):
+        super(CarrierWeightBreak, cls).write(*args)
+        Pool().get('carrier').clear_caches()
+
+    @classmethod
+    def delete(cls, breaks):
+        super(CarrierWeightBreak, cls).delete(breaks)
+        Pool().get('carrier').clear_caches()
+
+
+def _search_sorted(sorted_values, values):
+    "Returns the `bisect_left` index of each value in the sorted values"
+    if numpy is not None:
+        return numpy.searchsorted(
+            numpy.asarray(sorted_values), numpy.asarray(values), side='left'
+        ).tolist()
+    return [bisect_left(sorted_values, value) for value in values]
+
+
+def _normalize_zip(zip_code):
+    return (zip_code or '').replace(' ', '').upper()
+
+
+class RateTable(object):
+    """
+    In-memory index of the zones and weight breaks of a carrier.
+
+    Zones are found by walking a trie of the zip prefixes of the country,
+    falling back to the subdivision and then to the country itself. Prices
+    are found by bisecting the sorted weights of the breaks of the zone and
+    service. Weights are in the canonical kilogram unit and prices include
+    the surcharge of the carrier.
+    """
+
+    def __init__(self):
+        self._zip_tries = {}
+        self._subdivisions = {}
+        self._countries = {}
+        self._breaks = {}
+
+    def add_zone_line(self, zone, country, subdivision=None, zip_prefix=None):
+        zip_prefix = _normalize_zip(zip_prefix)
+        if zip_prefix:
+            node = self._zip_tries.setdefault(country, {})
+            for char in zip_prefix:
+                node = node.setdefault(char, {})
+            node[None] = zone
+        elif subdivision:
+            self._subdivisions[subdivision] = zone
+        else:
+            self._countries[country] = zone
+
+    def add_break(self, zone, service, weight, price, currency):
+        weights, prices = self._breaks.setdefault((zone, service), ([], []))
+        index = bisect_left(weights, weight)
+        weights.insert(index, weight)
+        prices.insert(index, (price, currency))
+
+    def find_zone(self, country, subdivision=None, zip_code=None):
+        "Returns the zone of the address parts, None if there is no zone"
+        zone = None
+        node = self._zip_tries.get(country)
+        if node is not None:
+            for char in _normalize_zip(zip_code):
+                node = node.get(char)
+                if node is None:
+                    break
+                zone = node.get(None, zone)
+        if zone is None and subdivision:
+            zone = self._subdivisions.get(subdivision)
+        if zone is None:
+            zone = self._countries.get(country)
+        return zone
+
+    def _get_breaks(self, zone, service=None):
+        """
+        Yields `(service, weights, prices)` for the breaks pricing the zone.
+        Without service the breaks of every service of the zone are given,
+        the breaks without service apply to any service.
+        """
+        if service is None:
+            services = set(s for z, s in self._breaks if z == zone)
+        else:
+            services = [service]
+
+        for service in services:
+            breaks = self._breaks.get((zone, service)) or \
+                self._breaks.get((zone, None))
+            if breaks:
+                yield (service,) + breaks
+
+    def get_prices(self, zone, weight, service=None):
+        """
+        Returns a list of `(service, price, currency)` tuples for the weight
+        in the zone, see `_get_breaks` for the services priced.
+        """
+        res = []
+        for service, weights, prices in self._get_breaks(zone, service):
+            index = bisect_left(weights, weight)
+            if index < len(weights):
+                price, currency = prices[index]
+                res.append((service, price, currency))
+        return res
+
+    def get_prices_bulk(self, zones, weights, service=None):
+        """
+        Same as `get_prices` for many `(zone, weight)` pairs at once, returns
+        the list of prices of each pair.
+
+        Pairs are grouped by zone and each group is looked up in the breaks
+        of the zone with a single vectorized search when NumPy is installed.
+        """
+        res = [[] for _ in zones]
+        positions = {}
+        for position, zone in enumerate(zones):
+            if zone is not None:
+                positions.setdefault(zone, []).append(position)
+
+        for zone, zone_positions in positions.iteritems():
+            zone_weights = [weights[p] for p in zone_positions]
+            for service, break_weights, prices in self._get_breaks(
+                    zone, service):
+                indexes = _search_sorted(break_weights, zone_weights)
+                for position, index in zip(zone_positions, indexes):
+                    if index < len(prices):
+                        price, currency = prices[index]
+                        res[position].append((service, price, currency))
+        return res
+
+    @classmethod
+    def from_carrier(cls, carrier):
+        "Returns the rate table built from the records of the carrier"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        Uom = pool.get('product.uom')
+        ZoneLine = pool.get('carrier.zone.line')
+        WeightBreak = pool.get('carrier.weight_break')
+
+        kilogram = Uom(ModelData.get_id('product', 'uom_kilogram'))
+
+        surcharge = 1 + (carrier.rate_surcharge or 0) / 100
+
+        table = cls()
+        for line in ZoneLine.search([('zone.carrier', '=', carrier.id)]):
+            table.add_zone_line(
+                line.zone.id, line.country.id,
+                line.subdivision and line.subdivision.id, line.zip_prefix
+            )
+        for break_ in WeightBreak.search([('carrier', '=', carrier.id)]):
+            table.add_break(
+                break_.zone.id, break_.service and break_.service.id,
+                Uom.convert_qty(
+                    break_.weight_uom, break_.weight, kilogram, round=False
+                ),
+                break_.currency.round(break_.price * surcharge),
+                break_.currency.id
+            )
+        return table
+
+
+def _get_rate_table_rates(records, carrier, carrier_service=None):
+    "Returns the list of rates of each record from the carrier rate table"
+    pool = Pool()
+    ModelData = pool.get('ir.model.data')
+    Uom = pool.get('product.uom')
+    CarrierService = pool.get('carrier.service')
+    Currency = pool.get('currency.currency')
+
+    kilogram = Uom(ModelData.get_id('product', 'uom_kilogram'))
+    table = carrier.get_rate_table()
+    billable_weights = {}
+    if records:
+        billable_weights = pool.get(records[0].__name__).get_billable_weights(
+            records, carrier
+        )
+
+    zones, weights, factors = [], [], {}
+    for record in records:
+        address = record._get_ship_to_address()
+        if not address or not address.country:
+            zones.append(None)
+            weights.append(0)
+            continue
+        zones.append(table.find_zone(
+            address.country.id,
+            address.subdivision and address.subdivision.id, address.zip
+        ))
+        uom = record.weight_uom
+        if uom.id not in factors:
+            factors[uom.id] = Uom.compute_qty(uom, 1, kilogram, round=False)
+        weights.append((billable_weights[record.id] or 0) * factors[uom.id])
+
+    res = []
+    for prices in table.get_prices_bulk(
+            zones, weights, carrier_service and carrier_service.id):
+        rates = []
+        for service, price, currency in prices:
+            service = service and CarrierService(service)
+            rates.append({
+                'display_name': service and '%s %s' % (
+                    carrier.rec_name, service.name
+                ) or carrier.rec_name,
+                'carrier_service': service,
+                'cost': price,
+                'cost_currency': Currency(currency),
+                'carrier': carrier,
+            })
+        res.append(rates)
+    return res
+
+
+def get_rate_table_rates(record, carrier, carrier_service=None):
+    """
+    Rates a sale or a shipment with the rate table of the carrier, returns
+    the rates in the format of `get_shipping_rate`.
+    """
+    rates, = _get_rate_table_rates([record], carrier, carrier_service)
+    return rates
+
+
+def get_rate_table_rates_bulk(records, carrier, carrier_service=None):
+    """
+    Rates many sales or shipments with the rate table of the carrier and
+    returns a dictionary mapping the id of each record to its rates.
+
+    Zones are resolved per record, weights are converted once per unit and
+    prices are looked up with one vectorized search per zone, which makes
+    re-pricing a whole backlog a matter of seconds.
+    """
+    records = list(records)
+    return dict(zip(
+        [r.id for r in records],
+        _get_rate_table_rates(records, carrier, carrier_service)
+    ))
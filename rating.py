@@ -0,0 +1,677 @@
+# -*- coding: utf-8 -*-
+"""
+    rating.py
+
+    Helpers shared by the rating entry points of sales and shipments.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+from decimal import Decimal
+from itertools import chain
+from Queue import Queue, Empty
+
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import Model
+from trytond.pool import Pool
+from trytond.protocols.jsonrpc import JSONDecoder, JSONEncoder
+from trytond.transaction import Transaction
+
+from .adapter import AdapterTimeout, get_adapter, iter_run
+from .single_flight import single_flight
+from .limiter import CallBudgetExhausted
+from .breaker import (
+    allow_call, cancel_call, record_success, record_failure,
+    is_carrier_failure
+)
+
+__all__ = [
+    'TIMEOUT', 'RateQuote', 'imap_unordered', 'fan_out_shipping_rates',
+    'iter_shipping_rates', 'quote_shipping_rate', 'clear_rate_cache',
+    'address_fingerprint', 'get_rate_wizard_wait', 'get_rate_adapter',
+    'get_rate_timeout', 'get_rate_store_ttl',
+]
+
+logger = logging.getLogger(__name__)
+
+#: Marker yielded by :func:`imap_unordered` for calls which missed the
+#: deadline.
+TIMEOUT = object()
+
+#: Reference to an active record which can travel between transactions.
+RecordRef = namedtuple('RecordRef', ['model', 'id'])
+
+#: Rates already quoted, keyed on the fingerprint of what was rated.
+_rate_cache = Cache(
+    'shipping.rate_quote',
+    size_limit=config.getint('shipping', 'rate_cache_size', default=1024),
+    context=False
+)
+
+#: Last quotes answered for a fingerprint, served marked as stale while
+#: the circuit of the carrier is open.
+_stale_quotes = Cache(
+    'shipping.rate_quote_stale',
+    size_limit=config.getint('shipping', 'rate_cache_size', default=1024),
+    context=False
+)
+
+#: Quotes handed out to clients, keyed on the handle of their token.
+_quote_handles = Cache(
+    'shipping.rate_quote_handle',
+    size_limit=config.getint('shipping', 'rate_handle_size', default=4096),
+    context=False
+)
+
+
+def _work(func, items, jobs, results):
+    "Worker thread body of :func:`imap_unordered`"
+    while True:
+        try:
+            index = jobs.get_nowait()
+        except Empty:
+            return
+        try:
+            results.put((index, func(items[index]), None))
+        except Exception as exc:
+            results.put((index, None, exc))
+
+
+def imap_unordered(func, items, workers, timeout=None):
+    """
+    Call `func` for every item of `items` from a pool of at most `workers`
+    threads and yield `(item, result)` tuples in the order the calls
+    complete.
+
+    Calls which have not completed `timeout` seconds after the dispatch
+    are yielded last as `(item, TIMEOUT)` and abandoned. An exception
+    raised by `func` is re-raised in the caller.
+    """
+    items = list(items)
+    jobs, results = Queue(), Queue()
+    for index in xrange(len(items)):
+        jobs.put(index)
+
+    for _ in xrange(min(workers, len(items))):
+        thread = threading.Thread(
+            target=_work, args=(func, items, jobs, results)
+        )
+        thread.daemon = True
+        thread.start()
+
+    # Queue.get without a timeout cannot be interrupted, so wait in slices
+    deadline = time.time() + (timeout or float('inf'))
+    pending = set(xrange(len(items)))
+    while pending and time.time() < deadline:
+        try:
+            index, result, error = results.get(
+                timeout=max(min(deadline - time.time(), 3600), 0)
+            )
+        except Empty:
+            continue
+        pending.discard(index)
+        if error is not None:
+            raise error
+        yield items[index], result
+
+    for index in sorted(pending):
+        yield items[index], TIMEOUT
+
+
+def get_rate_workers():
+    """
+    Size of the worker pool used to rate carriers concurrently, read from
+    the `rate_workers` option of the `shipping` configuration section.
+    """
+    return config.getint('shipping', 'rate_workers', default=1)
+
+
+def get_rate_timeout():
+    """
+    Seconds a carrier is given to answer a concurrent rate request, read
+    from the `rate_timeout` option of the `shipping` configuration section.
+    """
+    return config.getfloat('shipping', 'rate_timeout', default=30)
+
+
+def get_rate_wizard_wait():
+    """
+    Seconds the rate wizards wait for carriers before showing the rates
+    which arrived, read from the `rate_wizard_wait` option of the `shipping`
+    configuration section. Zero waits up to the rate timeout.
+    """
+    return config.getfloat('shipping', 'rate_wizard_wait', default=0)
+
+
+def get_rate_cache_ttl():
+    """
+    Seconds a quoted rate is reused for, read from the `rate_cache_ttl`
+    option of the `shipping` configuration section. Zero disables the cache.
+    """
+    return config.getint('shipping', 'rate_cache_ttl', default=300)
+
+
+def get_rate_store_ttl():
+    """
+    Seconds the rates stored by the pre-rating of sales stay valid for,
+    read from the `rate_store_ttl` option of the `shipping` configuration
+    section.
+    """
+    return config.getint('shipping', 'rate_store_ttl', default=3600)
+
+
+def _detach(value):
+    if isinstance(value, Model):
+        return RecordRef(value.__name__, value.id)
+    return value
+
+
+def _attach(value):
+    if isinstance(value, RecordRef):
+        return Pool().get(value.model)(value.id)
+    return value
+
+
+class RateQuote(object):
+    """
+    Immutable and compact form of a rate.
+
+    It holds ids instead of active records so it can be cached, passed
+    between transactions and stored server side: `store` returns a short
+    token which wizards use as selection key, and `from_token` gives the
+    quote back. Keys of the rate other than the five mandatory ones are
+    kept in `extra`.
+    """
+    __slots__ = (
+        'carrier', 'carrier_service', 'cost', 'cost_currency',
+        'display_name', 'extra',
+    )
+
+    def __init__(
+            self, carrier, carrier_service, cost, cost_currency,
+            display_name=None, extra=()):
+        set_ = super(RateQuote, self).__setattr__
+        set_('carrier', carrier)
+        set_('carrier_service', carrier_service)
+        set_('cost', cost)
+        set_('cost_currency', cost_currency)
+        set_('display_name', display_name)
+        set_('extra', extra)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('RateQuote is immutable')
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, RateQuote) and
+            self._values() == other._values()
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return 'RateQuote%r' % (self._values(),)
+
+    @classmethod
+    def from_rate(cls, rate):
+        "Returns the quote of a rate dictionary"
+        return cls(
+            int(rate['carrier']),
+            rate['carrier_service'] and int(rate['carrier_service']),
+            Decimal(str(rate['cost'])),
+            int(rate['cost_currency']),
+            rate.get('display_name'),
+            tuple(sorted(
+                (key, _detach(value)) for key, value in rate.iteritems()
+                if key not in cls.__slots__
+            )),
+        )
+
+    def to_rate(self):
+        "Returns the rate dictionary, with active records, of the quote"
+        pool = Pool()
+        Carrier = pool.get('carrier')
+        CarrierService = pool.get('carrier.service')
+        Currency = pool.get('currency.currency')
+
+        carrier = Carrier(self.carrier)
+        service = self.carrier_service and CarrierService(self.carrier_service)
+        rate = dict((key, _attach(value)) for key, value in self.extra)
+        rate.update({
+            'carrier': carrier,
+            'carrier_service': service,
+            'cost': self.cost,
+            'cost_currency': Currency(self.cost_currency),
+            'display_name': self.display_name or service and '%s %s' % (
+                carrier.rec_name, service.name
+            ) or carrier.rec_name,
+        })
+        return rate
+
+    @classmethod
+    def dumps(cls, quotes):
+        "Returns the quotes serialized as JSON, see `loads`"
+        return json.dumps([
+            quote._values()[:-1] + ([
+                (key, True, [value.model, value.id])
+                if isinstance(value, RecordRef) else (key, False, value)
+                for key, value in quote.extra
+            ],) for quote in quotes
+        ], cls=JSONEncoder)
+
+    @classmethod
+    def loads(cls, data):
+        "Returns the tuple of quotes serialized by `dumps`"
+        quotes = []
+        for values in json.loads(data, object_hook=JSONDecoder()):
+            extra = tuple(
+                (str(key), RecordRef(str(value[0]), value[1])
+                    if is_record else value)
+                for key, is_record, value in values[-1]
+            )
+            quotes.append(cls(*(values[:-1] + [extra])))
+        return tuple(quotes)
+
+    def store(self):
+        """
+        Keeps the quote server side and returns its token.
+
+        The token encodes carrier, service, currency and cost followed by
+        the handle of the stored quote, so the essentials of the quote
+        survive even if the handle was evicted or stored by another
+        process. Its display name is then rebuilt from the carrier and the
+        service by `to_rate`.
+        """
+        handle = hashlib.sha1(repr(self._values())).hexdigest()[:12]
+        _quote_handles.set(handle, self)
+        return '%d:%d:%d:%s:%s' % (
+            self.carrier, self.carrier_service or 0, self.cost_currency,
+            self.cost, handle
+        )
+
+    @classmethod
+    def from_token(cls, token):
+        "Returns the quote of a token given by `store`"
+        carrier, service, currency, cost, handle = token.split(':')
+        quote = _quote_handles.get(handle)
+        if quote is not None:
+            return quote
+        return cls(
+            int(carrier), int(service) or None, Decimal(cost), int(currency)
+        )
+
+
+def address_fingerprint(address):
+    "Hashable summary of the parts of an address which carriers rate on"
+    if not address:
+        return None
+    return tuple(sorted(address.serialize(purpose='validation').items()))
+
+
+def _is_rated_locally(carrier):
+    """
+    Tells if the rates of the carrier are computed from local data, its
+    rate table or the list price of its product, rather than asked to the
+    carrier
+    """
+    return carrier.use_rate_table or (
+        carrier.carrier_cost_method == 'product' and
+        not get_rate_adapter(carrier)
+    )
+
+
+def _get_rate_cache_key(record, carrier, carrier_service=None):
+    "Returns the rate cache key of the record, None when it is not cached"
+    ttl = not _is_rated_locally(carrier) and get_rate_cache_ttl()
+    return ttl and record._get_rate_fingerprint(carrier, carrier_service)
+
+
+def _get_cached_rates(key):
+    cached = key and _rate_cache.get(key)
+    if cached and cached[0] > time.time():
+        return [quote.to_rate() for quote in cached[1]]
+
+
+def _set_cached_rates(key, rates):
+    if key and rates:
+        _set_cached_quotes(key, tuple(map(RateQuote.from_rate, rates)))
+
+
+def _set_cached_quotes(key, quotes):
+    if key and quotes:
+        _rate_cache.set(key, (time.time() + get_rate_cache_ttl(), quotes))
+        _stale_quotes.set(key, quotes)
+
+
+def _get_stale_rates(key):
+    "Returns the last rates answered for the key, marked as stale"
+    quotes = key and _stale_quotes.get(key) or ()
+    rates = [quote.to_rate() for quote in quotes]
+    for rate in rates:
+        rate['stale'] = True
+    return rates
+
+
+def _call_carrier(record, carrier, carrier_service, silent):
+    """
+    Calls the carrier, accounting the outcome on its circuit breaker. Rate
+    tables are looked up locally, only the calls to carrier APIs are
+    throttled.
+    """
+    try:
+        if not carrier.use_rate_table:
+            carrier.throttle()
+    except Exception:
+        cancel_call(carrier)
+        raise
+    try:
+        rates = record.get_shipping_rate(
+            carrier, carrier_service=carrier_service, silent=silent
+        )
+    except Exception as exc:
+        if is_carrier_failure(exc):
+            record_failure(carrier, exc)
+        else:
+            record_success(carrier)
+        raise
+    record_success(carrier)
+    return rates
+
+
+def quote_shipping_rate(record, carrier, carrier_service=None, silent=False):
+    """
+    Return the rates of `carrier` for `record`, reusing the rates quoted in
+    the last `rate_cache_ttl` seconds for an identical fingerprint.
+
+    The fingerprint returned by `record._get_rate_fingerprint` describes
+    everything the rate depends on (addresses, weight, packages, moves or
+    lines), so a change to any of them is a cache miss. Cached entries are
+    evicted least recently used first. Carriers rated from local data,
+    their rate table or the price of their product, are cheaper to rate
+    than to fingerprint and would not see the changes of that data, they
+    are not cached.
+
+    Identical requests made while one is in flight wait for its answer
+    instead of calling the carrier again, see
+    :func:`single_flight.single_flight`. Calls to carrier APIs are budgeted
+    by `carrier.throttle`, rate table lookups are not.
+
+    While the circuit of the carrier is open (see :mod:`breaker`) the
+    carrier is not called, the last rates answered for the fingerprint are
+    returned with a `stale` key set, or no rate. Rates answered to an
+    identical request count as an answer of the carrier.
+
+    Silent requests skip a carrier out of API call budget, it gives no
+    rate.
+    """
+    try:
+        return _quote_shipping_rate(record, carrier, carrier_service, silent)
+    except CallBudgetExhausted as exc:
+        if not silent:
+            raise
+        _log_skipped(record, carrier, exc)
+        return []
+
+
+def _log_skipped(record, carrier, error):
+    logger.warning(
+        'Carrier %s skipped to rate %s: %s', carrier.rec_name, record, error
+    )
+
+
+def _quote_shipping_rate(record, carrier, carrier_service, silent):
+    key = _get_rate_cache_key(record, carrier, carrier_service)
+    if not key:
+        if not allow_call(carrier):
+            return []
+        return _call_carrier(record, carrier, carrier_service, silent)
+
+    rates = _get_cached_rates(key)
+    if rates is not None:
+        return rates
+    if not allow_call(carrier):
+        return _get_stale_rates(key)
+
+    called = []
+
+    def get_quotes():
+        called.append(True)
+        return tuple(map(RateQuote.from_rate, _call_carrier(
+            record, carrier, carrier_service, silent
+        )))
+
+    answered = False
+    try:
+        # Silent requests hide the errors the others must raise
+        quotes = single_flight(
+            (key, silent), get_quotes, get_rate_timeout(), get_rate_cache_ttl(),
+            RateQuote.dumps, RateQuote.loads
+        )
+        answered = True
+    finally:
+        # _call_carrier accounts its own outcome, otherwise the request was
+        # answered by an identical one or not at all
+        if not called:
+            if answered:
+                record_success(carrier)
+            else:
+                record_failure(carrier, 'No answer to the rate request')
+    _set_cached_quotes(key, quotes)
+    return [quote.to_rate() for quote in quotes]
+
+
+def get_rate_adapter(carrier):
+    "Returns the adapter rating the carrier, None if there is none"
+    if carrier.use_rate_table:
+        return None
+    return get_adapter(carrier.carrier_cost_method, 'rate')
+
+
+def clear_rate_cache():
+    "Forget every quoted rate, in all the server processes"
+    _rate_cache.clear()
+
+
+def _get_rates_in_transaction(
+        database_name, user, context, model, record_id, carrier_id, silent):
+    "Rate a record against a carrier from a new read-only transaction"
+    with Transaction().start(
+            database_name, user, readonly=True, context=context):
+        pool = Pool()
+        record = pool.get(model)(record_id)
+        carrier = pool.get('carrier')(carrier_id)
+        return map(
+            RateQuote.from_rate,
+            _quote_shipping_rate(record, carrier, None, silent)
+        )
+
+
+def _can_rate_concurrently(record, carriers, workers):
+    """
+    Worker threads open their own transactions, so the record must be
+    stored and the database must be reachable from another connection.
+    """
+    return (
+        workers > 1 and len(carriers) > 1 and
+        record.id is not None and record.id >= 0 and
+        Transaction().database.name != ':memory:'
+    )
+
+
+def iter_shipping_rates(record, carriers, silent=False, timeout=None):
+    """
+    Rate `record`, a sale or a shipment, against each of `carriers` and
+    yield `(carrier, rates)` tuples as the carriers answer.
+
+    Carriers driven by an adapter are all sent at once on the threads of
+    the adapters before the other carriers are rated and stay in flight
+    meanwhile, their rates are yielded as they arrive. When more than one
+    rate worker is configured the other carriers are rated concurrently,
+    each from its own read-only transaction, so the record is rated as last
+    committed, and the tuples come in arrival order.
+
+    Carriers which did not answer within `timeout` seconds (the rate
+    timeout by default) are yielded last as `(carrier, TIMEOUT)`. They keep
+    being rated in the background and their rates land in the rate cache,
+    so asking again later gets them at once. Silent requests skip the
+    carriers out of API call budget, they are yielded as `(carrier,
+    TIMEOUT)` too.
+    """
+    if timeout is None:
+        timeout = get_rate_timeout()
+    carriers = list(carriers)
+    adapted = [c for c in carriers if get_rate_adapter(c)]
+
+    cached, runs, keys = _send_adapted_rates(record, adapted, timeout)
+    for result in cached:
+        yield result
+    for result in _iter_threaded_rates(
+            record, [c for c in carriers if c not in adapted], silent,
+            timeout):
+        yield result
+        for arrived in _collect_adapted_rates(
+                chain(*[run.ready() for run in runs]), keys, silent):
+            yield arrived
+    for result in _collect_adapted_rates(chain(*runs), keys, silent):
+        yield result
+
+
+def _quote_or_skip(record, carrier, silent):
+    "Quote the carrier, TIMEOUT if a silent request skips it for its budget"
+    try:
+        return _quote_shipping_rate(record, carrier, None, silent)
+    except CallBudgetExhausted as exc:
+        if not silent:
+            raise
+        _log_skipped(record, carrier, exc)
+        return TIMEOUT
+
+
+def _iter_threaded_rates(record, carriers, silent, timeout):
+    workers = get_rate_workers()
+    if not _can_rate_concurrently(record, carriers, workers):
+        for carrier in carriers:
+            yield carrier, _quote_or_skip(record, carrier, silent)
+        return
+
+    transaction = Transaction()
+    database_name = transaction.database.name
+    user = transaction.user
+    context = transaction.context.copy()
+
+    def rate_carrier(carrier):
+        try:
+            return _get_rates_in_transaction(
+                database_name, user, context, record.__name__, record.id,
+                carrier.id, silent
+            )
+        except CallBudgetExhausted as exc:
+            if not silent:
+                raise
+            return exc
+
+    for carrier, quotes in imap_unordered(
+            rate_carrier, carriers, workers, timeout):
+        if isinstance(quotes, CallBudgetExhausted):
+            _log_skipped(record, carrier, quotes)
+            yield carrier, TIMEOUT
+        elif quotes is TIMEOUT:
+            record_failure(carrier, 'timeout')
+            yield carrier, TIMEOUT
+        else:
+            yield carrier, [quote.to_rate() for quote in quotes]
+
+
+def _send_adapted_rates(record, carriers, timeout):
+    """
+    Sends the rate requests of the carriers driven by an adapter which are
+    not cached and returns a tuple `(cached, runs, keys)`: the list of the
+    `(carrier, rates)` known without calling, the runs of
+    :func:`adapter.iter_run` and the cache key of each carrier sent.
+    Carriers whose circuit is open are not sent, their stale rates are
+    given instead.
+    """
+    cached, keys, calls = [], {}, {}
+    for carrier in carriers:
+        key = _get_rate_cache_key(record, carrier)
+        rates = _get_cached_rates(key)
+        if rates is not None:
+            cached.append((carrier, rates))
+            continue
+        if not allow_call(carrier):
+            cached.append((carrier, _get_stale_rates(key)))
+            continue
+        keys[carrier] = key
+        calls.setdefault(carrier.carrier_cost_method, []).append(
+            (record, carrier)
+        )
+
+    runs = [
+        iter_run(
+            get_adapter(method, 'rate'), 'rate', method_calls, timeout,
+            throttle=lambda record, carrier: carrier.get_throttle()
+        ) for method, method_calls in calls.iteritems()
+    ]
+    return cached, runs, keys
+
+
+def _collect_adapted_rates(results, keys, silent):
+    for (record, carrier), rates, error in results:
+        if isinstance(error, AdapterTimeout):
+            record_failure(carrier, 'timeout')
+            yield carrier, TIMEOUT
+        elif isinstance(error, CallBudgetExhausted):
+            cancel_call(carrier)
+            if not silent:
+                raise error
+            _log_skipped(record, carrier, error)
+            yield carrier, TIMEOUT
+        elif error is not None:
+            if is_carrier_failure(error):
+                record_failure(carrier, error)
+            else:
+                record_success(carrier)
+            if not silent:
+                raise error
+            logger.warning(
+                'Carrier %s failed to rate %s: %s', carrier.rec_name, record,
+                error
+            )
+            yield carrier, []
+        else:
+            record_success(carrier)
+            _set_cached_rates(keys[carrier], rates)
+            yield carrier, rates
+
+
+def fan_out_shipping_rates(record, carriers, silent=False):
+    """
+    Rate `record`, a sale or a shipment, against each of `carriers` and
+    return a tuple `(rates, timed_out_carriers)`, see
+    :func:`iter_shipping_rates`.
+    """
+    rates, timed_out = [], []
+    for carrier, carrier_rates in iter_shipping_rates(
+            record, carriers, silent):
+        if carrier_rates is TIMEOUT:
+            timed_out.append(carrier)
+        else:
+            rates.extend(carrier_rates)
+
+    if timed_out:
+        logger.warning(
+            'Carriers %s did not answer rate request for %s in time',
+            ', '.join(c.rec_name for c in timed_out), record
+        )
+    return rates, timed_out
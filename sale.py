@@ -3,20 +3,49 @@
     sale.py
 
 """
-import json
+import datetime
+import hashlib
+import logging
+from contextlib import contextmanager
 from decimal import Decimal
 
-from trytond.model import ModelView, fields
+from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval, Not, Bool
 from trytond.transaction import Transaction
 from trytond.wizard import Wizard, StateView, Button, StateTransition
 from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
 from babel.numbers import format_currency
 
-__all__ = ['SaleLine', 'Sale']
+from .rating import (
+    TIMEOUT, RateQuote, fan_out_shipping_rates, iter_shipping_rates,
+    quote_shipping_rate, address_fingerprint, get_rate_wizard_wait,
+    get_rate_adapter, get_rate_timeout, get_rate_store_ttl
+)
+from .rate_table import get_rate_table_rates
+from .breaker import OPEN, get_circuit_state
+
+__all__ = ['SaleLine', 'Sale', 'SaleShippingRate']
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def _sale_transaction():
+    """
+    Runs the block in a transaction of its own, committed unless it fails.
+    Other transactions can not reach an in-memory database, the block runs
+    in the current transaction there.
+    """
+    transaction = Transaction()
+    if transaction.database.name == ':memory:':
+        yield
+        return
+    with transaction.new_transaction():
+        yield
+
 
 class Sale:
     "Sale"
@@ -60,6 +89,19 @@ class Sale:
         "on_change_with_carrier_cost_method"
     )
 
+    #: Set when the rates of the sale must be computed again by the
+    #: pre-rating cron.
+    rating_pending = fields.Boolean(
+        'Rating Pending', readonly=True, select=True
+    )
+    shipping_rates = fields.One2Many(
+        'sale.shipping_rate', 'sale', 'Shipping Rates', readonly=True
+    )
+
+    @staticmethod
+    def default_rating_pending():
+        return False
+
     @classmethod
     @ModelView.button_action('shipping.wizard_sale_apply_shipping')
     def apply_shipping(cls, sales):
@@ -88,6 +130,8 @@ class Sale:
         super(Sale, cls).__setup__()
         cls._error_messages.update({
             'warehouse_address_missing': 'Warehouse address is missing',
+            'carrier_rate_timeout':
+                'Carriers %s did not answer the rate request in time',
         })
         cls._buttons.update({
             'apply_shipping': {
@@ -114,14 +158,35 @@ class Sale:
 
         return ModelData.get_id('product', 'uom_pound')
 
-    def get_weight(self, name):
+    @classmethod
+    def get_weight(cls, sales, name=None):
         """
-        Returns sum of weight associated with each line
+        Returns sum of weight associated with each line, the weights of
+        the lines of all the sales are computed together
         """
-        return sum(map(
-            lambda line: line.get_weight(self.weight_uom, silent=True),
-            self.lines
-        ))
+        SaleLine = Pool().get('sale.line')
+
+        by_uom = {}
+        for sale in sales:
+            by_uom.setdefault(sale.weight_uom, []).append(sale)
+
+        res = {}
+        for weight_uom, uom_sales in by_uom.iteritems():
+            weights = SaleLine.get_weights(
+                [line for sale in uom_sales for line in sale.lines],
+                weight_uom, silent=True
+            )
+            for sale in uom_sales:
+                res[sale.id] = sum([weights[line.id] for line in sale.lines])
+        return res
+
+    @classmethod
+    def get_billable_weights(cls, sales, carrier=None):
+        """
+        Returns a dictionary with the weight billed for each sale by
+        `carrier`, sales are not packed yet so it is their weight
+        """
+        return cls.get_weight(sales)
 
     @fields.depends('party', 'shipment_address', 'warehouse')
     def on_change_with_is_international_shipping(self, name=None):
@@ -144,6 +209,12 @@ class Sale:
             return self.raise_user_error('warehouse_address_missing')
         return self.warehouse and self.warehouse.address
 
+    def _get_ship_to_address(self):
+        """
+        The address the sale is delivered to
+        """
+        return self.shipment_address
+
     def add_shipping_line(
             self, shipment_cost, description, carrier=None,
             carrier_service=None
@@ -242,6 +313,10 @@ class Sale:
         Gives a list of rates from carriers provided. If no carriers provided,
         return rates from all the carriers.
 
+        Carriers are rated concurrently when the `rate_workers` option of
+        the `shipping` configuration section is greater than one, see
+        :func:`rating.fan_out_shipping_rates`.
+
         List contains dictionary with following minimum keys:
             [
                 {
@@ -256,13 +331,64 @@ class Sale:
         Carrier = Pool().get('carrier')
 
         if carriers is None:
-            carriers = Carrier.search([])
+            carriers = Carrier.get_active_carriers()
 
-        rates = []
-        for carrier in carriers:
-            rates.extend(self.get_shipping_rate(carrier, silent=silent))
+        rates, timed_out = fan_out_shipping_rates(self, carriers, silent)
+        if timed_out and not silent:
+            self.raise_user_error('carrier_rate_timeout', error_args=(
+                ', '.join(c.rec_name for c in timed_out),
+            ))
         return rates
 
+    def iter_shipping_rates(self, carriers=None, silent=False, timeout=None):
+        """
+        Same as `get_shipping_rates` but yields `(carrier, rates)` tuples
+        as each carrier answers, so callers can show the rates of the
+        fastest carriers first. Carriers which did not answer within
+        `timeout` seconds are yielded last with `rating.TIMEOUT` as rates,
+        see :func:`rating.iter_shipping_rates`.
+        """
+        Carrier = Pool().get('carrier')
+
+        if carriers is None:
+            carriers = Carrier.get_active_carriers()
+
+        return iter_shipping_rates(self, carriers, silent, timeout)
+
+    def quote_shipping_rate(self, carrier, carrier_service=None, silent=False):
+        """
+        Same as `get_shipping_rate` but reuses the rates recently quoted for
+        an identical sale, see :func:`rating.quote_shipping_rate`.
+        """
+        return quote_shipping_rate(self, carrier, carrier_service, silent)
+
+    def _get_rate_fingerprint(self, carrier, carrier_service=None):
+        """
+        Returns a hashable fingerprint of everything the rates of carrier
+        depend on, it is used as key of the rate cache. None disables the
+        cache for the sale.
+
+        Downstream modules rating on more information should extend it.
+        """
+        if self.id is None or self.id < 0:
+            return None
+
+        return (
+            self.__name__,
+            Transaction().context.get('company'),
+            carrier.id,
+            carrier_service and carrier_service.id,
+            address_fingerprint(self._get_ship_from_address(silent=True)),
+            address_fingerprint(self.shipment_address),
+            self.weight_uom.id,
+            self.weight,
+            tuple(sorted(
+                (line.product.id, line.quantity, line.unit.id)
+                for line in self.lines
+                if line.product and line.shipment_cost is None
+            )),
+        )
+
     def get_shipping_rate(self, carrier, carrier_service=None, silent=False):
         """
         Gives a list of rates from provided carrier and carrier service.
@@ -280,6 +406,16 @@ class Sale:
         """
         Company = Pool().get('company.company')
 
+        if carrier.use_rate_table:
+            return get_rate_table_rates(self, carrier, carrier_service)
+
+        adapter = get_rate_adapter(carrier)
+        if adapter:
+            return adapter.run(
+                'rate', self, carrier, carrier_service,
+                timeout=get_rate_timeout()
+            )
+
         if carrier.carrier_cost_method == 'product':
             currency = Company(Transaction().context['company']).currency
             rate_dict = {
@@ -294,6 +430,157 @@ class Sale:
 
         return []
 
+    @classmethod
+    def quote(cls, sales):
+        super(Sale, cls).quote(sales)
+        cls.set_rating_pending(sales)
+
+    @classmethod
+    def confirm(cls, sales):
+        super(Sale, cls).confirm(sales)
+        cls.set_rating_pending(sales)
+
+    @classmethod
+    def _get_rating_fields(cls):
+        "Fields of the sale whose change calls for rating it again"
+        return {'lines', 'shipment_address', 'warehouse'}
+
+    @classmethod
+    def write(cls, *args):
+        rating_fields = cls._get_rating_fields()
+        actions = iter(args)
+        to_rate = []
+        for sales, values in zip(actions, actions):
+            if rating_fields & set(values):
+                to_rate.extend(sales)
+        super(Sale, cls).write(*args)
+        cls.set_rating_pending(to_rate)
+
+    @classmethod
+    def copy(cls, sales, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default.setdefault('rating_pending', False)
+        default.setdefault('shipping_rates', None)
+        return super(Sale, cls).copy(sales, default=default)
+
+    @classmethod
+    def set_rating_pending(cls, sales):
+        """
+        Queue the quotations and confirmed sales for the pre-rating cron,
+        see `pre_rate_sales_cron`.
+        """
+        sales = [
+            sale for sale in sales
+            if sale.state in ('quotation', 'confirmed') and
+            not sale.rating_pending
+        ]
+        if sales:
+            cls.write(sales, {'rating_pending': True})
+
+    @classmethod
+    def pre_rate_sales_cron(cls):
+        """
+        This is a cron method, it rates the sales queued by
+        `set_rating_pending` and stores their rates so the apply shipping
+        wizard shows them at once. Its calls to the carriers give way to
+        interactive ones.
+
+        Each sale is rated in a transaction of its own. Sales which failed
+        or were not fully rated stay pending for the next run.
+        """
+        sales = cls.search([('rating_pending', '=', True)])
+
+        for sale_id in map(int, sales):
+            try:
+                with _sale_transaction():
+                    sale = cls(sale_id)
+                    if sale.state in ('quotation', 'confirmed'):
+                        with Transaction().set_context(
+                                company=sale.company.id,
+                                shipping_call_priority='background'):
+                            if not sale.store_shipping_rates():
+                                continue
+                    cls.write([sale], {'rating_pending': False})
+            except Exception:
+                logger.exception('Failed to pre-rate sale %d', sale_id)
+
+    def _get_stored_rate_fingerprint(self, carrier):
+        fingerprint = self._get_rate_fingerprint(carrier)
+        return fingerprint and hashlib.sha1(repr(fingerprint)).hexdigest()
+
+    def get_stored_shipping_rates(self, carriers=None):
+        """
+        Returns a tuple `(rates, stale_carriers)` with the rates stored for
+        the sale by `store_shipping_rates` which are still valid and the
+        carriers which must be rated again.
+
+        Stored rates are valid for `rate_store_ttl` seconds (see
+        :func:`rating.get_rate_store_ttl`) as long as the rate fingerprint
+        of the sale is unchanged.
+        """
+        Carrier = Pool().get('carrier')
+
+        if carriers is None:
+            carriers = Carrier.get_active_carriers()
+
+        stored = dict(
+            (shipping_rate.carrier.id, shipping_rate)
+            for shipping_rate in self.shipping_rates
+        )
+        valid_after = datetime.datetime.now() - datetime.timedelta(
+            seconds=get_rate_store_ttl()
+        )
+        rates, stale = [], []
+        for carrier in carriers:
+            shipping_rate = stored.get(carrier.id)
+            if shipping_rate and shipping_rate.rated_at > valid_after and \
+                    shipping_rate.fingerprint == \
+                    self._get_stored_rate_fingerprint(carrier):
+                rates.extend(shipping_rate.get_rates())
+            else:
+                stale.append(carrier)
+        return rates, stale
+
+    def store_shipping_rates(self, carriers=None):
+        """
+        Rates the sale against the carriers whose stored rates are stale
+        and stores their answers. Returns False if a carrier did not answer
+        in time, only gave stale rates or was skipped as its circuit is
+        open, it is left to the next run.
+        """
+        ShippingRate = Pool().get('sale.shipping_rate')
+
+        _, stale = self.get_stored_shipping_rates(carriers)
+        if not stale:
+            return True
+
+        now = datetime.datetime.now()
+        to_create, complete = [], True
+        for carrier, rates in self.iter_shipping_rates(stale, silent=True):
+            fingerprint = self._get_stored_rate_fingerprint(carrier)
+            if not fingerprint:
+                continue
+            if rates is TIMEOUT or get_circuit_state(carrier) == OPEN or \
+                    any(rate.get('stale') for rate in rates):
+                complete = False
+                continue
+            to_create.append({
+                'sale': self.id,
+                'carrier': carrier.id,
+                'fingerprint': fingerprint,
+                'quotes': RateQuote.dumps(map(RateQuote.from_rate, rates)),
+                'rated_at': now,
+            })
+
+        ShippingRate.delete(ShippingRate.search([
+            ('sale', '=', self.id),
+            ('carrier', 'in', [values['carrier'] for values in to_create]),
+        ]))
+        ShippingRate.create(to_create)
+        return complete
+
     @classmethod
     def get_allowed_carriers_domain(cls):
         """This method returns domain to seach allowed carriers
@@ -328,6 +615,126 @@ class SaleLine:
             'weight_required': 'Weight is missing on the product %s',
         })
 
+    @staticmethod
+    def _get_sales(lines):
+        return list(set(line.sale for line in lines if line.sale))
+
+    @classmethod
+    def create(cls, vlist):
+        lines = super(SaleLine, cls).create(vlist)
+        Pool().get('sale.sale').set_rating_pending(cls._get_sales(lines))
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        super(SaleLine, cls).write(*args)
+        Pool().get('sale.sale').set_rating_pending(cls._get_sales(
+            [line for lines in args[::2] for line in lines]
+        ))
+
+    @classmethod
+    def delete(cls, lines):
+        sales = cls._get_sales(lines)
+        super(SaleLine, cls).delete(lines)
+        Pool().get('sale.sale').set_rating_pending(sales)
+
+    @classmethod
+    def _get_weight_rows(cls, lines):
+        """
+        Returns the rows `(id, quantity, unit, type, default_uom,
+        canonical_weight, weight, weight_uom)` of the lines with a product,
+        read with one query per slice of lines
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+
+        line = cls.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        cursor = Transaction().connection.cursor()
+
+        rows = []
+        for sub_ids in grouped_slice(map(int, lines)):
+            cursor.execute(*line.join(
+                product, condition=line.product == product.id
+            ).join(
+                template, condition=product.template == template.id
+            ).select(
+                line.id, line.quantity, line.unit, template.type,
+                template.default_uom, product.canonical_weight,
+                template.weight, template.weight_uom,
+                where=reduce_ids(line.id, sub_ids)
+            ))
+            rows.extend(cursor.fetchall())
+        return rows
+
+    @classmethod
+    def _iter_weight_rows(cls, lines, silent):
+        """
+        Yields `(id, quantity, canonical_weight, weight, weight_uom)` for
+        the lines with a weight, the quantity in the default uom of the
+        product.
+        """
+        ProductUom = Pool().get('product.uom')
+
+        for line_id, quantity, unit, type_, default_uom, canonical_weight, \
+                weight, weight_uom in cls._get_weight_rows(lines):
+            if (quantity or 0) <= 0 or type_ == 'service':
+                continue
+            if not canonical_weight:
+                if not silent:
+                    cls.raise_user_error('weight_required', error_args=(
+                        cls(line_id).product.name,
+                    ))
+                continue
+            if unit != default_uom:
+                quantity = ProductUom.convert_qty(unit, quantity, default_uom)
+            yield line_id, quantity, canonical_weight, weight, weight_uom
+
+    @classmethod
+    def get_canonical_weights(cls, lines, silent=False):
+        """
+        Returns a dictionary with the weight of each line in grams, not
+        rounded, computed from rows read in bulk instead of browsing each
+        line and product.
+
+        :param lines: List of lines or of their ids
+        :param silent: Raise error if not silent
+        """
+        weights = dict((int(line), 0) for line in lines)
+        for line_id, quantity, canonical_weight, _, _ in \
+                cls._iter_weight_rows(lines, silent):
+            weights[line_id] = canonical_weight * quantity
+        return weights
+
+    @classmethod
+    def get_weights(cls, lines, weight_uom, silent=False):
+        """
+        Returns a dictionary with the weight of each line as given by
+        `get_weight`, computed from rows read in bulk instead of browsing
+        each line and product.
+
+        :param lines: List of lines or of their ids
+        :param weight_uom: Weight uom used by carriers
+        :param silent: Raise error if not silent
+        """
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        ProductUom = pool.get('product.uom')
+
+        gram = ModelData.get_id('product', 'uom_gram')
+        weights = dict((int(line), 0) for line in lines)
+        for line_id, quantity, canonical_weight, weight, product_weight_uom \
+                in cls._iter_weight_rows(lines, silent):
+            if product_weight_uom == int(weight_uom):
+                weights[line_id] = weight * quantity
+            else:
+                weights[line_id] = ProductUom.convert_qty(
+                    gram, canonical_weight * quantity, weight_uom
+                )
+        return weights
+
     def get_weight(self, weight_uom, silent=False):
         """
         Returns weight as required for carriers
@@ -335,13 +742,15 @@ class SaleLine:
         :param weight_uom: Weight uom used by carriers
         :param silent: Raise error if not silent
         """
-        ProductUom = Pool().get('product.uom')
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        ProductUom = pool.get('product.uom')
 
         if not self.product or self.quantity <= 0 or \
                 self.product.type == 'service':
             return 0
 
-        if not self.product.weight:
+        if not self.product.canonical_weight:
             if silent:
                 return 0
             self.raise_user_error(
@@ -352,7 +761,7 @@ class SaleLine:
         # Find the quantity in the default uom of the product as the weight
         # is for per unit in that uom
         if self.unit != self.product.default_uom:
-            quantity = ProductUom.compute_qty(
+            quantity = ProductUom.convert_qty(
                 self.unit,
                 self.quantity,
                 self.product.default_uom
@@ -360,18 +769,39 @@ class SaleLine:
         else:
             quantity = self.quantity
 
-        weight = self.product.weight * quantity
+        # The weight is already in the uom used by carriers
+        if self.product.weight_uom == weight_uom:
+            return self.product.weight * quantity
+
+        return ProductUom.convert_qty(
+            ModelData.get_id('product', 'uom_gram'),
+            self.product.canonical_weight * quantity,
+            weight_uom
+        )
 
-        # Compare product weight uom with the weight uom used by carrier
-        # and calculate weight if botth are not same
-        if self.product.weight_uom != weight_uom:
-            weight = ProductUom.compute_qty(
-                self.product.weight_uom,
-                weight,
-                weight_uom,
-            )
 
-        return weight
+class SaleShippingRate(ModelSQL, ModelView):
+    """
+    Sale Shipping Rate
+
+    The rates of a carrier for a sale, computed ahead of the apply shipping
+    wizard by the pre-rating cron.
+    """
+    __name__ = 'sale.shipping_rate'
+
+    sale = fields.Many2One(
+        'sale.sale', 'Sale', required=True, select=True, ondelete='CASCADE'
+    )
+    carrier = fields.Many2One(
+        'carrier', 'Carrier', required=True, ondelete='CASCADE'
+    )
+    fingerprint = fields.Char('Fingerprint', required=True)
+    quotes = fields.Text('Quotes', required=True)
+    rated_at = fields.DateTime('Rated At', required=True)
+
+    def get_rates(self):
+        "Returns the stored rates as rate dictionaries"
+        return [quote.to_rate() for quote in RateQuote.loads(self.quotes)]
 
 
 class ReturnSale:
@@ -418,6 +848,9 @@ class ApplyShippingSelectRate(ModelView):
 
     rate = fields.Selection([], 'Rate', required=True, sort=False)
 
+    #: Carriers which had not answered yet when the rates were shown.
+    pending_carriers = fields.Text('Pending Carriers', readonly=True)
+
     @classmethod
     def default_rate(cls):
         # Fill the first selection value
@@ -444,6 +877,9 @@ class ApplyShipping(Wizard):
         'shipping.apply_shipping_select_rate_form',
         [
             Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Refresh', 'get_rates', 'tryton-refresh', states={
+                'invisible': ~Eval('pending_carriers'),
+            }),
             Button('Apply', 'apply_rate', 'tryton-go-next', default=True),
         ]
     )
@@ -470,45 +906,59 @@ class ApplyShipping(Wizard):
         return 'start'
 
     def transition_get_rates(self):
+        pending = []
         if self.start.carrier:
-            rates = self.sale.get_shipping_rate(
+            rates = self.sale.quote_shipping_rate(
                 self.start.carrier, self.start.carrier_service, silent=True
             )
         else:
-            rates = self.sale.get_shipping_rates(silent=True)
+            rates, pending = self._get_arrived_rates()
+        self.select_rate.pending_carriers = '\n'.join(
+            carrier.rec_name for carrier in pending
+        )
 
         sorted_rates = sorted(rates, key=lambda r: Decimal("%s" % r['cost']))
         result = []
         for rate in sorted_rates:
-            key = json.dumps({
-                'display_name': rate['display_name'],
-                'cost_currency': rate['cost_currency'].id,
-                'cost': str(rate['cost']),
-                'carrier': rate['carrier'].id,
-                'carrier_service': rate['carrier_service'] and
-                rate['carrier_service'].id
-            })
             display_name = "%s %s" % (rate['display_name'], format_currency(
                 rate['cost'], rate['cost_currency'].code,
                 locale=Transaction().language
             ))
-            result.append((key, display_name))
+            result.append((RateQuote.from_rate(rate).store(), display_name))
         self.select_rate.__class__.rate.selection = result
 
         return "select_rate"
 
-    def transition_apply_rate(self):
-        Currency = Pool().get('currency.currency')
-        Carrier = Pool().get('carrier')
-        CarrierService = Pool().get('carrier.service')
-
-        # Build rate object
-        rate = json.loads(self.select_rate.rate)
-        rate['cost'] = Decimal(rate['cost'])
-        rate['cost_currency'] = Currency(rate['cost_currency'])
-        rate['carrier'] = Carrier(rate['carrier'])
-        if rate['carrier_service']:
-            rate['carrier_service'] = CarrierService(rate['carrier_service'])
+    def _get_arrived_rates(self):
+        """
+        Returns a tuple `(rates, pending_carriers)` with the rates of the
+        carriers which answered within the wizard wait. Rates stored by the
+        pre-rating cron are used as long as they are valid, only the other
+        carriers are rated. The pending carriers keep being rated in the
+        background, refreshing picks their rates up from the rate cache.
+        """
+        rates, stale = self.sale.get_stored_shipping_rates()
+        pending = []
+        if not stale:
+            return rates, pending
+        for carrier, carrier_rates in self.sale.iter_shipping_rates(
+                stale, silent=True, timeout=get_rate_wizard_wait() or None):
+            if carrier_rates is TIMEOUT:
+                pending.append(carrier)
+            else:
+                rates.extend(carrier_rates)
+        return rates, pending
+
+    def default_select_rate(self, fields):
+        selection = self.select_rate.__class__.rate.selection
+        return {
+            'rate': selection and selection[0][0] or None,
+            'pending_carriers': getattr(
+                self.select_rate, 'pending_carriers', None
+            ),
+        }
 
+    def transition_apply_rate(self):
+        rate = RateQuote.from_token(self.select_rate.rate).to_rate()
         self.sale.apply_shipping_rate(rate)
         return 'end'
@@ -140,6 +140,9 @@ setup(
     ],
     license='BSD',
     install_requires=requires,
+    extras_require={
+        'numpy': ['numpy'],
+    },
     zip_safe=False,
     entry_points="""
     [trytond.modules]
@@ -3,22 +3,25 @@
     shipment.py
 
 """
-import simplejson as json
-from decimal import Decimal
+from sql.aggregate import Count, Sum
+from sql.conditionals import Case
 
 from trytond.model import fields, ModelView
 from trytond.pool import PoolMeta, Pool
 from trytond.wizard import Wizard, StateView, Button, StateTransition
 from trytond.pyson import Eval, Bool
 from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
 
 from .mixin import ShipmentCarrierMixin
+from .rating import RateQuote
 
 __metaclass__ = PoolMeta
 __all__ = [
     'ShipmentOut', 'GenerateShippingLabelMessage',
     'GenerateShippingLabel', 'ShippingCarrierSelector',
-    'SelectShippingRate'
+    'SelectShippingRate', 'GenerateShippingLabelsBatchEnd',
+    'GenerateShippingLabelsBatch',
 ]
 
 
@@ -26,6 +29,14 @@ class ShipmentOut(ShipmentCarrierMixin):
     __metaclass__ = PoolMeta
     __name__ = 'stock.shipment.out'
 
+    @classmethod
+    def __setup__(cls):
+        super(ShipmentOut, cls).__setup__()
+        cls._error_messages.update({
+            'items_not_packaged':
+                'Not all the items are packaged for shipments %s',
+        })
+
     @property
     def carrier_cost_moves(self):
         return filter(
@@ -38,41 +49,99 @@ class ShipmentOut(ShipmentCarrierMixin):
 
     @classmethod
     def get_weight(cls, records, name=None):
-
-        res = {}
+        packed, moves = [], []
         for shipment in records:
-            weight_uom = shipment.weight_uom
-
             if shipment.packages or (shipment.state in ('packed', 'done')):
-                res.update(super(ShipmentOut, cls).get_weight([shipment], name))
+                packed.append(shipment)
                 continue
 
             inventory_moves = filter(
                 lambda m: (m.state != 'cancel' and m.quantity),
                 shipment.inventory_moves
             )
-            res[shipment.id] = sum([
-                move.get_weight(weight_uom, silent=True)
-                for move in inventory_moves
-            ])
+            moves.append((shipment, inventory_moves))
 
+        res = super(ShipmentOut, cls).get_weight(packed, name)
+        res.update(cls._sum_move_weights(moves))
         return res
 
     @classmethod
     def pack(cls, shipments):
+        """
+        Checks the packages of the shipments hold all their items and packs
+        the shipments without packages. Their packages are created together,
+        the shipments not packed automatically get the package of
+        `_get_default_package_values`, or of `_create_default_package` when
+        the class overrides it.
+        """
         super(ShipmentOut, cls).pack(shipments)
 
+        unpackaged = cls.get_unpackaged_shipments(
+            [s for s in shipments if s.packages]
+        )
+        if unpackaged:
+            cls.raise_user_error('items_not_packaged', (
+                ', '.join('#%s' % s.number for s in unpackaged),
+            ))
+
+        packages = []
         for shipment in shipments:
-            if not shipment.packages:
-                # No package, create a default package
+            if shipment.packages:
+                continue
+            if shipment._is_auto_packed():
+                packages.extend(shipment._get_packages())
+            elif cls._overrides_default_package():
                 shipment._create_default_package()
             else:
-                if (len(shipment.carrier_cost_moves) !=
-                        sum(len(p.moves) for p in shipment.packages)):
-                    cls.raise_user_error(
-                        "Not all the items are packaged for shipment #%s", (
-                            shipment.number, )
-                    )
+                # No package, create a default package
+                packages.append(shipment._get_default_package_values())
+        if packages:
+            cls.create_packages(packages)
+
+    @classmethod
+    def get_unpackaged_shipments(cls, shipments):
+        """
+        Returns the shipments whose packages do not hold as many moves as
+        the shipment has carrier cost moves, counted with one aggregate
+        query per slice of shipments.
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Location = pool.get('stock.location')
+
+        move = Move.__table__()
+        location = Location.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # Same moves as carrier_cost_moves: the outgoing moves leave the
+        # output location of the warehouse
+        is_cost_move = (
+            move.from_location.in_(location.select(
+                location.output_location,
+                where=location.type == 'warehouse'
+            )) &
+            (move.state != 'cancel') &
+            (move.quantity != 0)
+        )
+        unpackaged = set()
+        for sub_shipments in grouped_slice(shipments):
+            cursor.execute(*move.select(
+                move.shipment,
+                Sum(Case((is_cost_move, 1), else_=0)),
+                Count(move.package),
+                where=move.shipment.in_([
+                    '%s,%d' % (cls.__name__, s.id) for s in sub_shipments
+                ]),
+                group_by=move.shipment
+            ))
+            unpackaged.update(
+                shipment for shipment, cost_moves, packaged
+                in cursor.fetchall() if cost_moves != packaged
+            )
+        return [
+            s for s in shipments
+            if '%s,%d' % (cls.__name__, s.id) in unpackaged
+        ]
 
 
 class ShippingCarrierSelector(ModelView):
@@ -236,7 +305,7 @@ class GenerateShippingLabel(Wizard):
                 if not package.override_weight:
                     continue
                 package_weights.append(
-                    UOM.compute_qty(
+                    UOM.convert_qty(
                         package.override_weight_uom,
                         package.override_weight,
                         self.shipment.weight_uom
@@ -280,35 +349,13 @@ class GenerateShippingLabel(Wizard):
             package.save()
 
         # Fetch rates, and fill selection field with result list
-        rates = self.shipment.get_shipping_rate(
+        rates = self.shipment.quote_shipping_rate(
             self.start.carrier, self.start.carrier_service
         )
         result = []
         for rate in rates:
-            json_safe_rate = rate.copy()
-            json_safe_rate.update({
-                'carrier': json_safe_rate['carrier'].id,
-                'carrier_service': json_safe_rate['carrier_service'] and
-                json_safe_rate['carrier_service'].id,
-                'cost_currency': json_safe_rate['cost_currency'].id,
-            })
-
-            # Update when delivery date is not None
-            if json_safe_rate.get('delivery_date'):
-                json_safe_rate.update({
-                    'delivery_date': json_safe_rate[
-                        'delivery_date'].isoformat()
-                })
-
-            # Update when delivery time is not None
-            if json_safe_rate.get('delivery_time'):
-                json_safe_rate.update({
-                    'delivery_time': json_safe_rate[
-                        'delivery_time'].isoformat()
-                })
-
             result.append((
-                json.dumps(json_safe_rate), '%s %s %s' % (
+                RateQuote.from_rate(rate).store(), '%s %s %s' % (
                     rate['display_name'],
                     rate['cost'],
                     rate['cost_currency'].code,
@@ -329,20 +376,11 @@ class GenerateShippingLabel(Wizard):
 
     def transition_generate_labels(self):
         "Generates shipping labels from data provided by earlier states"
-        Carrier = Pool().get('carrier')
-        CarrierService = Pool().get('carrier.service')
-        Currency = Pool().get('currency.currency')
-
         if self.select_rate.rate:
-            rate = json.loads(self.select_rate.rate)
-            rate.update({
-                'carrier': Carrier(rate['carrier']),
-                'carrier_service': rate['carrier_service'] and
-                CarrierService(rate['carrier_service']),
-                'cost': Decimal(rate['cost']),
-                'cost_currency': Currency(rate['cost_currency'])
-            })
+            rate = RateQuote.from_token(self.select_rate.rate).to_rate()
             self.shipment.apply_shipping_rate(rate)
+        if self.shipment.carrier:
+            self.shipment.carrier.throttle()
         self.shipment.generate_shipping_labels()
 
         return "generate"
@@ -380,3 +418,55 @@ class GenerateShippingLabel(Wizard):
             'cost': self.shipment.cost,
             'cost_currency': self.shipment.cost_currency.id,
         }
+
+
+class GenerateShippingLabelsBatchEnd(ModelView):
+    'Generate Labels Batch End'
+    __name__ = 'shipping.label.batch.end'
+
+    generated = fields.Integer("Generated", readonly=True)
+    failed = fields.Integer("Failed", readonly=True)
+    summary = fields.Text("Summary", readonly=True)
+
+
+class GenerateShippingLabelsBatch(Wizard):
+    'Generate Labels Batch'
+    __name__ = 'shipping.label.batch'
+
+    #: Transition generating the labels of all the selected shipments, see
+    #: `generate_shipping_labels_batch`.
+    start = StateTransition()
+
+    #: State shows how many labels were generated and why the others
+    #: failed.
+    done = StateView(
+        'shipping.label.batch.end',
+        'shipping.generate_shipping_labels_batch_end_view_form',
+        [
+            Button('Ok', 'end', 'tryton-ok'),
+        ]
+    )
+
+    def transition_start(self):
+        context = Transaction().context
+        Shipment = Pool().get(context['active_model'])
+
+        shipments = Shipment.browse(context.get('active_ids') or [])
+        if not shipments:
+            Shipment.raise_user_error('no_shipments')
+
+        errors = Shipment.generate_shipping_labels_batch(shipments)
+        failed = [s for s in shipments if errors[s.id]]
+        self.done.generated = len(shipments) - len(failed)
+        self.done.failed = len(failed)
+        self.done.summary = '\n'.join(
+            '%s: %s' % (s.rec_name, errors[s.id]) for s in failed
+        )
+        return 'done'
+
+    def default_done(self, fields):
+        return {
+            'generated': self.done.generated,
+            'failed': self.done.failed,
+            'summary': self.done.summary,
+        }
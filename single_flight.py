@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+    single_flight.py
+
+    Coalescing of identical concurrent requests, within a process and
+    across the processes of a database.
+"""
+import datetime
+import hashlib
+import threading
+import time
+
+from trytond import backend
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.model import ModelSQL, fields, Unique
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['RateRequest', 'single_flight']
+
+#: Seconds between two looks at a request in flight in another process.
+POLL_INTERVAL = 0.2
+
+
+class RateRequest(ModelSQL):
+    """
+    Rate Request
+
+    A rate request in flight or recently answered. The first process to
+    insert the fingerprint does the request, the others wait for its
+    result. Expired requests are deleted by `delete_expired_cron`.
+    """
+    __name__ = 'shipping.rate_request'
+
+    fingerprint = fields.Char('Fingerprint', required=True, select=True)
+    expires = fields.DateTime('Expires', required=True)
+    result = fields.Text('Result')
+
+    @classmethod
+    def __setup__(cls):
+        super(RateRequest, cls).__setup__()
+        table = cls.__table__()
+        cls._sql_constraints += [
+            ('fingerprint_uniq', Unique(table, table.fingerprint),
+                'The fingerprint of a rate request must be unique.'),
+        ]
+
+    @classmethod
+    def delete_expired_cron(cls):
+        """
+        This is a cron method, it deletes the requests which expired.
+        """
+        cls.delete(cls.search([
+            ('expires', '<', datetime.datetime.now()),
+        ]))
+
+
+class _Flight(object):
+    "A request in flight in this process"
+    __slots__ = ('event', 'result')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _use_database():
+    """
+    Requests are coalesced across processes when the
+    `rate_single_flight_database` option of the `shipping` configuration
+    section is set, on databases other processes can reach.
+    """
+    return (
+        config.getboolean(
+            'shipping', 'rate_single_flight_database', default=False
+        ) and
+        backend.name() != 'sqlite'
+    )
+
+
+def _in_process(key, compute, timeout):
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        if flight.event.wait(timeout) and flight.result is not None:
+            return flight.result
+        return compute()
+
+    try:
+        flight.result = compute()
+        return flight.result
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.event.set()
+
+
+def _claim(fingerprint, timeout):
+    """
+    Returns True if this process inserted the request of the fingerprint
+    and must do it, expired requests are replaced.
+    """
+    RateRequest = Pool().get('shipping.rate_request')
+    DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+
+    now = datetime.datetime.now()
+    try:
+        with Transaction().new_transaction():
+            RateRequest.delete(RateRequest.search([
+                ('fingerprint', '=', fingerprint),
+                ('expires', '<', now),
+            ]))
+            RateRequest.create([{
+                'fingerprint': fingerprint,
+                'expires': now + datetime.timedelta(seconds=timeout),
+            }])
+    except (UserError, DatabaseIntegrityError):
+        return False
+    return True
+
+
+def _release(fingerprint, result, ttl):
+    "Publishes the result of the request, or forgets it without result"
+    RateRequest = Pool().get('shipping.rate_request')
+
+    with Transaction().new_transaction():
+        requests = RateRequest.search([('fingerprint', '=', fingerprint)])
+        if result is None:
+            RateRequest.delete(requests)
+        else:
+            RateRequest.write(requests, {
+                'result': result,
+                'expires': datetime.datetime.now() +
+                datetime.timedelta(seconds=ttl),
+            })
+
+
+def _wait(fingerprint, timeout):
+    """
+    Returns the result published for the fingerprint, None if the request
+    was dropped or did not answer in time.
+    """
+    RateRequest = Pool().get('shipping.rate_request')
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with Transaction().new_transaction(readonly=True):
+            requests = RateRequest.search([
+                ('fingerprint', '=', fingerprint),
+            ])
+            if not requests:
+                return None
+            if requests[0].result is not None:
+                return requests[0].result
+        time.sleep(POLL_INTERVAL)
+
+
+def _in_database(key, compute, timeout, ttl, dumps, loads):
+    fingerprint = hashlib.sha1(repr(key)).hexdigest()
+    if not _claim(fingerprint, timeout):
+        result = _wait(fingerprint, timeout)
+        if result is not None:
+            return loads(result)
+        return compute()
+
+    result = None
+    try:
+        value = compute()
+        if value:
+            result = dumps(value)
+        return value
+    finally:
+        _release(fingerprint, result, ttl)
+
+
+def single_flight(key, compute, timeout, ttl=0, dumps=None, loads=None):
+    """
+    Returns `compute()`, sharing the result between the identical
+    concurrent calls: the first call for `key` computes, the calls made
+    meanwhile wait for its result, up to `timeout` seconds, instead of
+    computing again.
+
+    Calls are coalesced within the process and, when enabled, across the
+    processes of the database through `shipping.rate_request`. There the
+    result, serialized with `dumps` and read with `loads`, stays available
+    for `ttl` seconds. Empty results are not shared across processes.
+    """
+    if dumps is not None and _use_database():
+        return _in_process(key, lambda: _in_database(
+            key, compute, timeout, ttl, dumps, loads
+        ), timeout)
+    return _in_process(key, compute, timeout)
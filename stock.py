@@ -3,12 +3,29 @@
     stock.py
 
 """
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from trytond.config import config
 from trytond.pool import PoolMeta, Pool
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 
 __metaclass__ = PoolMeta
 __all__ = ['StockMove']
 
 
+def get_weight_array_threshold():
+    """
+    Number of moves from which weights are summed with NumPy arrays, read
+    from the `weight_array_threshold` option of the `shipping`
+    configuration section.
+    """
+    return config.getint('shipping', 'weight_array_threshold', default=1000)
+
+
 class StockMove:
     "Stock move"
     __name__ = "stock.move"
@@ -21,6 +38,41 @@ class StockMove:
                 'Weight for product %s in stock move is missing',
         })
 
+    @classmethod
+    def _get_package_weight_fields(cls):
+        "Fields of the move whose change changes the weight of its package"
+        return {'package', 'product', 'quantity', 'uom'}
+
+    @staticmethod
+    def _update_package_weights(packages):
+        Package = Pool().get('stock.package')
+        Package.update_computed_weight(list(set(filter(None, packages))))
+
+    @classmethod
+    def create(cls, vlist):
+        moves = super(StockMove, cls).create(vlist)
+        cls._update_package_weights(m.package for m in moves)
+        return moves
+
+    @classmethod
+    def write(cls, *args):
+        weight_fields = cls._get_package_weight_fields()
+        actions = iter(args)
+        changed, packages = [], []
+        for moves, values in zip(actions, actions):
+            if weight_fields & set(values):
+                changed.extend(moves)
+                packages.extend(m.package for m in moves)
+        super(StockMove, cls).write(*args)
+        packages.extend(m.package for m in cls.browse(changed))
+        cls._update_package_weights(packages)
+
+    @classmethod
+    def delete(cls, moves):
+        packages = [m.package for m in moves]
+        super(StockMove, cls).delete(moves)
+        cls._update_package_weights(packages)
+
     def get_weight(self, weight_uom, silent=False):
         """
         Returns weight as required for carrier
@@ -28,12 +80,14 @@ class StockMove:
         :param weight_uom: Weight uom used by carrier
         :param silent: Raise error if not silent
         """
-        ProductUom = Pool().get('product.uom')
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        ProductUom = pool.get('product.uom')
 
         if self.quantity <= 0:
             return 0
 
-        if not self.product.weight:
+        if not self.product.canonical_weight:
             if silent:
                 return 0
             self.raise_user_error(
@@ -44,7 +98,7 @@ class StockMove:
         # Find the quantity in the default uom of the product as the weight
         # is for per unit in that uom
         if self.uom != self.product.default_uom:
-            quantity = ProductUom.compute_qty(
+            quantity = ProductUom.convert_qty(
                 self.uom,
                 self.quantity,
                 self.product.default_uom
@@ -52,15 +106,180 @@ class StockMove:
         else:
             quantity = self.quantity
 
-        weight = self.product.weight * quantity
+        # The weight is already in the uom used by carrier
+        if self.product.weight_uom == weight_uom:
+            return self.product.weight * quantity
+
+        return ProductUom.convert_qty(
+            ModelData.get_id('product', 'uom_gram'),
+            self.product.canonical_weight * quantity,
+            weight_uom
+        )
+
+    @classmethod
+    def _get_weight_rows(cls, moves):
+        """
+        Returns the rows `(id, quantity, uom, default_uom,
+        canonical_weight, weight, weight_uom)` of the moves, read with one
+        query per slice of moves
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+
+        move = cls.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        cursor = Transaction().connection.cursor()
+
+        rows = []
+        for sub_ids in grouped_slice(map(int, moves)):
+            cursor.execute(*move.join(
+                product, condition=move.product == product.id
+            ).join(
+                template, condition=product.template == template.id
+            ).select(
+                move.id, move.quantity, move.uom, template.default_uom,
+                product.canonical_weight, template.weight, template.weight_uom,
+                where=reduce_ids(move.id, sub_ids)
+            ))
+            rows.extend(cursor.fetchall())
+        return rows
+
+    @classmethod
+    def _iter_weight_rows(cls, moves, silent):
+        """
+        Yields `(id, quantity, canonical_weight, weight, weight_uom)` for
+        the moves with a weight, the quantity in the default uom of the
+        product.
+        """
+        ProductUom = Pool().get('product.uom')
+
+        for move_id, quantity, uom, default_uom, canonical_weight, weight, \
+                weight_uom in cls._get_weight_rows(moves):
+            if quantity <= 0:
+                continue
+            if not canonical_weight:
+                if not silent:
+                    cls.raise_user_error('weight_required', error_args=(
+                        cls(move_id).product.name,
+                    ))
+                continue
+            if uom != default_uom:
+                quantity = ProductUom.convert_qty(uom, quantity, default_uom)
+            yield move_id, quantity, canonical_weight, weight, weight_uom
+
+    @classmethod
+    def get_canonical_weights(cls, moves, silent=False):
+        """
+        Returns a dictionary with the weight of each move in grams, not
+        rounded, computed from rows read in bulk instead of browsing each
+        move and product.
+
+        :param moves: List of moves or of their ids
+        :param silent: Raise error if not silent
+        """
+        weights = dict((int(move), 0) for move in moves)
+        for move_id, quantity, canonical_weight, _, _ in \
+                cls._iter_weight_rows(moves, silent):
+            weights[move_id] = canonical_weight * quantity
+        return weights
+
+    @classmethod
+    def get_weights(cls, moves, weight_uom, silent=False):
+        """
+        Returns a dictionary with the weight of each move as given by
+        `get_weight`, computed from rows read in bulk instead of browsing
+        each move and product.
 
-        # Compare product weight uom with the weight uom used by carrier
-        # and calculate weight if botth are not same
-        if self.product.weight_uom.symbol != weight_uom.symbol:
-            weight = ProductUom.compute_qty(
-                self.product.weight_uom,
-                weight,
-                weight_uom
+        :param moves: List of moves or of their ids
+        :param weight_uom: Weight uom used by carrier
+        :param silent: Raise error if not silent
+        """
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        ProductUom = pool.get('product.uom')
+
+        gram = ModelData.get_id('product', 'uom_gram')
+        weights = dict((int(move), 0) for move in moves)
+        for move_id, quantity, canonical_weight, weight, product_weight_uom \
+                in cls._iter_weight_rows(moves, silent):
+            if product_weight_uom == int(weight_uom):
+                weights[move_id] = weight * quantity
+            else:
+                weights[move_id] = ProductUom.convert_qty(
+                    gram, canonical_weight * quantity, weight_uom
+                )
+        return weights
+
+    @classmethod
+    def sum_weights(cls, groups, weight_uom, silent=False):
+        """
+        Returns the list of the sums of the weights, as given by
+        `get_weight`, of each list of moves of `groups`.
+
+        From `weight_array_threshold` moves the weights are computed and
+        summed with NumPy arrays when it is installed.
+
+        :param groups: List of lists of moves or of their ids
+        :param weight_uom: Weight uom used by carrier
+        :param silent: Raise error if not silent
+        """
+        moves = [int(m) for group in groups for m in group]
+        if numpy is None or not moves or \
+                len(moves) < get_weight_array_threshold():
+            weights = cls.get_weights(moves, weight_uom, silent=silent)
+            return [sum([weights[int(m)] for m in group]) for group in groups]
+
+        weights = cls._get_weight_array(moves, weight_uom, silent)
+        labels = numpy.repeat(
+            numpy.arange(len(groups)), [len(group) for group in groups]
+        )
+        return numpy.bincount(
+            labels, weights, minlength=len(groups)
+        ).tolist()
+
+    @classmethod
+    def _get_weight_array(cls, moves, weight_uom, silent):
+        "Returns the array of the weights of the list of move ids"
+        pool = Pool()
+        ModelData = pool.get('ir.model.data')
+        ProductUom = pool.get('product.uom')
+
+        rows = cls._get_weight_rows(moves)
+        ids, quantities, uoms, default_uoms, canonical_weights, \
+            product_weights, weight_uoms = (
+                zip(*rows) if rows else ((), (), (), (), (), (), ())
             )
+        quantities = numpy.array(quantities, dtype=float)
+        canonical_weights = numpy.array(
+            [w or 0 for w in canonical_weights], dtype=float
+        )
+        valid = (quantities > 0) & (canonical_weights != 0)
+        if not silent and not valid[quantities > 0].all():
+            # Raise for the moves missing a weight
+            cls.get_canonical_weights(moves, silent=silent)
+
+        uoms = numpy.array(uoms)
+        default_uoms = numpy.array(default_uoms)
+        for uom, default_uom in set(zip(uoms[valid], default_uoms[valid])):
+            if uom == default_uom:
+                continue
+            selected = valid & (uoms == uom) & (default_uoms == default_uom)
+            quantities[selected] = ProductUom.convert_qty_array(
+                uom, quantities[selected], default_uom
+            )
+
+        weights = ProductUom.convert_qty_array(
+            ModelData.get_id('product', 'uom_gram'),
+            canonical_weights * quantities, weight_uom
+        )
+        # Weights already in the uom used by carrier are not converted
+        same = numpy.array(weight_uoms) == int(weight_uom)
+        weights[same] = numpy.array(
+            [w or 0 for w in product_weights], dtype=float
+        )[same] * quantities[same]
+        weights[~valid] = 0
 
-        return weight
+        positions = dict((move_id, i) for i, move_id in enumerate(ids))
+        return weights[[positions[move_id] for move_id in moves]]
@@ -3,14 +3,57 @@
     tests/test_shipping.py
 
 """
+import threading
+import time
 import unittest
+import datetime
+from contextlib import contextmanager
 from datetime import date
 from decimal import Decimal
 
 import trytond.tests.test_tryton
+from trytond import backend
 from trytond.tests.test_tryton import POOL, USER, with_transaction
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
+from trytond.config import config
+
+from trytond.modules.shipping import (
+    rate_table, rating, breaker, stock, packing, mixin, limiter
+)
+from trytond.modules.shipping.product import _round_array
+from trytond.modules.shipping.adapter import (
+    AdapterTimeout, CarrierAdapter, register_adapter, unregister_adapter,
+    iter_run
+)
+from trytond.modules.shipping import single_flight as flights
+from trytond.modules.shipping.single_flight import single_flight
+from trytond.modules.shipping.limiter import (
+    TokenBucket, CallBudgetExhausted, INTERACTIVE, BACKGROUND
+)
+from trytond.modules.shipping.rating import (
+    RecordRef, imap_unordered, TIMEOUT, RateQuote, _quote_handles,
+    clear_rate_cache
+)
+
+
+class ListPriceAdapter(CarrierAdapter):
+    "Rates carriers on the price of their product as their API would"
+
+    def prepare_rate(self, record, carrier, carrier_service=None):
+        return carrier.id, carrier.carrier_product.list_price
+
+    def rate(self, request):
+        return request
+
+    def parse_rate(self, record, request, response):
+        carrier, cost = response
+        return [{
+            'carrier_service': None,
+            'cost': cost,
+            'cost_currency': record.company.currency,
+            'carrier': POOL.get('carrier')(carrier),
+        }]
 
 
 class TestShipping(unittest.TestCase):
@@ -34,6 +77,8 @@ class TestShipping(unittest.TestCase):
         self.Payment_term = POOL.get('account.invoice.payment_term')
         self.Country = POOL.get('country.country')
         self.CountrySubdivision = POOL.get('country.subdivision')
+        self.CarrierZone = POOL.get('carrier.zone')
+        self.CarrierZoneLine = POOL.get('carrier.zone.line')
         self.Sale = POOL.get('sale.sale')
         self.SaleConfiguration = POOL.get('sale.configuration')
         self.Currency = POOL.get('currency.currency')
@@ -951,6 +996,2111 @@ class TestShipping(unittest.TestCase):
                 [shipment]
             )
 
+    def test_0060_concurrent_rate_fan_out(self):
+        """
+        Check results are merged in arrival order and slow calls time out
+        """
+        def rate(delay):
+            time.sleep(delay)
+            return delay
+
+        results = list(imap_unordered(rate, [0.3, 0.1, 5], 3, timeout=1))
+        self.assertEqual(results, [(0.1, 0.1), (0.3, 0.3), (5, TIMEOUT)])
+
+        def fail(item):
+            raise ValueError(item)
+
+        with self.assertRaises(ValueError):
+            list(imap_unordered(fail, [1], 1))
+
+    @with_transaction()
+    def test_0065_sale_shipping_rates(self):
+        """
+        Check rates of all the carriers are returned for a sale
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            sale, = self.Sale.create([{
+                'reference': 'S-1001',
+                'payment_term': self.payment_term.id,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+            }])
+
+            rate, = sale.get_shipping_rates(silent=True)
+            self.assertEqual(rate['carrier'], self.carrier)
+            self.assertEqual(rate['cost'], Decimal('10'))
+
+    @with_transaction()
+    def test_0070_rate_cache(self):
+        """
+        Check rates are reused until what is rated changes
+        """
+        calls = []
+
+        class CostAdapter(CarrierAdapter):
+            def prepare_rate(self, record, carrier, carrier_service=None):
+                return carrier.id
+
+            def rate(self, request):
+                calls.append(request)
+                return Decimal(len(calls))
+
+            def parse_rate(self, record, request, response):
+                return [{
+                    'carrier_service': None,
+                    'cost': response,
+                    'cost_currency': record.company.currency,
+                    'carrier': POOL.get('carrier')(request),
+                }]
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            sale, = self.Sale.create([{
+                'reference': 'S-1001',
+                'payment_term': self.payment_term.id,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+            }])
+            product = self.create_product(3, self.uom_kg)
+            sale_line, = self.SaleLine.create([{
+                'sale': sale.id,
+                'type': 'line',
+                'quantity': 1,
+                'product': product,
+                'unit_price': Decimal('10.00'),
+                'description': 'Test Description1',
+                'unit': product.template.default_uom,
+            }])
+
+            # The price of the carrier product is read at once
+            rate, = sale.quote_shipping_rate(self.carrier)
+            self.assertEqual(rate['cost'], Decimal('10'))
+            self.Template.write(
+                [self.carrier.carrier_product.template],
+                {'list_price': Decimal('12')}
+            )
+            rate, = sale.quote_shipping_rate(self.carrier)
+            self.assertEqual(rate['cost'], Decimal('12'))
+
+            # Rates asked to the carrier are reused
+            register_adapter('product', CostAdapter())
+            try:
+                rate, = sale.quote_shipping_rate(self.carrier)
+                self.assertEqual(rate['cost'], Decimal('1'))
+
+                # Nothing rated changed, the quote is reused
+                rate, = sale.quote_shipping_rate(self.carrier)
+                self.assertEqual(rate['cost'], Decimal('1'))
+                self.assertEqual(rate['carrier'], self.carrier)
+
+                # Changing the lines changes the fingerprint
+                self.SaleLine.write([sale_line], {'quantity': 2})
+                rate, = sale.quote_shipping_rate(self.carrier)
+                self.assertEqual(rate['cost'], Decimal('2'))
+
+                # Changing the carrier clears the cache
+                self.Carrier.write([self.carrier], {'active': True})
+                rate, = sale.quote_shipping_rate(self.carrier)
+                self.assertEqual(rate['cost'], Decimal('3'))
+            finally:
+                unregister_adapter('product')
+                clear_rate_cache()
+
+    @with_transaction()
+    def test_0075_shipping_rates_batch(self):
+        """
+        Check many shipments are rated in one call
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            warehouse = self.StockLocation.search([
+                ('type', '=', 'warehouse')
+            ])[0]
+            shipments = self.Shipment.create([{
+                'planned_date': date.today(),
+                'customer': self.sale_party.id,
+                'warehouse': warehouse,
+                'delivery_address': self.sale_party.addresses[0],
+            } for i in range(3)])
+
+            rates = self.Shipment.get_shipping_rates_batch(
+                shipments, [self.carrier]
+            )
+            self.assertEqual(set(rates), set(map(int, shipments)))
+            for shipment in shipments:
+                rate, = rates[shipment.id]
+                self.assertEqual(rate['carrier'], self.carrier)
+                self.assertEqual(rate['cost'], Decimal('10'))
+
+    @with_transaction()
+    def test_0080_apply_shipping_rates_by_policy(self):
+        """
+        Check rates are picked by policy and applied in bulk
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            warehouse = self.StockLocation.search([
+                ('type', '=', 'warehouse')
+            ])[0]
+            shipments = self.Shipment.create([{
+                'planned_date': date.today(),
+                'customer': self.sale_party.id,
+                'warehouse': warehouse,
+                'delivery_address': self.sale_party.addresses[0],
+            } for i in range(2)])
+
+            picked = self.Shipment.apply_shipping_rates_by_policy(
+                shipments, 'cheapest', [self.carrier]
+            )
+            for shipment in shipments:
+                self.assertEqual(picked[shipment.id]['carrier'], self.carrier)
+                self.assertEqual(shipment.carrier, self.carrier)
+                self.assertEqual(shipment.cost, Decimal('10'))
+                self.assertEqual(shipment.cost_currency, self.company.currency)
+
+            with self.assertRaises(UserError):
+                self.Shipment.apply_shipping_rates_by_policy(
+                    shipments, 'unknown'
+                )
+
+            other_carrier, = self.Carrier.copy([self.carrier])
+            currency = self.company.currency
+            cheap, preferred, fast = rates = [{
+                'carrier': self.carrier,
+                'cost': Decimal('10'),
+                'cost_currency': currency,
+            }, {
+                'carrier': other_carrier,
+                'cost': Decimal('10.5'),
+                'cost_currency': currency,
+                'delivery_date': date(2016, 1, 3),
+            }, {
+                'carrier': other_carrier,
+                'cost': Decimal('20'),
+                'cost_currency': currency,
+                'delivery_date': date(2016, 1, 2),
+            }]
+
+            self.assertIs(
+                self.Shipment._pick_rate_cheapest(rates, currency), cheap
+            )
+            self.assertIs(
+                self.Shipment._pick_rate_fastest(rates, currency), fast
+            )
+            self.assertIs(
+                self.Shipment._pick_rate_fastest(
+                    rates, currency, max_cost=Decimal('15')
+                ), preferred
+            )
+            self.assertIs(
+                self.Shipment._pick_rate_preferred(
+                    rates, currency, preferred_carrier=other_carrier,
+                    tolerance=10
+                ), preferred
+            )
+            self.assertIs(
+                self.Shipment._pick_rate_preferred(
+                    rates, currency, preferred_carrier=other_carrier,
+                    tolerance=1
+                ), cheap
+            )
+            self.assertIsNone(
+                self.Shipment._pick_rate_cheapest([], currency)
+            )
+
+    @with_transaction()
+    def test_0085_active_carriers(self):
+        """
+        Check the active carriers are cached until carriers change
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            self.assertEqual(
+                self.Carrier.get_active_carriers(), [self.carrier]
+            )
+
+            other_carrier, = self.Carrier.copy([self.carrier])
+            self.assertEqual(
+                self.Carrier.get_active_carriers(),
+                [self.carrier, other_carrier]
+            )
+
+            self.Carrier.write([self.carrier], {'active': False})
+            self.assertEqual(
+                self.Carrier.get_active_carriers(), [other_carrier]
+            )
+
+    @with_transaction()
+    def test_0090_rate_quote(self):
+        """
+        Check rates round trip through quotes and their tokens
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            rate = {
+                'display_name': 'Ground',
+                'carrier': self.carrier,
+                'carrier_service': None,
+                'cost': Decimal('10.25'),
+                'cost_currency': self.company.currency,
+                'delivery_date': date(2016, 1, 2),
+            }
+            quote = RateQuote.from_rate(rate)
+            self.assertEqual(quote.carrier, self.carrier.id)
+            with self.assertRaises(AttributeError):
+                quote.cost = Decimal('0')
+
+            token = quote.store()
+            self.assertEqual(RateQuote.from_token(token), quote)
+            self.assertEqual(RateQuote.from_token(token).to_rate(), rate)
+
+            self.assertEqual(len(token.split(':')), 5)
+
+            # The essentials survive a lost handle
+            _quote_handles.clear()
+            rate = RateQuote.from_token(token).to_rate()
+            self.assertEqual(rate['carrier'], self.carrier)
+            self.assertEqual(rate['cost'], Decimal('10.25'))
+            self.assertEqual(rate['cost_currency'], self.company.currency)
+            self.assertEqual(rate['display_name'], self.carrier.rec_name)
+
+    @with_transaction()
+    def test_0095_rate_table(self):
+        """
+        Check carriers are rated from their zones and weight breaks
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            address = self.sale_party.addresses[0]
+            currency = self.company.currency
+            miami, florida, country = self.CarrierZone.create([{
+                'carrier': self.carrier.id,
+                'name': 'Miami',
+                'lines': [('create', [{
+                    'country': address.country.id,
+                    'zip_prefix': '331',
+                }])],
+            }, {
+                'carrier': self.carrier.id,
+                'name': 'Florida',
+                'lines': [('create', [{
+                    'country': address.country.id,
+                    'subdivision': address.subdivision.id,
+                }])],
+            }, {
+                'carrier': self.carrier.id,
+                'name': 'United States',
+                'lines': [('create', [{
+                    'country': address.country.id,
+                }])],
+            }])
+            self.Carrier.write([self.carrier], {
+                'use_rate_table': True,
+                'weight_breaks': [('create', [{
+                    'zone': zone.id,
+                    'weight': weight,
+                    'weight_uom': uom.id,
+                    'price': Decimal(price),
+                    'currency': currency.id,
+                } for zone, weight, uom, price in [
+                    (miami, 1, self.uom_kg, '5'),
+                    (miami, 5, self.uom_kg, '8'),
+                    (florida, 10, self.uom_pound, '9'),
+                    (country, 100, self.uom_pound, '20'),
+                ]])],
+            })
+
+            table = self.carrier.get_rate_table()
+            self.assertEqual(
+                table.find_zone(address.country.id, None, '33137'), miami.id
+            )
+            self.assertEqual(
+                table.find_zone(
+                    address.country.id, address.subdivision.id, '32003'
+                ), florida.id
+            )
+            self.assertEqual(
+                table.find_zone(address.country.id, None, '10001'),
+                country.id
+            )
+            self.assertIsNone(table.find_zone(-1, None, '33137'))
+
+            sale, = self.Sale.create([{
+                'reference': 'S-1001',
+                'payment_term': self.payment_term.id,
+                'party': self.sale_party.id,
+                'invoice_address': address.id,
+                'shipment_address': address.id,
+            }])
+            product = self.create_product(3, self.uom_kg)
+            self.SaleLine.create([{
+                'sale': sale.id,
+                'type': 'line',
+                'quantity': 1,
+                'product': product,
+                'unit_price': Decimal('10.00'),
+                'description': 'Test Description1',
+                'unit': product.template.default_uom,
+            }])
+
+            rate, = sale.get_shipping_rate(self.carrier)
+            self.assertEqual(rate['cost'], Decimal('8'))
+            self.assertEqual(rate['cost_currency'], currency)
+            self.assertEqual(rate['carrier'], self.carrier)
+
+            # Changing the zones rebuilds the table
+            self.CarrierZoneLine.write(list(miami.lines), {
+                'zip_prefix': '999',
+            })
+            rate, = sale.get_shipping_rate(self.carrier)
+            self.assertEqual(rate['cost'], Decimal('9'))
+
+            # Too heavy for every break of the zone
+            self.SaleLine.write(list(sale.lines), {'quantity': 2})
+            self.assertEqual(sale.get_shipping_rate(self.carrier), [])
+
+            # Rate tables do not use the API call budget
+            self.SaleLine.write(list(sale.lines), {'quantity': 1})
+            self.Carrier.write([self.carrier], {
+                'api_calls_per_second': 0.001,
+                'api_call_burst': 1,
+            })
+            if not config.has_section('shipping'):
+                config.add_section('shipping')
+            config.set('shipping', 'rate_timeout', '0')
+            try:
+                for i in range(3):
+                    rate, = sale.quote_shipping_rate(self.carrier)
+                    self.assertEqual(rate['cost'], Decimal('9'))
+            finally:
+                config.remove_option('shipping', 'rate_timeout')
+
+    @with_transaction()
+    def test_0100_rate_table_bulk(self):
+        """
+        Check shipments are priced from the rate table in bulk
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            address = self.sale_party.addresses[0]
+            currency = self.company.currency
+            other_address, = self.Address.create([{
+                'party': self.sale_party.id,
+                'name': 'Jane Doe',
+                'street': '1 Main Street',
+                'zip': '32003',
+                'city': 'Fleming Island',
+                'country': address.country.id,
+                'subdivision': address.subdivision.id,
+            }])
+            miami, florida = self.CarrierZone.create([{
+                'carrier': self.carrier.id,
+                'name': 'Miami',
+                'lines': [('create', [{
+                    'country': address.country.id,
+                    'zip_prefix': '331',
+                }])],
+            }, {
+                'carrier': self.carrier.id,
+                'name': 'Florida',
+                'lines': [('create', [{
+                    'country': address.country.id,
+                    'subdivision': address.subdivision.id,
+                }])],
+            }])
+            self.Carrier.write([self.carrier], {
+                'use_rate_table': True,
+                'rate_surcharge': Decimal('10'),
+                'weight_breaks': [('create', [{
+                    'zone': zone.id,
+                    'weight': 10,
+                    'weight_uom': self.uom_kg.id,
+                    'price': Decimal(price),
+                    'currency': currency.id,
+                } for zone, price in [(miami, '5'), (florida, '9')]])],
+            })
+
+            warehouse = self.StockLocation.search([
+                ('type', '=', 'warehouse')
+            ])[0]
+            shipments = self.Shipment.create([{
+                'planned_date': date.today(),
+                'customer': self.sale_party.id,
+                'warehouse': warehouse,
+                'delivery_address': delivery_address,
+            } for delivery_address in [address, other_address, address]])
+
+            rates = self.Shipment.get_shipping_rates_batch(
+                shipments, [self.carrier]
+            )
+            self.assertEqual(
+                [rates[s.id][0]['cost'] for s in shipments],
+                [Decimal('5.50'), Decimal('9.90'), Decimal('5.50')]
+            )
+            for shipment in shipments:
+                self.assertEqual(
+                    rates[shipment.id],
+                    shipment.get_shipping_rate(self.carrier)
+                )
+
+            # Without NumPy the breaks are searched one weight at a time
+            numpy, rate_table.numpy = rate_table.numpy, None
+            try:
+                self.assertEqual(
+                    self.Shipment.get_shipping_rates_batch(
+                        shipments, [self.carrier]
+                    ), rates
+                )
+            finally:
+                rate_table.numpy = numpy
+
+            self.Shipment.apply_shipping_rates_by_policy(
+                shipments, 'cheapest', [self.carrier]
+            )
+            self.assertEqual(
+                [(s.cost, s.cost_currency) for s in shipments],
+                [(Decimal('5.50'), currency), (Decimal('9.90'), currency),
+                    (Decimal('5.50'), currency)]
+            )
+
+    @with_transaction()
+    def test_0105_iter_shipping_rates(self):
+        """
+        Check rates are yielded carrier by carrier
+        """
+        ApplyShipping = POOL.get('sale.sale.apply_shipping', type='wizard')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            sale, = self.Sale.create([{
+                'reference': 'S-1001',
+                'payment_term': self.payment_term.id,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+            }])
+            other_carrier, = self.Carrier.copy([self.carrier])
+
+            results = list(sale.iter_shipping_rates(
+                [self.carrier, other_carrier]
+            ))
+            self.assertEqual(
+                [carrier for carrier, rates in results],
+                [self.carrier, other_carrier]
+            )
+            for carrier, (rate,) in results:
+                self.assertEqual(rate['carrier'], carrier)
+                self.assertEqual(rate['cost'], Decimal('10'))
+
+            session_id, start_state, end_state = ApplyShipping.create()
+            with Transaction().set_context(active_id=sale.id):
+                result = ApplyShipping.execute(session_id, {
+                    'start': {
+                        'carrier': None,
+                        'carrier_service': None,
+                        'weight': 0,
+                    },
+                }, 'get_rates')
+            defaults = result['view']['defaults']
+            self.assertEqual(result['view']['state'], 'select_rate')
+            self.assertFalse(defaults['pending_carriers'])
+            self.assertEqual(
+                RateQuote.from_token(defaults['rate']).cost, Decimal('10')
+            )
+
+    @with_transaction()
+    def test_0110_async_adapter(self):
+        """
+        Check carriers are rated through their adapter
+        """
+        class ProductAdapter(CarrierAdapter):
+            def prepare_rate(self, record, carrier, carrier_service=None):
+                return {'carrier': carrier.id, 'weight': record.weight}
+
+            def rate(self, request):
+                return Decimal('7')
+
+            def parse_rate(self, record, request, response):
+                return [{
+                    'display_name': 'Adapter',
+                    'carrier_service': None,
+                    'cost': response,
+                    'cost_currency': record.company.currency,
+                    'carrier': POOL.get('carrier')(request['carrier']),
+                }]
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            sale, = self.Sale.create([{
+                'reference': 'S-1001',
+                'payment_term': self.payment_term.id,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+            }])
+            register_adapter('product', ProductAdapter())
+            try:
+                rate, = sale.get_shipping_rate(self.carrier)
+                self.assertEqual(rate['cost'], Decimal('7'))
+
+                (carrier, (rate,)), = sale.iter_shipping_rates(
+                    [self.carrier]
+                )
+                self.assertEqual(carrier, self.carrier)
+                self.assertEqual(rate['cost'], Decimal('7'))
+            finally:
+                unregister_adapter('product')
+
+    def test_0111_adapter_iter_run(self):
+        """
+        Check the calls of an adapter run together and fail separately
+        """
+        release = threading.Event()
+
+        class EchoAdapter(CarrierAdapter):
+            def prepare_track(self, record):
+                if record == 'bad':
+                    raise ValueError(record)
+                return record
+
+            def track(self, request):
+                if request == 'slow':
+                    release.wait(5)
+                return request.upper()
+
+            def parse_track(self, record, request, response):
+                return response
+
+        calls = [('a',), ('bad',), ('slow',), ('b',)]
+        try:
+            results = list(iter_run(EchoAdapter(), 'track', calls, 0.5))
+        finally:
+            release.set()
+
+        self.assertEqual(
+            sorted((a, r) for a, r, e in results if e is None),
+            [(('a',), 'A'), (('b',), 'B')]
+        )
+        errors = dict((a, e) for a, r, e in results if e is not None)
+        self.assertIsInstance(errors[('bad',)], ValueError)
+        self.assertIsInstance(errors[('slow',)], AdapterTimeout)
+        self.assertEqual(results[-1][0], ('slow',))
+
+        # Calls are sent before the results are iterated
+        sent, unblock = threading.Event(), threading.Event()
+
+        class WaitAdapter(EchoAdapter):
+            def track(self, request):
+                sent.set()
+                unblock.wait(5)
+                return request.upper()
+
+        try:
+            run = iter_run(WaitAdapter(), 'track', [('a',)], 5)
+            self.assertTrue(sent.wait(2))
+            self.assertEqual(list(run.ready()), [])
+        finally:
+            unblock.set()
+        self.assertEqual(list(run), [(('a',), 'A', None)])
+
+        # An operation is supported with its three methods only
+        class HalfAdapter(CarrierAdapter):
+            def track(self, request):
+                return request
+
+        self.assertTrue(EchoAdapter().supports('track'))
+        self.assertFalse(HalfAdapter().supports('track'))
+        self.assertFalse(EchoAdapter().supports('label'))
+
+    def test_0112_adapter_throttle(self):
+        """
+        Check the throttle of a call runs in the thread sending it
+        """
+        class EchoAdapter(CarrierAdapter):
+            def prepare_track(self, record):
+                return record
+
+            def track(self, request):
+                return request.upper()
+
+            def parse_track(self, record, request, response):
+                return response
+
+        threads = []
+
+        def throttle(record):
+            if record == 'b':
+                return lambda: threads.append(threading.current_thread())
+
+        def refuse(record):
+            def refuse():
+                raise UserError('Budget exhausted')
+            return refuse
+
+        self.assertEqual(list(iter_run(
+            EchoAdapter(), 'track', [('b',)], 5, throttle=throttle
+        )), [(('b',), 'B', None)])
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertEqual(len(threads), 1)
+        (args, result, error), = iter_run(
+            EchoAdapter(), 'track', [('a',)], 5, throttle=refuse
+        )
+        self.assertIsInstance(error, UserError)
+
+    def test_0115_single_flight(self):
+        """
+        Check identical concurrent requests are done once
+        """
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return (RateQuote(1, None, Decimal('10'), 1),)
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(
+                    single_flight('key', compute, 5)
+                )
+            ) for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(results)), 1)
+
+        # Once answered, the next request is done again
+        single_flight('key', compute, 5)
+        self.assertEqual(len(calls), 2)
+
+        quotes = (
+            RateQuote(1, 2, Decimal('10.5'), 3, u'Ground', (
+                ('delivery_date', date(2016, 1, 2)),
+                ('tracking', RecordRef('shipment.tracking', 4)),
+            )),
+            RateQuote(1, None, Decimal('3'), 3),
+        )
+        self.assertEqual(RateQuote.loads(RateQuote.dumps(quotes)), quotes)
+
+    @with_transaction()
+    def test_0116_delete_expired_rate_requests(self):
+        """
+        Check the expired rate requests are deleted
+        """
+        RateRequest = POOL.get('shipping.rate_request')
+
+        now = datetime.datetime.now()
+        expired, current = RateRequest.create([{
+            'fingerprint': 'expired',
+            'expires': now - datetime.timedelta(seconds=1),
+            'result': '[]',
+        }, {
+            'fingerprint': 'current',
+            'expires': now + datetime.timedelta(hours=1),
+        }])
+
+        RateRequest.delete_expired_cron()
+        self.assertEqual(RateRequest.search([]), [current])
+
+    @with_transaction()
+    def test_0117_single_flight_database(self):
+        """
+        Check requests are coalesced across processes through the database
+        """
+        RateRequest = POOL.get('shipping.rate_request')
+        transaction = Transaction()
+
+        class Backend(object):
+            "Backend of a database the other processes reach"
+            name = staticmethod(lambda: 'postgresql')
+            get = staticmethod(backend.get)
+
+        class OtherTransaction(object):
+            "The transactions of the other processes are the test one"
+            @staticmethod
+            @contextmanager
+            def new_transaction(readonly=False):
+                before = RateRequest.search([])
+                try:
+                    yield transaction
+                except Exception:
+                    # Roll back the requests created
+                    RateRequest.delete([
+                        r for r in RateRequest.search([]) if r not in before
+                    ])
+                    raise
+
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return answer
+
+        def request():
+            return single_flight(
+                'key', compute, 1, 60, RateQuote.dumps, RateQuote.loads
+            )
+
+        answer = (RateQuote(1, None, Decimal('10'), 1),)
+        if not config.has_section('shipping'):
+            config.add_section('shipping')
+        config.set('shipping', 'rate_single_flight_database', 'True')
+        flights.backend = Backend
+        flights.Transaction = lambda: OtherTransaction
+        try:
+            # The first request is done and publishes its result
+            self.assertEqual(request(), answer)
+            published, = RateRequest.search([])
+            self.assertEqual(RateQuote.loads(published.result), answer)
+
+            # The next ones read it instead
+            self.assertEqual(request(), answer)
+            self.assertEqual(len(calls), 1)
+
+            # Expired requests are done again
+            RateRequest.write([published], {
+                'expires': datetime.datetime.now() -
+                datetime.timedelta(seconds=1),
+            })
+            self.assertEqual(request(), answer)
+            self.assertEqual(len(calls), 2)
+
+            # Empty results are not published
+            RateRequest.delete(RateRequest.search([]))
+            answer = ()
+            self.assertEqual(request(), ())
+            self.assertEqual(len(calls), 3)
+            self.assertEqual(RateRequest.search([]), [])
+        finally:
+            flights.backend = backend
+            flights.Transaction = Transaction
+            config.remove_option('shipping', 'rate_single_flight_database')
+
+    def test_0120_token_bucket(self):
+        """
+        Check calls are budgeted and interactive ones go first
+        """
+        bucket = TokenBucket(10, 2)
+        self.assertTrue(bucket.acquire(timeout=0))
+        self.assertTrue(bucket.acquire(timeout=0))
+        self.assertFalse(bucket.acquire(timeout=0))
+        self.assertTrue(bucket.acquire(timeout=1))
+
+        bucket = TokenBucket(5, 1)
+        bucket.acquire()
+        order = []
+
+        def call(priority):
+            bucket.acquire(priority, timeout=2)
+            order.append(priority)
+
+        background = threading.Thread(target=call, args=(BACKGROUND,))
+        background.start()
+        time.sleep(0.05)
+        interactive = threading.Thread(target=call, args=(INTERACTIVE,))
+        interactive.start()
+        background.join()
+        interactive.join()
+        self.assertEqual(order, [INTERACTIVE, BACKGROUND])
+
+    @with_transaction()
+    def test_0125_carrier_throttle(self):
+        """
+        Check carriers refuse calls beyond their API budget
+        """
+        self.setup_defaults()
+
+        # Carriers without limit are not throttled
+        for i in range(5):
+            self.carrier.throttle()
+
+        self.Carrier.write([self.carrier], {
+            'api_calls_per_second': 0.001,
+            'api_call_burst': 1,
+        })
+        if not config.has_section('shipping'):
+            config.add_section('shipping')
+        config.set('shipping', 'rate_timeout', '0')
+        try:
+            self.carrier.throttle()
+            with self.assertRaises(UserError):
+                self.carrier.throttle()
+            self.assertIn(
+                (Transaction().database.name, ('carrier', self.carrier.id)),
+                limiter._buckets
+            )
+
+            # The budget is taken by the thread making the call
+            throttle, errors = self.carrier.get_throttle(), []
+
+            def call():
+                try:
+                    throttle()
+                except UserError as exc:
+                    errors.append(exc)
+
+            thread = threading.Thread(target=call)
+            thread.start()
+            thread.join()
+            self.assertIsInstance(errors[0], CallBudgetExhausted)
+
+            # Silent requests skip the carrier
+            with Transaction().set_context(company=self.company.id):
+                sale, = self.Sale.create([{
+                    'reference': 'S-1001',
+                    'payment_term': self.payment_term.id,
+                    'party': self.sale_party.id,
+                    'invoice_address': self.sale_party.addresses[0].id,
+                    'shipment_address': self.sale_party.addresses[0].id,
+                }])
+                self.assertEqual(
+                    sale.quote_shipping_rate(self.carrier, silent=True), []
+                )
+                self.assertEqual(
+                    list(sale.iter_shipping_rates([self.carrier], True)),
+                    [(self.carrier, TIMEOUT)]
+                )
+                with self.assertRaises(CallBudgetExhausted):
+                    sale.quote_shipping_rate(self.carrier)
+        finally:
+            config.remove_option('shipping', 'rate_timeout')
+            clear_rate_cache()
+
+    @with_transaction()
+    def test_0130_circuit_breaker(self):
+        """
+        Check failing carriers are isolated and served stale rates
+        """
+        CarrierLog = POOL.get('carrier.log')
+
+        self.setup_defaults()
+
+        calls = []
+        get_shipping_rate = self.Sale.get_shipping_rate
+
+        def fail(sale, carrier, carrier_service=None, silent=False):
+            calls.append(carrier)
+            raise IOError('Connection refused')
+
+        if not config.has_section('shipping'):
+            config.add_section('shipping')
+        config.set('shipping', 'breaker_failures', '2')
+        config.set('shipping', 'breaker_reset', '0.2')
+        register_adapter('product', ListPriceAdapter())
+        try:
+            with Transaction().set_context(company=self.company.id):
+                sale, = self.Sale.create([{
+                    'reference': 'S-1001',
+                    'payment_term': self.payment_term.id,
+                    'party': self.sale_party.id,
+                    'invoice_address': self.sale_party.addresses[0].id,
+                    'shipment_address': self.sale_party.addresses[0].id,
+                }])
+                rate, = sale.quote_shipping_rate(self.carrier)
+                self.assertNotIn('stale', rate)
+
+                clear_rate_cache()
+                self.Sale.get_shipping_rate = fail
+                for i in range(2):
+                    with self.assertRaises(IOError):
+                        sale.quote_shipping_rate(self.carrier)
+                self.assertEqual(
+                    breaker.get_circuit_state(self.carrier), breaker.OPEN
+                )
+                self.assertEqual(breaker._circuits.keys(), [
+                    (Transaction().database.name, self.carrier.id)
+                ])
+
+                # The open circuit serves the last rates without calling
+                rate, = sale.quote_shipping_rate(self.carrier)
+                self.assertTrue(rate['stale'])
+                self.assertEqual(rate['cost'], Decimal('10'))
+                self.assertEqual(len(calls), 2)
+
+                # A failed trial call opens the circuit again
+                time.sleep(0.25)
+                with self.assertRaises(IOError):
+                    sale.quote_shipping_rate(self.carrier)
+                self.assertEqual(len(calls), 3)
+                self.assertEqual(
+                    breaker.get_circuit_state(self.carrier), breaker.OPEN
+                )
+
+                # A successful trial call closes it
+                time.sleep(0.25)
+                self.Sale.get_shipping_rate = get_shipping_rate
+                rate, = sale.quote_shipping_rate(self.carrier)
+                self.assertNotIn('stale', rate)
+                self.assertEqual(
+                    breaker.get_circuit_state(self.carrier), breaker.CLOSED
+                )
+
+                self.assertEqual([
+                    log.log.split(',')[0] for log in CarrierLog.search(
+                        [('carrier', '=', self.carrier.id)],
+                        order=[('id', 'ASC')]
+                    )
+                ], [
+                    'Circuit opened after 2 failures',
+                    'Circuit half-open',
+                    'Circuit opened after 3 failures',
+                    'Circuit half-open',
+                    'Circuit closed',
+                ])
+        finally:
+            self.Sale.get_shipping_rate = get_shipping_rate
+            unregister_adapter('product')
+            breaker._circuits.clear()
+            clear_rate_cache()
+            config.remove_option('shipping', 'breaker_failures')
+            config.remove_option('shipping', 'breaker_reset')
+
+    @with_transaction()
+    def test_0131_circuit_breaker_single_flight(self):
+        """
+        Check the trial call of a half-open circuit always ends it
+        """
+        self.setup_defaults()
+
+        if not config.has_section('shipping'):
+            config.add_section('shipping')
+        config.set('shipping', 'breaker_failures', '1')
+        config.set('shipping', 'breaker_reset', '0')
+        register_adapter('product', ListPriceAdapter())
+        try:
+            with Transaction().set_context(company=self.company.id):
+                sale, = self.Sale.create([{
+                    'reference': 'S-1001',
+                    'payment_term': self.payment_term.id,
+                    'party': self.sale_party.id,
+                    'invoice_address': self.sale_party.addresses[0].id,
+                    'shipment_address': self.sale_party.addresses[0].id,
+                }])
+                answer = (RateQuote(
+                    self.carrier.id, None, Decimal('12'),
+                    self.company.currency.id,
+                ),)
+
+                # Answered by an identical request of another worker
+                breaker.record_failure(self.carrier, 'down')
+                rating.single_flight = lambda key, compute, *args: answer
+                rate, = sale.quote_shipping_rate(self.carrier)
+                self.assertEqual(rate['cost'], Decimal('12'))
+                self.assertEqual(
+                    breaker.get_circuit_state(self.carrier), breaker.CLOSED
+                )
+
+                # Not answered by the identical request
+                clear_rate_cache()
+                breaker.record_failure(self.carrier, 'down')
+
+                def no_answer(key, compute, *args):
+                    raise IOError('Lost the rate request')
+
+                rating.single_flight = no_answer
+                with self.assertRaises(IOError):
+                    sale.quote_shipping_rate(self.carrier)
+                rating.single_flight = single_flight
+                self.assertEqual(
+                    breaker.get_circuit_state(self.carrier), breaker.OPEN
+                )
+
+                # Not called, the carrier is out of budget
+                def throttle(carrier):
+                    raise UserError('Budget exhausted')
+
+                self.Carrier.throttle = throttle
+                with self.assertRaises(UserError):
+                    sale.quote_shipping_rate(self.carrier)
+                del self.Carrier.throttle
+                self.assertEqual(
+                    breaker.get_circuit_state(self.carrier), breaker.OPEN
+                )
+                rate, = sale.quote_shipping_rate(self.carrier)
+                self.assertNotIn('stale', rate)
+                self.assertEqual(
+                    breaker.get_circuit_state(self.carrier), breaker.CLOSED
+                )
+        finally:
+            rating.single_flight = single_flight
+            unregister_adapter('product')
+            if 'throttle' in vars(self.Carrier):
+                del self.Carrier.throttle
+            breaker._circuits.clear()
+            clear_rate_cache()
+            config.remove_option('shipping', 'breaker_failures')
+            config.remove_option('shipping', 'breaker_reset')
+
+    @with_transaction()
+    def test_0135_pre_rate_sales(self):
+        """
+        Check quotations are rated ahead of the apply shipping wizard
+        """
+        ApplyShipping = POOL.get('sale.sale.apply_shipping', type='wizard')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            product = self.create_product(2, self.uom_kg)
+            sale, = self.Sale.create([{
+                'reference': 'S-1001',
+                'payment_term': self.payment_term.id,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 1,
+                    'product': product.id,
+                    'unit_price': Decimal('10.00'),
+                    'description': 'Test Description1',
+                    'unit': product.template.default_uom.id,
+                }])],
+            }])
+            self.assertFalse(sale.rating_pending)
+
+            self.Sale.quote([sale])
+            self.assertTrue(sale.rating_pending)
+
+        # The cron runs without company in the context
+        self.Sale.pre_rate_sales_cron()
+
+        with Transaction().set_context(company=self.company.id):
+            sale = self.Sale(sale.id)
+            self.assertFalse(sale.rating_pending)
+            shipping_rate, = sale.shipping_rates
+            self.assertEqual(shipping_rate.carrier, self.carrier)
+
+            rates, stale = sale.get_stored_shipping_rates([self.carrier])
+            self.assertEqual(stale, [])
+            self.assertEqual(
+                [(r['carrier'], r['cost']) for r in rates],
+                [(self.carrier, Decimal('10'))]
+            )
+
+            # The wizard serves the stored rates without calling carriers
+            clear_rate_cache()
+            get_shipping_rate = self.Sale.get_shipping_rate
+            self.Sale.get_shipping_rate = None
+            try:
+                session_id, start_state, end_state = ApplyShipping.create()
+                with Transaction().set_context(active_id=sale.id):
+                    result = ApplyShipping.execute(session_id, {
+                        'start': {
+                            'carrier': None,
+                            'carrier_service': None,
+                            'weight': 0,
+                        },
+                    }, 'get_rates')
+            finally:
+                self.Sale.get_shipping_rate = get_shipping_rate
+            self.assertEqual(
+                RateQuote.from_token(result['view']['defaults']['rate']).cost,
+                Decimal('10')
+            )
+
+            # Changing the lines queues the sale and stales its rates
+            self.SaleLine.write(list(sale.lines), {'quantity': 2})
+            sale = self.Sale(sale.id)
+            self.assertTrue(sale.rating_pending)
+            self.assertEqual(
+                sale.get_stored_shipping_rates([self.carrier]),
+                ([], [self.carrier])
+            )
+
+        self.Sale.pre_rate_sales_cron()
+
+        with Transaction().set_context(company=self.company.id):
+            sale = self.Sale(sale.id)
+            self.assertFalse(sale.rating_pending)
+            self.assertEqual(len(sale.shipping_rates), 1)
+            rates, stale = sale.get_stored_shipping_rates([self.carrier])
+            self.assertEqual(len(rates), 1)
+            self.assertEqual(stale, [])
+
+            # Stored rates expire
+            if not config.has_section('shipping'):
+                config.add_section('shipping')
+            config.set('shipping', 'rate_store_ttl', '0')
+            try:
+                self.assertEqual(
+                    sale.get_stored_shipping_rates([self.carrier]),
+                    ([], [self.carrier])
+                )
+            finally:
+                config.remove_option('shipping', 'rate_store_ttl')
+
+    @with_transaction()
+    def test_0136_pre_rate_sales_incomplete(self):
+        """
+        Check sales not fully rated stay queued for the next run
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            sale, = self.Sale.create([{
+                'reference': 'S-1001',
+                'payment_term': self.payment_term.id,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+            }])
+            self.Sale.quote([sale])
+
+        def throttle(carrier):
+            raise UserError('Budget exhausted')
+
+        if not config.has_section('shipping'):
+            config.add_section('shipping')
+        config.set('shipping', 'breaker_failures', '1')
+        try:
+            # The circuit of the carrier is open
+            breaker.record_failure(self.carrier, 'down')
+            self.Sale.pre_rate_sales_cron()
+            self.assertTrue(self.Sale(sale.id).rating_pending)
+            self.assertFalse(self.Sale(sale.id).shipping_rates)
+            breaker._circuits.clear()
+
+            # A failing sale does not stop the run
+            self.Carrier.throttle = throttle
+            self.Sale.pre_rate_sales_cron()
+            self.assertTrue(self.Sale(sale.id).rating_pending)
+            del self.Carrier.throttle
+
+            self.Sale.pre_rate_sales_cron()
+            self.assertFalse(self.Sale(sale.id).rating_pending)
+            self.assertTrue(self.Sale(sale.id).shipping_rates)
+        finally:
+            if 'throttle' in vars(self.Carrier):
+                del self.Carrier.throttle
+            breaker._circuits.clear()
+            clear_rate_cache()
+            config.remove_option('shipping', 'breaker_failures')
+
+    @with_transaction()
+    def test_0140_bulk_weights(self):
+        """
+        Check weights computed in bulk match those of each move
+        """
+        Move = POOL.get('stock.move')
+
+        self.setup_defaults()
+        uom_gram, = self.Uom.search([('symbol', '=', 'g')])
+
+        with Transaction().set_context(company=self.company.id):
+            products = [
+                (self.create_product(0.5, self.uom_kg), self.uom_pound),
+                (self.create_product(3, self.uom_kg), self.uom_kg),
+                (self.create_product(250, uom_gram), uom_gram),
+                (self.create_product(), self.uom_kg),
+            ]
+            sale, = self.Sale.create([{
+                'reference': 'S-1001',
+                'payment_term': self.payment_term.id,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 3,
+                    'product': product.id,
+                    'unit_price': Decimal('10.00'),
+                    'description': 'Test Description1',
+                    'unit': unit.id,
+                } for product, unit in products])],
+            }])
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+            shipment, = sale.shipments
+
+            moves = shipment.outgoing_moves + shipment.inventory_moves
+            for weight_uom in (self.uom_kg, self.uom_pound, uom_gram):
+                self.assertEqual(
+                    Move.get_weights(moves, weight_uom, silent=True),
+                    dict(
+                        (m.id, m.get_weight(weight_uom, silent=True))
+                        for m in moves
+                    )
+                )
+
+            # Moves without weight are reported when not silent
+            with self.assertRaises(UserError):
+                Move.get_weights(moves, self.uom_kg)
+
+            self.assertEqual(
+                self.Shipment.get_weight([shipment])[shipment.id],
+                sum(
+                    m.get_weight(shipment.weight_uom, silent=True)
+                    for m in shipment.inventory_moves
+                )
+            )
+
+    @with_transaction()
+    def test_0145_stored_package_weight(self):
+        """
+        Check the stored package weight follows moves and products
+        """
+        Move = POOL.get('stock.move')
+
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            product = self.create_product(1, self.uom_kg)
+            other_product = self.create_product(2, self.uom_kg)
+            sale, = self.Sale.create([{
+                'reference': 'S-1001',
+                'payment_term': self.payment_term.id,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 1,
+                    'product': p.id,
+                    'unit_price': Decimal('10.00'),
+                    'description': 'Test Description1',
+                    'unit': self.uom_kg.id,
+                } for p in (product, other_product)])],
+            }])
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+            shipment, = sale.shipments
+            self.Shipment.assign([shipment])
+            self.Shipment.pack([shipment])
+
+            package, = shipment.packages
+            self.assertEqual(len(package.moves), 2)
+            # 1 kg + 2 kg = 6.61 pounds
+            self.assertAlmostEqual(package.computed_weight, 6.61, delta=0.01)
+
+            # Removing a move
+            move, = [m for m in package.moves if m.product == other_product]
+            Move.write([move], {'package': None})
+            package = self.Package(package.id)
+            self.assertAlmostEqual(package.computed_weight, 2.2, delta=0.01)
+
+            # Changing the quantity
+            move, = package.moves
+            Move.draft([move])
+            Move.write([move], {'quantity': 3})
+            package = self.Package(package.id)
+            self.assertAlmostEqual(package.computed_weight, 6.61, delta=0.01)
+
+            # Changing the weight of the product
+            self.Template.write([product.template], {'weight': 2})
+            package = self.Package(package.id)
+            self.assertAlmostEqual(package.computed_weight, 13.23, delta=0.01)
+
+            self.assertEqual(
+                self.Package.compute_weight([package]),
+                {package.id: package.computed_weight}
+            )
+
+            # Packages not stored yet are computed when read
+            self.Package.write([package], {'computed_weight': None})
+            package = self.Package(package.id)
+            self.assertAlmostEqual(package.weight, 13.23, delta=0.01)
+            self.assertEqual(package.get_weight(), package.weight)
+            self.assertAlmostEqual(
+                package.get_computed_weight(), 13.23, delta=0.01
+            )
+
+            # Shipped packages keep their weight
+            self.Package.write([package], {'computed_weight': 13.23})
+            self.Shipment.write([shipment], {'state': 'done'})
+            POOL.get('stock.move').write(list(package.moves), {
+                'state': 'done',
+                'effective_date': date.today(),
+            })
+            self.Template.write([product.template], {'weight': 3})
+            package = self.Package(package.id)
+            self.assertEqual(package.computed_weight, 13.23)
+
+    @with_transaction()
+    def test_0150_uom_conversions(self):
+        """
+        Check cached uom conversions match compute_qty
+        """
+        self.setup_defaults()
+
+        uom_unit, = self.Uom.search([('symbol', '=', 'u')])
+        uoms = self.Uom.search([
+            ('category', 'in', [
+                self.uom_kg.category.id, uom_unit.category.id,
+            ]),
+        ])
+        for from_uom in uoms:
+            for to_uom in uoms:
+                for qty in (0, 1, 0.5, 3.14159, 1234.5678):
+                    if from_uom.category != to_uom.category:
+                        with self.assertRaises(ValueError):
+                            self.Uom.convert_qty(from_uom, qty or 1, to_uom)
+                        continue
+                    for round_ in (True, False):
+                        self.assertEqual(
+                            self.Uom.convert_qty(
+                                from_uom.id, qty, to_uom.id, round=round_
+                            ),
+                            self.Uom.compute_qty(
+                                from_uom, qty, to_uom, round=round_
+                            )
+                        )
+
+        # Changing a uom forgets the cached conversions
+        self.assertEqual(
+            self.Uom.convert_qty(self.uom_kg, 1.234, self.uom_pound), 2.72
+        )
+        self.Uom.write([self.uom_pound], {'rounding': 0.1})
+        self.assertEqual(
+            self.Uom.convert_qty(self.uom_kg, 1.234, self.uom_pound), 2.7
+        )
+
+    @with_transaction()
+    def test_0155_sale_weights(self):
+        """
+        Check the weights of sales are computed in bulk
+        """
+        self.setup_defaults()
+        uom_gram, = self.Uom.search([('symbol', '=', 'g')])
+
+        with Transaction().set_context(company=self.company.id):
+            products = [
+                (self.create_product(0.5, self.uom_kg), self.uom_pound),
+                (self.create_product(250, uom_gram), uom_gram),
+                (self.create_product(2, self.uom_kg, is_service=True),
+                    self.uom_kg),
+                (self.create_product(), self.uom_kg),
+            ]
+            sales = self.Sale.create([{
+                'reference': 'S-100%d' % i,
+                'payment_term': self.payment_term.id,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': i + 1,
+                    'product': product.id,
+                    'unit_price': Decimal('10.00'),
+                    'description': 'Test Description1',
+                    'unit': unit.id,
+                } for product, unit in products] + [{
+                    'type': 'comment',
+                    'description': 'Comment',
+                }])],
+            } for i in range(3)])
+
+            weights = self.Sale.get_weight(sales, 'weight')
+            for sale in sales:
+                self.assertEqual(weights[sale.id], sum(
+                    line.get_weight(sale.weight_uom, silent=True)
+                    for line in sale.lines
+                ))
+                self.assertEqual(sale.weight, weights[sale.id])
+
+            lines = [line for sale in sales for line in sale.lines]
+            self.assertEqual(
+                self.SaleLine.get_weights(lines, uom_gram, silent=True),
+                dict(
+                    (line.id, line.get_weight(uom_gram, silent=True))
+                    for line in lines
+                )
+            )
+            with self.assertRaises(UserError):
+                self.SaleLine.get_weights(lines, uom_gram)
+
+    @with_transaction()
+    def test_0160_canonical_weight(self):
+        """
+        Check the canonical weight of products follows their template
+        """
+        self.setup_defaults()
+        uom_gram, = self.Uom.search([('symbol', '=', 'g')])
+
+        product = self.create_product(0.5, self.uom_kg)
+        self.assertEqual(product.canonical_weight, 500)
+
+        self.Template.write([product.template], {
+            'weight': 2,
+            'weight_uom': self.uom_pound.id,
+        })
+        product = self.Product(product.id)
+        self.assertAlmostEqual(product.canonical_weight, 907.18, delta=0.01)
+
+        self.Template.write([product.template], {'weight': 250})
+        self.Template.write([product.template], {'weight_uom': uom_gram.id})
+        product = self.Product(product.id)
+        self.assertEqual(product.canonical_weight, 250)
+
+        self.assertIsNone(self.create_product().canonical_weight)
+        self.assertEqual(
+            self.Product.search([('canonical_weight', '>', 100)]), [product]
+        )
+
+        # Inactive products follow their template too
+        self.Product.write([product], {'active': False})
+        self.Template.write([product.template], {'weight': 300})
+        self.assertEqual(self.Product(product.id).canonical_weight, 300)
+        self.Product.write([product], {'active': True})
+
+        # Weights already in the requested uom are neither converted nor
+        # rounded
+        self.Template.write([product.template], {
+            'weight': 0.25,
+            'weight_uom': self.uom_pound.id,
+        })
+        with Transaction().set_context(company=self.company.id):
+            sale, = self.Sale.create([{
+                'reference': 'S-1001',
+                'payment_term': self.payment_term.id,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 1.5,
+                    'product': product.id,
+                    'unit_price': Decimal('10.00'),
+                    'description': 'Test Description1',
+                    'unit': product.template.default_uom.id,
+                }])],
+            }])
+        line, = sale.lines
+        self.assertEqual(line.get_weight(self.uom_pound), 0.375)
+        self.assertEqual(
+            self.SaleLine.get_weights([line], self.uom_pound),
+            {line.id: 0.375}
+        )
+        self.assertEqual(line.get_weight(self.uom_kg), 0.17)
+        self.assertEqual(
+            self.SaleLine.get_weights([line], self.uom_kg), {line.id: 0.17}
+        )
+
+    @unittest.skipIf(stock.numpy is None, 'NumPy is not available')
+    @with_transaction()
+    def test_0165_weight_arrays(self):
+        """
+        Check weights summed with NumPy arrays match the move weights
+        """
+        Move = POOL.get('stock.move')
+
+        self.setup_defaults()
+        uom_gram, = self.Uom.search([('symbol', '=', 'g')])
+
+        # Halfway cases round away from zero as in Python 2
+        numbers = [
+            0.5, 1.5, 2.5, -0.5, -2.5, 0.125, 2.675, 1.005, 0.49999999,
+            1234.5678, 0,
+        ]
+        for precision in (1, 0.01, 0.25, 0.001, 5):
+            self.assertEqual(
+                _round_array(stock.numpy.array(numbers), precision).tolist(),
+                [self.Uom(rounding=precision).round(n) for n in numbers]
+            )
+
+        with Transaction().set_context(company=self.company.id):
+            products = [
+                (self.create_product(0.5, self.uom_kg), self.uom_pound),
+                (self.create_product(3, self.uom_kg), self.uom_kg),
+                (self.create_product(250, uom_gram), uom_gram),
+                (self.create_product(), self.uom_kg),
+            ]
+            sale, = self.Sale.create([{
+                'reference': 'S-1001',
+                'payment_term': self.payment_term.id,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 3,
+                    'product': p.id,
+                    'unit_price': Decimal('10.00'),
+                    'description': 'Test Description1',
+                    'unit': unit.id,
+                } for p, unit in products])],
+            }])
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+            shipment, = sale.shipments
+            moves = shipment.outgoing_moves + shipment.inventory_moves
+            groups = [moves, moves[:1], [], moves[1:] + moves[:2]]
+
+            expected = {}
+            for weight_uom in (self.uom_kg, self.uom_pound, uom_gram):
+                weights = dict(
+                    (m.id, m.get_weight(weight_uom, silent=True))
+                    for m in moves
+                )
+                expected[weight_uom] = [
+                    sum(weights[m.id] for m in group) for group in groups
+                ]
+
+            if not config.has_section('shipping'):
+                config.add_section('shipping')
+            config.set('shipping', 'weight_array_threshold', '0')
+            try:
+                for weight_uom, sums in expected.iteritems():
+                    for weight, expected_weight in zip(
+                            Move.sum_weights(groups, weight_uom, silent=True),
+                            sums):
+                        self.assertAlmostEqual(weight, expected_weight)
+                with self.assertRaises(UserError):
+                    Move.sum_weights(groups, self.uom_kg)
+
+                # Without NumPy the weights are summed one by one
+                numpy_, stock.numpy = stock.numpy, None
+                try:
+                    self.assertEqual(
+                        Move.sum_weights(groups, uom_gram, silent=True),
+                        expected[uom_gram]
+                    )
+                finally:
+                    stock.numpy = numpy_
+            finally:
+                config.remove_option('shipping', 'weight_array_threshold')
+
+    @with_transaction()
+    def test_0170_auto_pack(self):
+        """
+        Check moves are packed into the box types of the carrier
+        """
+        Box, Item = packing.Box, packing.Item
+
+        small = Box('S', (10, 10, 10), 5)
+        large = Box('L', (30, 30, 30), 20)
+
+        def packed(items, boxes=(large, small)):
+            return sorted(
+                (b.box and b.box.key, sorted(i.key for i in b.items))
+                for b in packing.pack(items, boxes)
+            )
+
+        self.assertEqual(packing.pack([], [small]), [])
+        # Items are rotated and small items fill the open box
+        self.assertEqual(packed([
+            Item('a', (5, 25, 5), 1, 1),
+            Item('b', (5, 5, 5), 2, 1),
+        ]), [('L', ['a', 'b'])])
+        # Bins are moved to the smallest box holding them
+        self.assertEqual(
+            packed([Item('a', (5, 5, 5), 1, 1)]), [('S', ['a'])]
+        )
+        self.assertEqual(
+            packed([Item('a', (5, 5, 5), 1, 4), Item('b', (5, 5, 5), 1, 4)]),
+            [('L', ['a', 'b'])]
+        )
+        # Weight limits open new boxes
+        self.assertEqual(
+            packed([Item(i, (1, 1, 1), 1, 6) for i in range(5)], [large]),
+            [('L', [0, 1, 2]), ('L', [3, 4])]
+        )
+        # Items fitting no box are packed alone
+        self.assertEqual(packed([
+            Item('a', (40, 1, 1), 1, 1), Item('b', (1, 1, 1), 1, 25),
+            Item('c', (1, 1, 1), 1, 1),
+        ]), [(None, ['a']), (None, ['b']), ('S', ['c'])])
+
+        self.setup_defaults()
+        uom_cm, = self.Uom.search([('symbol', '=', 'cm')])
+
+        small_box, large_box = self.BoxType.create([{
+            'name': 'Small',
+            'length': 10,
+            'width': 10,
+            'height': 10,
+            'distance_unit': uom_cm.id,
+            'maximum_weight': 5,
+            'maximum_weight_uom': self.uom_kg.id,
+        }, {
+            'name': 'Large',
+            'length': 30,
+            'width': 30,
+            'height': 30,
+            'distance_unit': uom_cm.id,
+            'maximum_weight': 10,
+            'maximum_weight_uom': self.uom_kg.id,
+        }])
+        self.Carrier.write([self.carrier], {
+            'auto_pack': True,
+            'box_types': [('add', [small_box.id, large_box.id])],
+        })
+
+        with Transaction().set_context(company=self.company.id):
+            products = []
+            for weight, dimensions, quantity in [
+                    (1, (20, 10, 10), 1), (1.5, (5, 5, 5), 4),
+                    (2, (5, 5, 5), 2), (1, (50, 1, 1), 1)]:
+                product = self.create_product(weight, self.uom_kg)
+                length, width, height = dimensions
+                self.Template.write([product.template], {
+                    'length': length,
+                    'length_uom': uom_cm.id,
+                    'width': width,
+                    'width_uom': uom_cm.id,
+                    'height': height,
+                    'height_uom': uom_cm.id,
+                })
+                products.append((product, quantity))
+            sale, = self.Sale.create([{
+                'reference': 'S-1001',
+                'payment_term': self.payment_term.id,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': quantity,
+                    'product': p.id,
+                    'unit_price': Decimal('10.00'),
+                    'description': 'Test Description1',
+                    'unit': self.uom_kg.id,
+                } for p, quantity in products])],
+            }])
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+            shipment, = sale.shipments
+            self.Shipment.write([shipment], {'carrier': self.carrier.id})
+            self.Shipment.assign([shipment])
+            self.Shipment.pack([shipment])
+
+            packages = sorted(
+                (p.box_type and p.box_type.name, sorted(
+                    products.index((m.product, m.quantity)) for m in p.moves
+                ), p.computed_weight)
+                for p in shipment.packages
+            )
+            self.assertEqual([p[:2] for p in packages], [
+                (None, [3]), ('Large', [0, 1]), ('Small', [2]),
+            ])
+            # 1 kg + 4 * 1.5 kg and 2 * 2 kg in pounds
+            self.assertAlmostEqual(packages[1][2], 15.43, delta=0.01)
+            self.assertAlmostEqual(packages[2][2], 8.82, delta=0.01)
+
+    @with_transaction()
+    def test_0175_bulk_pack(self):
+        """
+        Check shipments are packed together and all the shipments with
+        unpackaged items are reported
+        """
+        self.setup_defaults()
+
+        with Transaction().set_context(company=self.company.id):
+            products = [
+                self.create_product(1, self.uom_kg),
+                self.create_product(2, self.uom_kg),
+            ]
+            sales = self.Sale.create([{
+                'reference': 'S-100%d' % i,
+                'payment_term': self.payment_term.id,
+                'party': self.sale_party.id,
+                'invoice_address': self.sale_party.addresses[0].id,
+                'shipment_address': self.sale_party.addresses[0].id,
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 1,
+                    'product': p.id,
+                    'unit_price': Decimal('10.00'),
+                    'description': 'Test Description1',
+                    'unit': self.uom_kg.id,
+                } for p in products])],
+            } for i in range(5)])
+            self.Sale.quote(sales)
+            self.Sale.confirm(sales)
+            self.Sale.process(sales)
+            shipments = [sale.shipments[0] for sale in sales]
+            self.Shipment.assign(shipments)
+
+            # Packages missing a move
+            for shipment in shipments[:2]:
+                self.Package.create([{
+                    'shipment': '%s,%d' % (shipment.__name__, shipment.id),
+                    'moves': [('add', [shipment.outgoing_moves[0].id])],
+                }])
+            self.assertEqual(
+                self.Shipment.get_unpackaged_shipments(shipments), shipments
+            )
+            with self.assertRaises(UserError) as cm:
+                self.Shipment.pack(shipments)
+            for shipment in shipments[:2]:
+                self.assertIn('#%s' % shipment.number, cm.exception.message)
+            self.assertNotIn('#%s' % shipments[2].number, cm.exception.message)
+            self.assertFalse(self.Package.search([
+                ('shipment', '=', '%s,%d' % (
+                    shipments[2].__name__, shipments[2].id
+                )),
+            ]))
+
+            # Packages holding all the moves
+            self.Package.create([{
+                'shipment': '%s,%d' % (shipments[2].__name__, shipments[2].id),
+                'moves': [('add', map(int, shipments[2].outgoing_moves))],
+            }])
+
+            # The default packages are created together
+            created = []
+            create_packages = self.Shipment.create_packages
+
+            def _create_packages(packages):
+                created.append(len(packages))
+                return create_packages(packages)
+
+            self.Shipment.create_packages = staticmethod(_create_packages)
+            try:
+                self.Shipment.pack(shipments[2:4])
+            finally:
+                del self.Shipment.create_packages
+            self.assertEqual(created, [1])
+
+            # Unless the class overrides _create_default_package
+            created = []
+            create_default_package = self.Shipment._create_default_package
+
+            def _create_default_package(shipment, box_type=None):
+                created.append(shipment)
+                return create_default_package(shipment, box_type)
+
+            self.Shipment._create_default_package = _create_default_package
+            try:
+                self.Shipment.pack(shipments[2:])
+            finally:
+                del self.Shipment._create_default_package
+            self.assertEqual(created, shipments[4:])
+
+            for shipment in shipments[2:]:
+                shipment = self.Shipment(shipment.id)
+                self.assertEqual(shipment.state, 'packed')
+                package, = shipment.packages
+                self.assertEqual(
+                    sorted(map(int, package.moves)),
+                    sorted(map(int, shipment.outgoing_moves))
+                )
+                # 1 kg + 2 kg in pounds
+                self.assertAlmostEqual(
+                    package.computed_weight, 6.61, delta=0.01
+                )
+            self.assertEqual(
+                self.Shipment.get_unpackaged_shipments(shipments[2:]), []
+            )
+
+    @with_transaction()
+    def test_0180_package_tracking_numbers(self):
+        """
+        Check tracking numbers of packages are read and searched in bulk
+        """
+        self.setup_defaults()
+        with Transaction().set_context({'company': self.company.id}):
+            packages = self.Package.create([{
+                'code': 'Package %d' % i,
+            } for i in range(4)])
+
+            def ref(package):
+                return '%s,%d' % (package.__name__, package.id)
+
+            cancelled, first, second, other, sale_tracking = \
+                self.Tracking.create([{
+                    'carrier': self.carrier,
+                    'tracking_number': number,
+                    'origin': origin,
+                } for number, origin in [
+                    ('AA1', ref(packages[0])),
+                    ('AA2', ref(packages[0])),
+                    ('AA3', ref(packages[0])),
+                    ('BB1', ref(packages[1])),
+                    ('AA4', 'sale.sale,%d' % packages[2].id),
+                ]])
+            cancelled.cancel_tracking_number()
+
+            self.assertEqual(
+                self.Package.get_tracking_number(packages, 'tracking_number'),
+                {
+                    packages[0].id: first.id,
+                    packages[1].id: other.id,
+                    packages[2].id: None,
+                    packages[3].id: None,
+                }
+            )
+            self.assertEqual(
+                self.Package.search([
+                    ('tracking_number', 'ilike', 'aa%'),
+                ]), [packages[0]]
+            )
+            self.assertEqual(
+                self.Package.search([
+                    ('tracking_number', 'in', ['AA4', 'BB1']),
+                ]), [packages[1]]
+            )
+            self.assertEqual(
+                self.Package.search([('tracking_number', '=', 'CC1')]), []
+            )
+
+    @with_transaction()
+    def test_0185_billable_weight(self):
+        """
+        Check packages are billed the larger of their weight and
+        dimensional weight
+        """
+        self.setup_defaults()
+        uom_cm, = self.Uom.search([('symbol', '=', 'cm')])
+
+        with Transaction().set_context(company=self.company.id):
+            address = self.sale_party.addresses[0]
+            currency = self.company.currency
+            box_type, = self.BoxType.create([{
+                'name': 'Large',
+                'length': 30,
+                'width': 30,
+                'height': 30,
+                'distance_unit': uom_cm.id,
+            }])
+            zone, = self.CarrierZone.create([{
+                'carrier': self.carrier.id,
+                'name': 'Florida',
+                'lines': [('create', [{
+                    'country': address.country.id,
+                    'subdivision': address.subdivision.id,
+                }])],
+            }])
+            self.Carrier.write([self.carrier], {
+                'box_types': [('add', [box_type.id])],
+                'dimensional_weight_divisor': 5000,
+                'dimensional_distance_uom': uom_cm.id,
+                'dimensional_weight_uom': self.uom_kg.id,
+                'use_rate_table': True,
+                'weight_breaks': [('create', [{
+                    'zone': zone.id,
+                    'weight': weight,
+                    'weight_uom': self.uom_kg.id,
+                    'price': Decimal(price),
+                    'currency': currency.id,
+                } for weight, price in [(5, '5'), (20, '12')]])],
+            })
+            other_carrier, = self.Carrier.copy([self.carrier], {
+                'dimensional_weight_divisor': None,
+                'use_rate_table': False,
+                'rate_zones': None,
+                'weight_breaks': None,
+            })
+
+            product = self.create_product(1, self.uom_kg)
+            sale, = self.Sale.create([{
+                'reference': 'S-1001',
+                'payment_term': self.payment_term.id,
+                'party': self.sale_party.id,
+                'invoice_address': address.id,
+                'shipment_address': address.id,
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 1,
+                    'product': product.id,
+                    'unit_price': Decimal('10.00'),
+                    'description': 'Test Description1',
+                    'unit': self.uom_kg.id,
+                }])],
+            }])
+            self.assertEqual(
+                self.Sale.get_billable_weights([sale], self.carrier),
+                {sale.id: sale.weight}
+            )
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+            shipment, = sale.shipments
+            self.Shipment.write([shipment], {'carrier': self.carrier.id})
+            self.Shipment.assign([shipment])
+            self.Shipment.pack([shipment])
+
+            # Packages without dimensions are billed their weight
+            shipment = self.Shipment(shipment.id)
+            package, = shipment.packages
+            self.assertIsNone(package.dimensional_weight)
+            self.assertEqual(package.billable_weight, package.weight)
+            self.assertEqual(shipment.billable_weight, shipment.weight)
+            rate, = shipment.get_shipping_rate(self.carrier)
+            self.assertEqual(rate['cost'], Decimal('5'))
+
+            # 30 cm * 30 cm * 30 cm / 5000 = 5.4 kg
+            self.Package.write([package], {'box_type': box_type.id})
+            shipment = self.Shipment(shipment.id)
+            package, = shipment.packages
+            dimensional_weight = self.Uom.compute_qty(
+                self.uom_kg, 5.4, package.weight_uom
+            )
+            self.assertEqual(package.dimensional_weight, dimensional_weight)
+            self.assertEqual(package.billable_weight, dimensional_weight)
+            self.assertEqual(shipment.billable_weight, dimensional_weight)
+            self.assertNotEqual(shipment.weight, dimensional_weight)
+            rate, = shipment.get_shipping_rate(self.carrier)
+            self.assertEqual(rate['cost'], Decimal('12'))
+
+            # Carriers without divisor bill the actual weight
+            self.assertEqual(
+                self.Package.get_billable_weights([package], other_carrier),
+                {package.id: package.weight}
+            )
+            self.assertEqual(
+                self.Shipment.get_billable_weights([shipment], other_carrier),
+                {shipment.id: shipment.weight}
+            )
+
+            # The fingerprint follows the dimensions of the packages
+            fingerprint = shipment._get_rate_fingerprint(self.carrier)
+            self.BoxType.write([box_type], {'length': 40})
+            self.assertNotEqual(
+                self.Shipment(shipment.id)._get_rate_fingerprint(self.carrier),
+                fingerprint
+            )
+
+    @with_transaction()
+    def test_0190_generate_shipping_labels_batch(self):
+        """
+        Check the labels of many shipments are generated together and the
+        failures are reported per shipment
+        """
+        LabelsBatch = POOL.get('shipping.label.batch', type='wizard')
+
+        self.setup_defaults()
+
+        def generate_shipping_labels(shipment, **kwargs):
+            if shipment.shipping_instructions == 'Reject':
+                raise UserError('Address rejected')
+            shipment.tracking_number, = self.Tracking.create([{
+                'carrier': self.carrier.id,
+                'tracking_number': 'AA%d' % shipment.id,
+                'origin': '%s,%d' % (shipment.__name__, shipment.id),
+            }])
+            shipment.cost = Decimal('7')
+
+        with Transaction().set_context(company=self.company.id):
+            warehouse = self.StockLocation.search([
+                ('type', '=', 'warehouse')
+            ])[0]
+            shipments = self.Shipment.create([{
+                'planned_date': date.today(),
+                'customer': self.sale_party.id,
+                'warehouse': warehouse,
+                'delivery_address': self.sale_party.addresses[0],
+                'carrier': self.carrier.id,
+                'cost_currency': self.company.currency.id,
+                'shipping_instructions': instructions,
+            } for instructions in ['Ok', 'Reject', 'Draft', 'Ok']])
+            self.Shipment.write(
+                [s for s in shipments if s.shipping_instructions != 'Draft'],
+                {'state': 'packed'}
+            )
+
+            # Without label support every shipment fails
+            errors = self.Shipment.generate_shipping_labels_batch(shipments)
+            self.assertEqual(sorted(errors), sorted(map(int, shipments)))
+            self.assertTrue(all(errors.values()))
+
+            self.Shipment.generate_shipping_labels = generate_shipping_labels
+            try:
+                errors = self.Shipment.generate_shipping_labels_batch(
+                    shipments
+                )
+                ok, rejected, draft, other = shipments
+                self.assertIsNone(errors[ok.id])
+                self.assertIsNone(errors[other.id])
+                self.assertEqual(errors[rejected.id], 'Address rejected')
+                self.assertTrue(errors[draft.id])
+
+                # Tracking numbers and costs are saved
+                for shipment in (ok, other):
+                    shipment = self.Shipment(shipment.id)
+                    self.assertEqual(
+                        shipment.tracking_number.tracking_number,
+                        'AA%d' % shipment.id
+                    )
+                    self.assertEqual(shipment.cost, Decimal('7'))
+                self.assertIsNone(self.Shipment(rejected.id).tracking_number)
+
+                # Shipments with a tracking number are refused
+                with Transaction().set_context(
+                        active_model=self.Shipment.__name__,
+                        active_ids=map(int, shipments)):
+                    session_id, _, _ = LabelsBatch.create()
+                    result = LabelsBatch.execute(session_id, {}, 'start')
+                    LabelsBatch.delete(session_id)
+                values = result['view']['defaults']
+                self.assertEqual(values['generated'], 0)
+                self.assertEqual(values['failed'], 4)
+                self.assertIn(
+                    '%s: Address rejected' % rejected.rec_name,
+                    values['summary']
+                )
+            finally:
+                del self.Shipment.generate_shipping_labels
+
+    @with_transaction()
+    def test_0191_generate_shipping_labels_workers(self):
+        """
+        Check the labels of a batch are generated by the pool of workers
+        """
+        self.setup_defaults()
+
+        threads = set()
+
+        @classmethod
+        def generate_labels(cls, database_name, user, context, shipment_id):
+            threads.add(threading.current_thread().name)
+            time.sleep(0.1)
+            if shipment_id == rejected.id:
+                raise UserError('Address rejected')
+
+        with Transaction().set_context(company=self.company.id):
+            warehouse = self.StockLocation.search([
+                ('type', '=', 'warehouse')
+            ])[0]
+            shipments = self.Shipment.create([{
+                'planned_date': date.today(),
+                'customer': self.sale_party.id,
+                'warehouse': warehouse,
+                'delivery_address': self.sale_party.addresses[0],
+                'carrier': self.carrier.id,
+                'cost_currency': self.company.currency.id,
+                'state': 'packed',
+            } for i in range(4)])
+            rejected = shipments[1]
+
+            self.Shipment._generate_labels = generate_labels
+            can_generate_apart = mixin._can_generate_apart
+            mixin._can_generate_apart = lambda: True
+            try:
+                errors = self.Shipment.generate_shipping_labels_batch(
+                    shipments
+                )
+            finally:
+                mixin._can_generate_apart = can_generate_apart
+                del self.Shipment._generate_labels
+
+        self.assertEqual(errors, dict(
+            (s.id, 'Address rejected' if s == rejected else None)
+            for s in shipments
+        ))
+        self.assertEqual(len(threads), 4)
+
 
 def suite():
     """
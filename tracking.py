@@ -3,13 +3,21 @@
     tracking.py
 
 """
+import logging
+
 from trytond.model import fields, ModelView, ModelSQL
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+
+from .adapter import get_adapter, iter_run
 
 __metaclass__ = PoolMeta
 __all__ = ['ShipmentTracking']
 
+logger = logging.getLogger(__name__)
+
 
 class ShipmentTracking(ModelSQL, ModelView):
     """Shipment Tracking
@@ -78,9 +86,12 @@ class ShipmentTracking(ModelSQL, ModelView):
 
     def refresh_status(self):
         """
-        Downstream module can implement this
+        Downstream module can implement this, carriers driven by an async
+        adapter are refreshed through the `track` operation of the adapter.
         """
-        pass
+        adapter = get_adapter(self.carrier.carrier_cost_method, 'track')
+        if adapter:
+            adapter.run('track', self)
 
     @classmethod
     @ModelView.button
@@ -89,13 +100,14 @@ class ShipmentTracking(ModelSQL, ModelView):
         Update tracking numbers state
         """
         for tracking_number in tracking_numbers:
+            tracking_number.carrier.throttle()
             tracking_number.refresh_status()
 
     @classmethod
     def refresh_tracking_numbers_cron(cls):
         """
         This is a cron method, responsible for updating state of
-        shipments.
+        shipments. Its calls to the carriers give way to interactive ones.
         """
         states_to_refresh = [
             'pending_cancellation',
@@ -107,8 +119,51 @@ class ShipmentTracking(ModelSQL, ModelView):
         tracking_numbers = cls.search([
             ('state', 'in', states_to_refresh),
         ])
+
+        # Tracking numbers of carriers driven by an adapter are all sent at
+        # once and refreshed while the others are
+        adapted, others = {}, []
         for tracking_number in tracking_numbers:
-            tracking_number.refresh_status()
+            method = tracking_number.carrier.carrier_cost_method
+            if get_adapter(method, 'track'):
+                adapted.setdefault(method, []).append(tracking_number)
+            else:
+                others.append(tracking_number)
+
+        with Transaction().set_context(shipping_call_priority='background'):
+            runs = [
+                iter_run(
+                    get_adapter(m, 'track'), 'track', [(t,) for t in numbers],
+                    throttle=lambda t: t.carrier.get_throttle()
+                ) for m, numbers in adapted.iteritems()
+            ]
+            for tracking_number in cls._iter_throttled(others):
+                tracking_number.refresh_status()
+
+        for run in runs:
+            for (tracking_number,), _, error in run:
+                if error is not None:
+                    logger.warning(
+                        'Failed to refresh tracking number %s: %s',
+                        tracking_number.rec_name, error
+                    )
+
+    @staticmethod
+    def _iter_throttled(tracking_numbers):
+        """
+        Yields the tracking numbers whose carrier budget allows a call, the
+        others are left to the next run
+        """
+        for tracking_number in tracking_numbers:
+            try:
+                tracking_number.carrier.throttle()
+            except UserError as exc:
+                logger.warning(
+                    'Failed to refresh tracking number %s: %s',
+                    tracking_number.rec_name, exc.message
+                )
+                continue
+            yield tracking_number
 
     @classmethod
     def _get_origin(cls):